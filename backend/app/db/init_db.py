@@ -1,7 +1,8 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from .session import engine
 from ..models.base import Base
-from ..models.subway import Trip, StopTimeUpdate, VehiclePosition, Alert, FeedUpdate
+from ..models.subway import Trip, StopTimeUpdate, VehiclePosition, Alert, AlertInformedEntity, FeedUpdate
+from ..models.history import StopTimeHistory, VehiclePositionHistory, ObservedArrival, ArrivalAggregate, ArrivalHistogramBucket
 
 async def init_db():
     """Initialize the database tables."""
@@ -9,7 +9,7 @@ ASYNC_DATABASE_URL = DATABASE_URL.replace('postgresql://', 'postgresql+asyncpg:/
 # Create async engine
 engine = create_async_engine(
     ASYNC_DATABASE_URL,
-    echo=True,
+    echo=os.getenv("SQL_ECHO", "false").lower() == "true",
     future=True,
     pool_size=5,
     max_overflow=10,
@@ -1,6 +1,16 @@
-from fastapi import FastAPI
+import os
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
-from .routers import subway
+from .routers import analytics, display, subway
+from .services.feed_poller import feed_poller
+from .services import metrics
+from .services.arrivals_index import arrivals_index
+from .services.display_boards import display_boards
+from .services.vehicle_index import vehicle_index
+from .services.feed_stream import feed_broadcaster
+from .services.db_service import store_snapshot
+from .services.history_store import FEED_HISTORY_ENABLED, history_maintenance, record_snapshot
+from .services.analytics import ANALYTICS_ENABLED, record_snapshot_arrivals
 
 app = FastAPI(
     title="NYC Subway Live API",
@@ -19,6 +29,57 @@ app.add_middleware(
 
 # Include routers
 app.include_router(subway.router)
+app.include_router(analytics.router)
+app.include_router(display.router)
+
+# Derived indexes are rebuilt whenever a feed publishes a new snapshot
+feed_poller.subscribe(arrivals_index.update)
+feed_poller.subscribe(vehicle_index.update)
+feed_poller.subscribe(display_boards.update)
+feed_poller.subscribe(feed_broadcaster.on_snapshot)
+metrics.REGISTRY.add_collector(feed_poller.collect_metrics)
+
+# Persist every new feed version when a database is configured for it, from
+# the worker ingesting from the MTA only
+FEED_STORE_ENABLED = os.getenv("FEED_STORE_ENABLED", "false").lower() == "true"
+if FEED_STORE_ENABLED:
+    feed_poller.subscribe(store_snapshot, leader_only=True)
+    if FEED_HISTORY_ENABLED:
+        feed_poller.subscribe(record_snapshot, leader_only=True)
+    if ANALYTICS_ENABLED:
+        feed_poller.subscribe(record_snapshot_arrivals, leader_only=True)
+
+@app.on_event("startup")
+async def start_feed_poller():
+    """
+    Start background ingestion of the MTA feeds
+    """
+    if os.getenv("FEED_POLLER_ENABLED", "true").lower() == "true":
+        await feed_poller.start()
+
+@app.on_event("startup")
+async def start_display_boards():
+    """
+    Start re-rendering the display boards between feed updates
+    """
+    await display_boards.start()
+
+@app.on_event("startup")
+async def start_history_maintenance():
+    """
+    Start partition upkeep and retention of the stored feed data
+    """
+    if FEED_STORE_ENABLED:
+        await history_maintenance.start()
+
+@app.on_event("shutdown")
+async def stop_feed_poller():
+    """
+    Stop background ingestion of the MTA feeds
+    """
+    await feed_poller.stop()
+    await display_boards.stop()
+    await history_maintenance.stop()
 
 @app.get("/")
 async def root():
@@ -38,4 +99,11 @@ async def health_check():
     return {
         "status": "healthy",
         "service": "NYC Subway Live API"
-    } 
\ No newline at end of file
+    } 
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics() -> Response:
+    """
+    Pipeline metrics in the Prometheus text exposition format
+    """
+    return Response(content=metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
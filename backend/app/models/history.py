@@ -0,0 +1,124 @@
+from sqlalchemy import Column, Date, DateTime, Enum, Float, Index, Integer, String
+from .base import Base
+from .subway import StopTimeScheduleRelationship, VehicleStopStatus
+
+
+class StopTimeHistory(Base):
+    """
+    Last prediction of every stop of every trip, kept for the trip's service
+    day after the trip leaves the feed. Trips are referenced by GTFS trip id
+    so rows outlive the live tables; on PostgreSQL the table is partitioned
+    by service day.
+    """
+    __tablename__ = 'stop_time_history'
+    __table_args__ = (
+        Index('ix_stop_time_history_route_arrival', 'route_id', 'arrival_time'),
+        Index('ix_stop_time_history_stop_arrival', 'stop_id', 'arrival_time'),
+        {'postgresql_partition_by': 'RANGE (service_date)'}
+    )
+
+    service_date = Column(Date, primary_key=True)
+    trip_id = Column(String(64), primary_key=True)
+    stop_id = Column(String(16), primary_key=True)
+    route_id = Column(String(16), nullable=False)
+    arrival_time = Column(DateTime)
+    arrival_delay = Column(Integer)
+    departure_time = Column(DateTime)
+    departure_delay = Column(Integer)
+    schedule_relationship = Column(Enum(StopTimeScheduleRelationship))
+    first_seen = Column(DateTime, nullable=False)
+    last_seen = Column(DateTime, nullable=False)
+
+
+class VehiclePositionHistory(Base):
+    """
+    Trail of reported vehicle positions, one row per trip and vehicle
+    timestamp, partitioned by service day on PostgreSQL
+    """
+    __tablename__ = 'vehicle_position_history'
+    __table_args__ = (
+        Index('ix_vehicle_position_history_route_timestamp', 'route_id', 'timestamp'),
+        Index('ix_vehicle_position_history_stop_timestamp', 'current_stop_id', 'timestamp'),
+        {'postgresql_partition_by': 'RANGE (service_date)'}
+    )
+
+    service_date = Column(Date, primary_key=True)
+    trip_id = Column(String(64), primary_key=True)
+    timestamp = Column(DateTime, primary_key=True)
+    route_id = Column(String(16), nullable=False)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    bearing = Column(Float)
+    current_stop_sequence = Column(Integer)
+    current_stop_id = Column(String(16))
+    current_status = Column(Enum(VehicleStopStatus))
+
+
+class ObservedArrival(Base):
+    """
+    Arrival of a trip at a stop, observed from a vehicle reporting
+    STOPPED_AT or from the stop dropping out of the trip's predictions.
+    Partitioned by service day on PostgreSQL.
+    """
+    __tablename__ = 'observed_arrivals'
+    __table_args__ = (
+        Index('ix_observed_arrivals_route_arrived', 'route_id', 'arrived_at'),
+        Index('ix_observed_arrivals_stop_arrived', 'stop_id', 'arrived_at'),
+        {'postgresql_partition_by': 'RANGE (service_date)'}
+    )
+
+    service_date = Column(Date, primary_key=True)
+    trip_id = Column(String(64), primary_key=True)
+    stop_id = Column(String(16), primary_key=True)
+    route_id = Column(String(16), nullable=False)
+    arrived_at = Column(DateTime, nullable=False)
+    delay = Column(Integer)
+    headway = Column(Integer)
+    source = Column(String(16), nullable=False)
+
+
+class ArrivalAggregate(Base):
+    """
+    Observed arrivals of a route at a stop during one hour of a service day,
+    with delay and headway counts and sums; the matching histograms are in
+    arrival_histogram_buckets. Maintained incrementally as arrivals are
+    observed and kept after the raw observations expire.
+    """
+    __tablename__ = 'arrival_aggregates'
+    __table_args__ = (
+        Index('ix_arrival_aggregates_stop_date', 'stop_id', 'service_date'),
+    )
+
+    route_id = Column(String(16), primary_key=True)
+    service_date = Column(Date, primary_key=True)
+    stop_id = Column(String(16), primary_key=True)
+    hour = Column(Integer, primary_key=True)
+    arrivals = Column(Integer, nullable=False)
+    delay_count = Column(Integer, nullable=False)
+    delay_sum = Column(Integer, nullable=False)
+    headway_count = Column(Integer, nullable=False)
+    headway_sum = Column(Integer, nullable=False)
+
+
+class ArrivalHistogramBucket(Base):
+    """
+    Count of one delay or headway histogram bucket of an arrival aggregate.
+    One row per non-empty bucket, so histograms grow with atomic increments
+    like the aggregate's counters.
+    """
+    __tablename__ = 'arrival_histogram_buckets'
+    __table_args__ = (
+        Index('ix_arrival_histogram_buckets_stop_date', 'stop_id', 'service_date'),
+    )
+
+    route_id = Column(String(16), primary_key=True)
+    service_date = Column(Date, primary_key=True)
+    stop_id = Column(String(16), primary_key=True)
+    hour = Column(Integer, primary_key=True)
+    metric = Column(String(8), primary_key=True)  # delay or headway
+    bucket = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False)
+
+
+# Tables partitioned by service day on PostgreSQL
+PARTITIONED_TABLES = (StopTimeHistory.__table__, VehiclePositionHistory.__table__, ObservedArrival.__table__)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, JSON, Enum, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, JSON, Enum, DateTime, Boolean, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from .base import Base, TimestampMixin
 import enum
@@ -47,12 +47,17 @@ class Trip(Base, TimestampMixin):
     Model for subway trips
     """
     __tablename__ = 'trips'
+    __table_args__ = (
+        # GTFS trip ids repeat every service day
+        UniqueConstraint('trip_id', 'start_date', name='uq_trips_trip_id_start_date'),
+    )
 
     id = Column(Integer, primary_key=True)
-    trip_id = Column(String, nullable=False, index=True)
-    route_id = Column(String, nullable=False, index=True)
-    start_time = Column(String)
-    start_date = Column(String)
+    trip_id = Column(String(64), nullable=False, index=True)
+    route_id = Column(String(16), nullable=False, index=True)
+    start_time = Column(String(8))
+    # Empty when the feed gave no start date, so it can be part of the key
+    start_date = Column(String(8), nullable=False, default='', server_default='', index=True)
     schedule_relationship = Column(Enum(TripScheduleRelationship))
     
     # Relationships
@@ -64,10 +69,14 @@ class StopTimeUpdate(Base, TimestampMixin):
     Model for stop time updates
     """
     __tablename__ = 'stop_time_updates'
+    __table_args__ = (
+        # Upcoming arrivals at a stop
+        Index('ix_stop_time_updates_stop_arrival', 'stop_id', 'arrival_time'),
+    )
 
     id = Column(Integer, primary_key=True)
     trip_id = Column(Integer, ForeignKey('trips.id'), nullable=False)
-    stop_id = Column(String, nullable=False, index=True)
+    stop_id = Column(String(16), nullable=False, index=True)
     arrival_time = Column(DateTime, index=True)
     arrival_delay = Column(Integer)
     departure_time = Column(DateTime, index=True)
@@ -84,13 +93,13 @@ class VehiclePosition(Base, TimestampMixin):
     __tablename__ = 'vehicle_positions'
 
     id = Column(Integer, primary_key=True)
-    trip_id = Column(Integer, ForeignKey('trips.id'), nullable=False)
+    trip_id = Column(Integer, ForeignKey('trips.id'), nullable=False, unique=True)
     latitude = Column(Float)
     longitude = Column(Float)
     bearing = Column(Float)
     speed = Column(Float)
     current_stop_sequence = Column(Integer)
-    current_stop_id = Column(String, index=True)
+    current_stop_id = Column(String(16), index=True)
     current_status = Column(Enum(VehicleStopStatus))
     timestamp = Column(DateTime, index=True)
 
@@ -99,19 +108,50 @@ class VehiclePosition(Base, TimestampMixin):
 
 class Alert(Base, TimestampMixin):
     """
-    Model for service alerts
+    Model for service alerts. One row per distinct alert content under a
+    feed entity id; rows are deactivated when their alert leaves the feed.
     """
     __tablename__ = 'alerts'
+    __table_args__ = (
+        UniqueConstraint('feed_id', 'entity_id', 'content_hash', name='uq_alerts_feed_entity_content'),
+    )
 
     id = Column(Integer, primary_key=True)
+    feed_id = Column(String(16), nullable=False, default='', server_default='')
+    entity_id = Column(String(64), nullable=False, default='', server_default='')
+    content_hash = Column(String(40), nullable=False, default='', server_default='')
     effect = Column(Enum(AlertEffect), nullable=False)
     header_text = Column(String)
     description_text = Column(String)
     active = Column(Boolean, default=True, index=True)
+    expired_at = Column(DateTime)
     
     # Store informed entities as JSON
     informed_entities = Column(JSON)
 
+    # Relationships
+    informed = relationship("AlertInformedEntity", back_populates="alert", cascade="all, delete-orphan")
+
+class AlertInformedEntity(Base):
+    """
+    Route, stop or trip an alert applies to, indexed for lookups by route
+    and stop
+    """
+    __tablename__ = 'alert_informed_entities'
+    __table_args__ = (
+        Index('ix_alert_informed_entities_route', 'route_id', 'alert_id'),
+        Index('ix_alert_informed_entities_stop', 'stop_id', 'alert_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    alert_id = Column(Integer, ForeignKey('alerts.id', ondelete='CASCADE'), nullable=False, index=True)
+    route_id = Column(String(16))
+    stop_id = Column(String(16))
+    trip_id = Column(String(64))
+
+    # Relationships
+    alert = relationship("Alert", back_populates="informed")
+
 class FeedUpdate(Base, TimestampMixin):
     """
     Model to track feed updates
@@ -0,0 +1,60 @@
+from datetime import date, datetime, timedelta
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, Optional, Tuple
+from ..db.session import get_db
+from ..services.analytics import AnalyticsService
+
+router = APIRouter(
+    prefix="/api/analytics",
+    tags=["analytics"]
+)
+
+def service_days(end_date: Optional[str], days: int) -> Tuple[date, date]:
+    """
+    First and last service day of a range ending on `end_date` (YYYYMMDD,
+    default today)
+    """
+    try:
+        end = datetime.strptime(end_date, "%Y%m%d").date() if end_date else date.today()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid date: {end_date}")
+    return end - timedelta(days=days - 1), end
+
+@router.get("/routes/{route_id}")
+async def get_route_performance(
+    route_id: str,
+    stop_id: Optional[str] = None,
+    end_date: Optional[str] = Query(None, alias="date"),
+    days: int = Query(1, ge=1, le=366),
+    db: AsyncSession = Depends(get_db)
+) -> Dict:
+    """
+    Get hourly delay and headway statistics of a route from observed arrivals
+    Args:
+        route_id: GTFS route id, e.g. "A"
+        stop_id: Optional stop to restrict to, e.g. "A27N"
+        end_date: Last service day (YYYYMMDD), today by default
+        days: Number of service days ending on `end_date`
+    """
+    start, end = service_days(end_date, days)
+    return await AnalyticsService(db).performance(start, end, route_id=route_id, stop_id=stop_id)
+
+@router.get("/stops/{stop_id}")
+async def get_stop_performance(
+    stop_id: str,
+    route_id: Optional[str] = None,
+    end_date: Optional[str] = Query(None, alias="date"),
+    days: int = Query(1, ge=1, le=366),
+    db: AsyncSession = Depends(get_db)
+) -> Dict:
+    """
+    Get hourly delay and headway statistics at a stop from observed arrivals
+    Args:
+        stop_id: GTFS stop id including direction, e.g. "127N"
+        route_id: Optional route to restrict to
+        end_date: Last service day (YYYYMMDD), today by default
+        days: Number of service days ending on `end_date`
+    """
+    start, end = service_days(end_date, days)
+    return await AnalyticsService(db).performance(start, end, route_id=route_id, stop_id=stop_id)
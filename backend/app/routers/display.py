@@ -0,0 +1,54 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from typing import Dict, List
+from ..services.display_boards import DISPLAY_LONG_POLL_TIMEOUT, ROW_WIDTH, DisplayBoards, get_display_boards
+from .subway import etag_matches
+
+router = APIRouter(
+    prefix="/api/display",
+    tags=["display"]
+)
+
+@router.get("/boards")
+async def get_boards(
+    boards: DisplayBoards = Depends(get_display_boards)
+) -> Dict[str, List[Dict]]:
+    """
+    Get the configured display boards and their stops
+    """
+    return {
+        "boards": [
+            {"name": board.name, "stop_ids": list(board.stop_ids), "rows": board.rows, "row_width": ROW_WIDTH}
+            for board in boards.boards.values()
+        ]
+    }
+
+@router.get("/boards/{name}")
+async def get_board(
+    name: str,
+    request: Request,
+    wait: float = Query(0, ge=0, le=DISPLAY_LONG_POLL_TIMEOUT),
+    boards: DisplayBoards = Depends(get_display_boards)
+) -> Response:
+    """
+    Get the pre-rendered rows of a display board as fixed-width ASCII: one
+    line per row with the route (3 characters, left aligned), direction
+    (N, S or blank) and minutes away (3 characters, right aligned). With
+    `wait` set and an If-None-Match naming the current rows, the request
+    is held until the rows change and answered with an empty 304 if they
+    don't within `wait` seconds.
+    Args:
+        name: Board name from DISPLAY_BOARDS
+        wait: Seconds to long-poll for a change
+    """
+    board = boards.get(name)
+    if board is None:
+        raise HTTPException(status_code=404, detail=f"Unknown display board: {name}")
+
+    if_none_match = request.headers.get("if-none-match")
+    if etag_matches(if_none_match, board.etag) and wait:
+        await board.wait_for_change(board.etag, wait)
+
+    headers = {"ETag": board.etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, board.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=board.body, media_type="text/plain; charset=us-ascii", headers=headers)
@@ -1,6 +1,19 @@
-from fastapi import APIRouter, Depends, HTTPException
-from typing import Dict, List
+import asyncio
+import logging
+import math
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, WebSocket
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, List, Optional
+from ..db.session import get_db
+from ..services.db_service import DBService
 from ..services.mta_service import MTAService
+from ..services import feed_encoding
+from ..services.feed_poller import FeedPoller, FeedUnavailable, get_feed_poller
+from ..services.arrivals_index import ArrivalsIndex, get_arrivals_index
+from ..services.feed_stream import FeedBroadcaster, get_feed_broadcaster
+from ..services.vehicle_index import VehicleIndex, get_vehicle_index
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/api/subway",
@@ -13,40 +26,273 @@ async def get_available_lines() -> Dict[str, List[str]]:
     Get list of available subway lines grouped by line group
     """
     return {
-        "line_groups": list(MTAService.FEED_URLS.keys())
+        "line_groups": list(MTAService.LINE_GROUPS.keys())
     }
 
+@router.get("/feeds")
+async def get_feed_states(
+    poller: FeedPoller = Depends(get_feed_poller)
+) -> Dict[str, Dict]:
+    """
+    Get snapshot age and fetch hit/miss counters for each upstream feed
+    """
+    return {
+        "feeds": poller.feed_states()
+    }
+
+def negotiate_format(request: Request, formats: Optional[List[str]] = None) -> str:
+    """
+    Response format for a request's Accept header
+    """
+    try:
+        return feed_encoding.negotiate_format(request.headers.get("accept"), formats)
+    except feed_encoding.NotAcceptable:
+        raise HTTPException(status_code=406, detail="Supported formats: " + ", ".join(
+            media_type for fmt in (formats or feed_encoding.available_formats())
+            for media_type in feed_encoding.FORMATS[fmt]
+        ))
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Whether an If-None-Match header matches an entity tag, using the weak
+    comparison RFC 7232 prescribes for it
+    """
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
 @router.get("/feed/{line_group}")
 async def get_line_feed(
     line_group: str,
+    request: Request,
     data_type: str = None,
-    mta_service: MTAService = Depends(MTAService)
-) -> Dict:
+    poller: FeedPoller = Depends(get_feed_poller)
+) -> Response:
     """
-    Get real-time feed data for a specific line group
+    Get real-time feed data for a specific line group, served from the
+    latest snapshot published by the background feed poller. The body is
+    JSON, msgpack or the upstream GTFS-RT protobuf depending on the Accept
+    header, and is encoded and compressed once per feed version. Every
+    variant carries a strong ETag for its feed version, and requests whose
+    If-None-Match still matches get an empty 304. While the MTA is failing
+    the last good snapshot keeps being served with an Age and a Warning
+    header; only a feed that was never fetched answers 503.
     Args:
         line_group: The subway line group to fetch data for
         data_type: Optional type of data to return (vehicle_positions, alerts, trip_updates)
     """
-    return await mta_service.get_feed_data(line_group, data_type)
+    if line_group not in MTAService.LINE_GROUPS:
+        raise HTTPException(status_code=400, detail=f"Invalid line group: {line_group}")
+    if data_type not in ('vehicle_positions', 'alerts', 'trip_updates'):
+        data_type = None
+
+    fmt = negotiate_format(request)
+    encoding = feed_encoding.negotiate_encoding(request.headers.get("accept-encoding"))
+
+    try:
+        snapshot = await poller.get_line_snapshot(line_group)
+    except FeedUnavailable as e:
+        raise HTTPException(
+            status_code=503,
+            detail="Unable to fetch MTA data",
+            headers={"Retry-After": str(max(1, round(e.retry_after or poller.interval)))}
+        )
+    except Exception:
+        raise HTTPException(status_code=503, detail="Unable to fetch MTA data")
+
+    feed_status = snapshot.status(poller.stale_after)
+    feed_state = poller.feed_state(snapshot.feed_id)
+    etag = snapshot.etag(line_group, data_type, fmt, encoding)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "no-cache",
+        "Age": str(int(feed_status['age_seconds'])),
+        "X-Feed-Fetched-At": str(feed_status['fetched_at']),
+        "X-Feed-Age": str(feed_status['age_seconds']),
+        "X-Feed-Stale": str(feed_status['stale']).lower(),
+        "Vary": "Accept, Accept-Encoding"
+    }
+    if feed_state.consecutive_failures:
+        headers["X-Feed-Upstream-Failures"] = str(feed_state.consecutive_failures)
+        headers["Warning"] = '111 - "Revalidation Failed"'
+    elif feed_status['stale']:
+        headers["Warning"] = '110 - "Response is Stale"'
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        body = snapshot.encoded(line_group, data_type, fmt, encoding)
+    except LookupError:
+        raise HTTPException(status_code=406, detail="GTFS-RT payload not available for this feed version")
+
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=feed_encoding.media_type(fmt), headers=headers)
+
+@router.get("/stops/{stop_id}/arrivals")
+async def get_stop_arrivals(
+    stop_id: str,
+    request: Request,
+    limit: int = Query(5, ge=1, le=50),
+    arrivals: ArrivalsIndex = Depends(get_arrivals_index)
+) -> Response:
+    """
+    Get the next trains at a stop across all feeds, as JSON or msgpack
+    Args:
+        stop_id: GTFS stop id, e.g. "127" for both directions or "127N"
+        limit: Maximum number of arrivals to return
+    """
+    fmt = negotiate_format(request, [fmt for fmt in feed_encoding.available_formats() if fmt != 'protobuf'])
+    body = feed_encoding.serialize({
+        "stop_id": stop_id,
+        "arrivals": arrivals.next_arrivals(stop_id, limit)
+    }, fmt)
+    return Response(content=body, media_type=feed_encoding.media_type(fmt), headers={"Vary": "Accept"})
+
+@router.get("/vehicles")
+async def get_vehicles_in_bbox(
+    request: Request,
+    bbox: str = Query(..., description="min_lon,min_lat,max_lon,max_lat"),
+    routes: str = None,
+    limit: int = Query(None, ge=1),
+    vehicles: VehicleIndex = Depends(get_vehicle_index)
+) -> Response:
+    """
+    Get the vehicles currently inside a map viewport, as JSON or msgpack
+    Args:
+        bbox: Bounding box as west,south,east,north in degrees
+        routes: Optional comma-separated route ids to restrict to
+        limit: Maximum number of vehicles to return
+    """
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(value) for value in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be min_lon,min_lat,max_lon,max_lat")
+    if not all(math.isfinite(value) for value in (min_lon, min_lat, max_lon, max_lat)):
+        raise HTTPException(status_code=400, detail="bbox coordinates must be finite numbers")
+    if min_lat > max_lat or min_lon > max_lon:
+        raise HTTPException(status_code=400, detail="bbox minimums must not exceed maximums")
+
+    fmt = negotiate_format(request, [fmt for fmt in feed_encoding.available_formats() if fmt != 'protobuf'])
+    found = vehicles.within(
+        (min_lat, min_lon, max_lat, max_lon),
+        frozenset(routes.split(",")) if routes else None,
+        limit
+    )
+    body = feed_encoding.serialize({"count": len(found), "vehicles": found}, fmt)
+    return Response(content=body, media_type=feed_encoding.media_type(fmt), headers={"Vary": "Accept"})
+
+@router.get("/alerts")
+async def get_alerts(
+    route_id: Optional[str] = None,
+    stop_id: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
+) -> Dict[str, List[Dict]]:
+    """
+    Get the active service alerts informing a route or stop from the
+    stored feeds, through the informed entity index
+    Args:
+        route_id: Optional GTFS route id, e.g. "A"
+        stop_id: Optional GTFS stop id, e.g. "127" or "127N"
+    """
+    alerts = await DBService(db).get_alerts_for(route_id, stop_id)
+    return {
+        "alerts": [
+            {
+                "id": alert.entity_id,
+                "feed_id": alert.feed_id,
+                "effect": alert.effect.name,
+                "header_text": alert.header_text,
+                "description_text": alert.description_text,
+                "informed_entity": alert.informed_entities or [],
+                "since": alert.created_at.isoformat()
+            }
+            for alert in alerts
+        ]
+    }
+
+# APIRouter.websocket does not apply the router prefix in this FastAPI version
+@router.websocket(f"{router.prefix}/stream")
+async def stream_feed(
+    websocket: WebSocket,
+    line_groups: str = "1-2-3",
+    stop_ids: str = None,
+    broadcaster: FeedBroadcaster = Depends(get_feed_broadcaster)
+):
+    """
+    Push the current snapshot of the requested line groups, then only the
+    changes of each feed update
+    Args:
+        line_groups: Comma-separated line groups to subscribe to
+        stop_ids: Optional comma-separated stop ids to restrict updates to
+    """
+    groups = frozenset(line_groups.split(","))
+    if not groups.issubset(MTAService.LINE_GROUPS):
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    subscription = broadcaster.subscribe(groups, frozenset(stop_ids.split(",")) if stop_ids else None)
+
+    async def push():
+        # Feed version each line group was last synchronised to; diffs
+        # queued before a (re)sync are already part of its snapshot
+        synced = {}
+
+        async def send_snapshots():
+            for message in await broadcaster.snapshot_messages(subscription):
+                synced[message.line_group] = message.version
+                await websocket.send_text(message.text)
+
+        await send_snapshots()
+        while True:
+            message = await subscription.queue.get()
+            if message is None:
+                # Client fell behind; start over from the current state
+                await send_snapshots()
+            elif message.version > synced.get(message.line_group, 0):
+                await websocket.send_text(message.text)
+
+    async def receive():
+        # Incoming messages are ignored; receiving only notices the client leaving
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    pusher = asyncio.ensure_future(push())
+    receiver = asyncio.ensure_future(receive())
+    try:
+        await asyncio.wait({pusher, receiver}, return_when=asyncio.FIRST_COMPLETED)
+        if pusher.done():
+            logger.error(f"Feed stream for {line_groups} stopped: {pusher.exception()!r}")
+            await websocket.close(code=1011)
+        else:
+            receiver.result()
+    finally:
+        pusher.cancel()
+        receiver.cancel()
+        broadcaster.unsubscribe(subscription)
+
 
 @router.get("/status")
 async def get_service_status(
-    mta_service: MTAService = Depends(MTAService)
+    poller: FeedPoller = Depends(get_feed_poller)
 ) -> Dict:
     """
-    Get overall subway service status
+    Get overall subway service status from the feed fetchers' state (last
+    success, last error and consecutive failures per feed) without
+    contacting the MTA
     """
-    try:
-        # Get status for a sample line to check service health
-        sample_data = await mta_service.get_feed_data("1-2-3")
-        return {
-            "status": "operational",
-            "message": "Subway feed service is running normally",
-            "last_update": sample_data["header"]["timestamp"]
-        }
-    except Exception as e:
+    status = poller.service_status()
+    if status["status"] == "unavailable":
         raise HTTPException(
             status_code=503,
             detail="Subway feed service is currently unavailable"
-        ) 
\ No newline at end of file
+        )
+    messages = {
+        "operational": "Subway feed service is running normally",
+        "degraded": "Some subway feeds are stale, failing or not fetched yet: " + ", ".join(
+            dict.fromkeys(status["failing_feeds"] + status["unavailable_feeds"])
+        )
+    }
+    return {"message": messages[status["status"]], **status}
@@ -0,0 +1,445 @@
+"""
+On-time performance and headway analytics.
+
+Arrivals are observed between consecutive feed versions: a vehicle
+reporting STOPPED_AT at a stop, or a stop dropping out of a trip's
+predictions once its predicted time has passed. Each observation is stored
+in observed_arrivals and, only if it was not stored before, folded into the
+hourly arrival_aggregates row of its route and stop and the fixed-width
+histogram buckets of that row, which answer percentile queries without
+scanning raw observations. Aggregates only ever grow by atomic increments,
+so concurrent writers cannot lose each other's arrivals.
+"""
+import logging
+import os
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects import postgresql
+from ..db.session import AsyncSessionLocal
+from .db_service import _chunks
+from .decoded_feed import DecodedFeed, HAS_ARRIVAL, HAS_DEPARTURE
+from .feed_diff import ChangeSet
+from .history_store import HistoryService, service_date
+from .static_gtfs import StaticGTFS, get_static_gtfs
+from ..models.history import ArrivalAggregate, ArrivalHistogramBucket, ObservedArrival
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_ENABLED = os.getenv("ANALYTICS_ENABLED", "false").lower() == "true"
+# Stops dropping out more than this many seconds before their predicted
+# time are treated as cancelled or rerouted rather than served
+ARRIVAL_TOLERANCE = int(os.getenv("ARRIVAL_TOLERANCE", "120"))
+
+# (low, high, width) in seconds of the delay and headway histograms; values
+# outside the range are counted in the first or last bucket
+DELAY_BUCKETS = (-600, 3600, 30)
+HEADWAY_BUCKETS = (0, 3600, 30)
+MAX_HEADWAY = HEADWAY_BUCKETS[1]
+
+STOPPED_AT = 1
+SKIPPED = 1
+
+# (service_date, route_id, stop_id, hour) of one aggregate row
+AggregateKey = Tuple[date, str, str, int]
+# (service_date, trip_id, stop_id) of one observed arrival
+ObservationKey = Tuple[date, str, str]
+# Aggregate columns that only ever grow
+COUNTER_COLUMNS = ('arrivals', 'delay_count', 'delay_sum', 'headway_count', 'headway_sum')
+
+
+class Histogram:
+    """
+    Fixed-width histogram of integer seconds
+    """
+
+    __slots__ = ('low', 'width', 'counts')
+
+    def __init__(self, low: int, high: int, width: int, counts: Optional[List[int]] = None):
+        self.low = low
+        self.width = width
+        size = (high - low) // width
+        self.counts = list(counts) if counts and len(counts) == size else [0] * size
+
+    def bucket(self, value: int) -> int:
+        """
+        Index of the bucket counting a value
+        """
+        return min(max((value - self.low) // self.width, 0), len(self.counts) - 1)
+
+    def add(self, value: int, count: int = 1):
+        self.counts[self.bucket(value)] += count
+
+    def merge(self, other: 'Histogram'):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+
+    def percentile(self, q: float) -> Optional[float]:
+        """
+        Value below which a fraction `q` of the samples fall, interpolated
+        within its bucket
+        """
+        total = sum(self.counts)
+        if not total:
+            return None
+        target = q * total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= target:
+                return self.low + (index + (target - seen) / count) * self.width
+            seen += count
+        return self.low + len(self.counts) * self.width
+
+
+class ArrivalTracker:
+    """
+    Detects arrivals between consecutive feed versions and remembers, per
+    service day, which trips were already seen at which stops and when each
+    route last arrived at each stop
+    """
+
+    def __init__(self, tolerance: int = ARRIVAL_TOLERANCE):
+        self.tolerance = tolerance
+        self.loaded: Set[date] = set()
+        self._seen: Dict[date, Set[Tuple[str, str]]] = {}
+        self._last_arrival: Dict[Tuple[str, str], datetime] = {}
+
+    def observe(self, old: DecodedFeed, changes: ChangeSet, static: Optional[StaticGTFS] = None) -> List[Dict]:
+        """
+        Arrivals seen in a change set, not yet deduplicated
+        Args:
+            old: Version the changes were computed from
+            changes: Changes to the new version
+            static: Static schedule to compute delays the feed omits
+        """
+        timestamp = changes.header['timestamp']
+        observations = []
+
+        def observation(trip_id: str, stop_id: str, arrived_at: int, delay: Optional[int], source: str) -> Dict:
+            start_date = changes.trip_dates.get(trip_id)
+            if delay is None and static is not None and start_date:
+                row = static.find_trip(trip_id, start_date)
+                scheduled = static.scheduled_time(row, stop_id, start_date) if row is not None else None
+                if scheduled is not None:
+                    delay = arrived_at - scheduled
+            return {
+                'service_date': service_date(start_date, timestamp),
+                'trip_id': trip_id,
+                'stop_id': stop_id,
+                'route_id': changes.trip_routes.get(trip_id, ''),
+                'arrived_at': datetime.fromtimestamp(arrived_at),
+                'delay': delay,
+                'source': source
+            }
+
+        for vehicle in changes.vehicle_positions.changed():
+            if vehicle.get('current_status') == STOPPED_AT and 'trip' in vehicle and vehicle.get('stop_id'):
+                observations.append(observation(
+                    vehicle['trip']['trip_id'], vehicle['stop_id'], vehicle.get('timestamp', timestamp), None, 'vehicle'
+                ))
+
+        deleted = set(changes.stop_time_updates.deleted)
+        if deleted:
+            stop_times = old.stop_times
+            for i, trip in enumerate(old.trips):
+                for row in stop_times.trip_rows(i):
+                    key = (trip.trip_id, stop_times.stop_ids[stop_times.stop_code[row]])
+                    if key not in deleted:
+                        continue
+                    flags = stop_times.flags[row]
+                    if not flags & (HAS_ARRIVAL | HAS_DEPARTURE):
+                        continue
+                    update = stop_times.row_dict(row)
+                    if update.get('schedule_relationship') == SKIPPED:
+                        continue
+                    arrived_at = stop_times.event_time(row)
+                    if arrived_at > timestamp + self.tolerance:
+                        continue
+                    observations.append(observation(
+                        key[0], key[1], arrived_at, update.get('arrival', {}).get('delay'), 'feed'
+                    ))
+        return observations
+
+    def load(self, day: date, rows: Iterable[Tuple[str, str, str, datetime]]):
+        """
+        Seed a service day's state from stored (trip_id, stop_id, route_id,
+        arrived_at) observations
+        """
+        seen = self._seen.setdefault(day, set())
+        for trip_id, stop_id, route_id, arrived_at in rows:
+            seen.add((trip_id, stop_id))
+            last = self._last_arrival.get((route_id, stop_id))
+            if last is None or arrived_at > last:
+                self._last_arrival[route_id, stop_id] = arrived_at
+        self.loaded.add(day)
+        for old_day in [d for d in self.loaded if d < day - timedelta(days=2)]:
+            self.loaded.discard(old_day)
+            self._seen.pop(old_day, None)
+
+    def accept(self, observations: List[Dict]) -> List[Dict]:
+        """
+        Observations of trips not yet seen at their stop, in arrival order,
+        with the headway since the route's previous arrival at the stop.
+        The tracker is left unchanged until remember() is called with them.
+        """
+        accepted = []
+        seen_now: Set[ObservationKey] = set()
+        last_now: Dict[Tuple[str, str], datetime] = {}
+        for item in sorted(observations, key=lambda o: o['arrived_at']):
+            key = (item['trip_id'], item['stop_id'])
+            if key in self._seen.get(item['service_date'], ()) or (item['service_date'], *key) in seen_now:
+                continue
+            seen_now.add((item['service_date'], *key))
+            last_key = (item['route_id'], item['stop_id'])
+            last = last_now.get(last_key) or self._last_arrival.get(last_key)
+            item['headway'] = None
+            if last is None or item['arrived_at'] > last:
+                headway = int((item['arrived_at'] - last).total_seconds()) if last is not None else None
+                # Longer gaps are service breaks, not headways
+                if headway is not None and headway <= MAX_HEADWAY:
+                    item['headway'] = headway
+                last_now[last_key] = item['arrived_at']
+            accepted.append(item)
+        return accepted
+
+    def remember(self, observations: List[Dict]):
+        """
+        Mark accepted observations as seen, once they are committed
+        """
+        for item in observations:
+            self._seen.setdefault(item['service_date'], set()).add((item['trip_id'], item['stop_id']))
+            last_key = (item['route_id'], item['stop_id'])
+            last = self._last_arrival.get(last_key)
+            if last is None or item['arrived_at'] > last:
+                self._last_arrival[last_key] = item['arrived_at']
+
+
+class AnalyticsService(HistoryService):
+    """
+    Storage and queries of observed arrivals and their aggregates
+    """
+
+    async def record_arrivals(self, observations: List[Dict], tracker: ArrivalTracker) -> int:
+        """
+        Store new observations and fold the ones actually inserted into the
+        hourly aggregates. The tracker only learns about the observations
+        once the transaction is committed.
+        Returns:
+            Number of observations stored
+        """
+        try:
+            for day in {item['service_date'] for item in observations} - tracker.loaded:
+                result = await self.db.execute(
+                    select(ObservedArrival.trip_id, ObservedArrival.stop_id, ObservedArrival.route_id, ObservedArrival.arrived_at)
+                    .where(ObservedArrival.service_date == day)
+                )
+                tracker.load(day, result.all())
+
+            accepted = tracker.accept(observations)
+            if not accepted:
+                return 0
+            await self.ensure_partitions({item['service_date'] for item in accepted})
+            inserted = await self._insert_observations(accepted)
+            await self._update_aggregates(inserted)
+            await self.db.commit()
+        except Exception:
+            await self.db.rollback()
+            raise
+        # Observations another writer stored first are known all the same
+        tracker.remember(accepted)
+        return len(inserted)
+
+    async def _insert_observations(self, observations: List[Dict]) -> List[Dict]:
+        """
+        Insert observations, skipping ones already stored, and return those
+        actually inserted
+        """
+        key_columns = (ObservedArrival.service_date, ObservedArrival.trip_id, ObservedArrival.stop_id)
+        inserted: Set[ObservationKey] = set()
+        if self.db.bind.dialect.name == 'postgresql':
+            for chunk in _chunks(observations):
+                result = await self.db.execute(
+                    postgresql.insert(ObservedArrival).values(chunk).on_conflict_do_nothing().returning(*key_columns)
+                )
+                inserted.update(tuple(row) for row in result.all())
+        else:
+            # No RETURNING on this dialect: look the keys up first. SQLite
+            # has a single writer, so nothing can be inserted in between.
+            keys = [(item['service_date'], item['trip_id'], item['stop_id']) for item in observations]
+            stored = set()
+            for chunk in _chunks(keys):
+                result = await self.db.execute(select(*key_columns).where(tuple_(*key_columns).in_(chunk)))
+                stored.update(tuple(row) for row in result.all())
+            inserted = set(keys) - stored
+            if inserted:
+                await self.db.execute(ObservedArrival.__table__.insert(), [
+                    item for item, key in zip(observations, keys) if key in inserted
+                ])
+        return [item for item in observations if (item['service_date'], item['trip_id'], item['stop_id']) in inserted]
+
+    async def _update_aggregates(self, observations: List[Dict]):
+        """
+        Add newly inserted observations to their aggregate rows and
+        histogram buckets with atomic increments
+        """
+        rows: Dict[AggregateKey, Dict] = {}
+        buckets: Dict[Tuple, int] = {}
+        delay_histogram, headway_histogram = Histogram(*DELAY_BUCKETS), Histogram(*HEADWAY_BUCKETS)
+        for item in observations:
+            key = (item['service_date'], item['route_id'], item['stop_id'], item['arrived_at'].hour)
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = _empty_counters(*key)
+            row['arrivals'] += 1
+            if item['delay'] is not None:
+                row['delay_count'] += 1
+                row['delay_sum'] += item['delay']
+                bucket = (*key, 'delay', delay_histogram.bucket(item['delay']))
+                buckets[bucket] = buckets.get(bucket, 0) + 1
+            if item['headway'] is not None:
+                row['headway_count'] += 1
+                row['headway_sum'] += item['headway']
+                bucket = (*key, 'headway', headway_histogram.bucket(item['headway']))
+                buckets[bucket] = buckets.get(bucket, 0) + 1
+        if not rows:
+            return
+
+        statement = self._insert(ArrivalAggregate)
+        statement = statement.on_conflict_do_update(
+            index_elements=[
+                ArrivalAggregate.service_date, ArrivalAggregate.route_id, ArrivalAggregate.stop_id, ArrivalAggregate.hour
+            ],
+            set_={
+                column: getattr(ArrivalAggregate, column) + getattr(statement.excluded, column)
+                for column in COUNTER_COLUMNS
+            }
+        )
+        await self.db.execute(statement, list(rows.values()))
+
+        if buckets:
+            statement = self._insert(ArrivalHistogramBucket)
+            statement = statement.on_conflict_do_update(
+                index_elements=[
+                    ArrivalHistogramBucket.service_date, ArrivalHistogramBucket.route_id, ArrivalHistogramBucket.stop_id,
+                    ArrivalHistogramBucket.hour, ArrivalHistogramBucket.metric, ArrivalHistogramBucket.bucket
+                ],
+                set_={'count': ArrivalHistogramBucket.count + statement.excluded.count}
+            )
+            await self.db.execute(statement, [
+                {
+                    'service_date': day, 'route_id': route_id, 'stop_id': stop_id, 'hour': hour,
+                    'metric': metric, 'bucket': bucket, 'count': count
+                }
+                for (day, route_id, stop_id, hour, metric, bucket), count in buckets.items()
+            ])
+
+    async def performance(
+        self,
+        start: date,
+        end: date,
+        route_id: Optional[str] = None,
+        stop_id: Optional[str] = None
+    ) -> Dict:
+        """
+        Hourly arrivals, delay and headway statistics of a route and/or stop
+        over a range of service days
+        Args:
+            start: First service day
+            end: Last service day (inclusive)
+            route_id: Optional route to restrict to
+            stop_id: Optional stop to restrict to
+        """
+        def restrict(query, model):
+            query = query.where(model.service_date.between(start, end))
+            if route_id is not None:
+                query = query.where(model.route_id == route_id)
+            if stop_id is not None:
+                query = query.where(model.stop_id == stop_id)
+            return query
+
+        hours: Dict[int, Dict] = {}
+        total = _empty_aggregate(None, route_id, stop_id, None)
+
+        def hour_values(hour: int) -> Dict:
+            values = hours.get(hour)
+            if values is None:
+                values = hours[hour] = _empty_aggregate(None, route_id, stop_id, hour)
+            return values
+
+        result = await self.db.execute(restrict(select(ArrivalAggregate), ArrivalAggregate))
+        for aggregate in result.scalars():
+            for target in (hour_values(aggregate.hour), total):
+                for column in COUNTER_COLUMNS:
+                    target[column] += getattr(aggregate, column)
+
+        result = await self.db.execute(restrict(
+            select(
+                ArrivalHistogramBucket.hour, ArrivalHistogramBucket.metric,
+                ArrivalHistogramBucket.bucket, ArrivalHistogramBucket.count
+            ),
+            ArrivalHistogramBucket
+        ))
+        for hour, metric, bucket, count in result.all():
+            for target in (hour_values(hour), total):
+                histogram = target[f'{metric}_histogram']
+                if 0 <= bucket < len(histogram.counts):
+                    histogram.counts[bucket] += count
+
+        return {
+            'route_id': route_id,
+            'stop_id': stop_id,
+            'start_date': start.isoformat(),
+            'end_date': end.isoformat(),
+            'summary': _statistics(total),
+            'hours': [{'hour': hour, **_statistics(hours[hour])} for hour in sorted(hours)]
+        }
+
+
+def _empty_counters(day: Optional[date], route_id: Optional[str], stop_id: Optional[str], hour: Optional[int]) -> Dict:
+    return {
+        'service_date': day,
+        'route_id': route_id,
+        'stop_id': stop_id,
+        'hour': hour,
+        **{column: 0 for column in COUNTER_COLUMNS}
+    }
+
+
+def _empty_aggregate(day: Optional[date], route_id: Optional[str], stop_id: Optional[str], hour: Optional[int]) -> Dict:
+    return {
+        **_empty_counters(day, route_id, stop_id, hour),
+        'delay_histogram': Histogram(*DELAY_BUCKETS),
+        'headway_histogram': Histogram(*HEADWAY_BUCKETS)
+    }
+
+
+def _statistics(values: Dict) -> Dict:
+    """
+    JSON view of an aggregate: counts, means and percentiles in seconds
+    """
+    def summary(prefix: str) -> Dict:
+        count = values[f'{prefix}_count']
+        result = {'count': count, 'mean': round(values[f'{prefix}_sum'] / count, 1) if count else None}
+        for q in (50, 90, 95):
+            value = values[f'{prefix}_histogram'].percentile(q / 100)
+            result[f'p{q}'] = round(value, 1) if value is not None else None
+        return result
+
+    return {'arrivals': values['arrivals'], 'delay': summary('delay'), 'headway': summary('headway')}
+
+
+arrival_tracker = ArrivalTracker()
+
+
+async def record_snapshot_arrivals(snapshot, previous=None):
+    """
+    Feed poller listener storing the arrivals observed between a feed
+    version and the one before it
+    """
+    if previous is None:
+        return
+    observations = arrival_tracker.observe(previous.decoded, snapshot.changes(previous), get_static_gtfs())
+    if observations:
+        async with AsyncSessionLocal() as session:
+            stored = await AnalyticsService(session).record_arrivals(observations, arrival_tracker)
+        logger.debug(f"Recorded {stored} arrivals for feed {snapshot.feed_id}")
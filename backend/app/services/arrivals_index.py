@@ -0,0 +1,119 @@
+import heapq
+import time
+from array import array
+from bisect import bisect_left
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .feed_poller import FeedSnapshot
+from .static_gtfs import get_static_gtfs
+
+
+class FeedArrivals:
+    """
+    Per-snapshot index from stop_id to the feed's upcoming stop events,
+    sorted by time
+    """
+
+    __slots__ = ('snapshot', 'stops')
+
+    def __init__(self, snapshot: FeedSnapshot):
+        self.snapshot = snapshot
+        stop_times = snapshot.decoded.stop_times
+
+        rows_by_code: Dict[int, List[int]] = {}
+        for row, code in enumerate(stop_times.stop_code):
+            rows_by_code.setdefault(code, []).append(row)
+
+        event_time = stop_times.event_time
+        self.stops: Dict[str, Tuple[array, array]] = {}
+        for code, rows in rows_by_code.items():
+            rows.sort(key=event_time)
+            self.stops[stop_times.stop_ids[code]] = (
+                array('q', (event_time(row) for row in rows)),
+                array('I', rows)
+            )
+
+    def upcoming(self, stop_id: str, after: int) -> Iterator[Tuple[int, int, str, 'FeedArrivals']]:
+        """
+        (time, row, stop_id, index) for events at a stop from `after` on,
+        soonest first
+        """
+        entry = self.stops.get(stop_id)
+        if entry is None:
+            return iter(())
+        times, rows = entry
+        start = bisect_left(times, after)
+        return ((times[i], rows[i], stop_id, self) for i in range(start, len(times)))
+
+    def arrival(self, row: int, stop_id: str, event_time: int) -> Dict:
+        """
+        Compact description of one indexed stop event
+        """
+        decoded = self.snapshot.decoded
+        trip = decoded.trips[decoded.stop_times.trip_index[row]]
+        arrival = {
+            'route_id': trip.route_id,
+            'trip_id': trip.trip_id,
+            'stop_id': stop_id,
+            'direction': stop_id[-1] if stop_id[-1:] in ('N', 'S') else None,
+            'time': event_time
+        }
+        static = get_static_gtfs()
+        if static is not None:
+            arrival['stop_name'] = static.stop_name(stop_id)
+            trip_row = static.find_trip(trip.trip_id, trip.start_date or None)
+            if trip_row is not None:
+                arrival['headsign'] = static.headsign(trip_row)
+        return arrival
+
+
+class ArrivalsIndex:
+    """
+    Upcoming arrivals by stop across every feed. Each feed's part is
+    rebuilt only when that feed publishes a new snapshot.
+    """
+
+    def __init__(self):
+        self._feeds: Dict[str, FeedArrivals] = {}
+
+    def update(self, snapshot: FeedSnapshot, previous: Optional[FeedSnapshot] = None):
+        """
+        Replace the index for the snapshot's feed
+        """
+        self._feeds[snapshot.feed_id] = FeedArrivals(snapshot)
+
+    def next_arrivals(self, stop_id: str, limit: int = 5, after: Optional[int] = None) -> List[Dict]:
+        """
+        Next arrivals at a stop across all feeds, soonest first
+        Args:
+            stop_id: GTFS stop id; a parent id without an N/S suffix
+                matches both directions
+            limit: Maximum number of arrivals to return
+            after: POSIX time to search from (defaults to now)
+        """
+        if after is None:
+            after = int(time.time())
+        stop_ids = [stop_id] if stop_id[-1:] in ('N', 'S') else [f"{stop_id}N", f"{stop_id}S"]
+        streams = [
+            feed.upcoming(child_id, after)
+            for feed in list(self._feeds.values())
+            for child_id in stop_ids
+        ]
+        return [
+            feed.arrival(row, child_id, event_time)
+            for event_time, row, child_id, feed in islice(
+                heapq.merge(*streams, key=lambda event: event[0]),
+                limit
+            )
+        ]
+
+
+arrivals_index = ArrivalsIndex()
+
+
+def get_arrivals_index() -> ArrivalsIndex:
+    """
+    Get the application-wide arrivals index
+    """
+    return arrivals_index
@@ -1,68 +1,479 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, bindparam, delete, or_, select, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional, Tuple
+from ..db.session import AsyncSessionLocal
+from .decoded_feed import DecodedFeed
+from .feed_diff import ChangeSet, alert_content_hash, diff_feeds
+from .metrics import DB_INGEST_SECONDS
 from ..models.subway import (
-    Trip, StopTimeUpdate, VehiclePosition, Alert, FeedUpdate,
+    Trip, StopTimeUpdate, VehiclePosition, Alert, AlertInformedEntity, FeedUpdate,
     TripScheduleRelationship, StopTimeScheduleRelationship, VehicleStopStatus, AlertEffect
 )
 
+# Maximum number of bound parameters in a single IN (...) clause
+IN_CLAUSE_CHUNK_SIZE = 500
+
+# (trip_id, start_date) identifying a stored trip; GTFS trip ids repeat daily
+TripKey = Tuple[str, str]
+
+
+def trip_key(trip: Dict) -> TripKey:
+    """
+    Stored trip key of a trip descriptor, with an empty start date when
+    the feed gave none
+    """
+    return trip['trip_id'], trip.get('start_date') or ''
+
+
+def _chunks(values: List, size: int = IN_CLAUSE_CHUNK_SIZE) -> Iterator[List]:
+    """
+    Split a list into consecutive chunks
+    """
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
 class DBService:
     """
-    Service for handling database operations
+    Service for handling database operations on an async session
     """
     
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
 
-    def store_feed_data(self, data: Dict) -> FeedUpdate:
+    async def store_feed_data(self, data: Dict, feed_id: str = '') -> FeedUpdate:
         """
-        Store a complete feed update
+        Store a complete feed update one entity at a time
+        Args:
+            data: Feed data in the format of MTAService._process_feed_data
+            feed_id: Feed the data came from, scoping its alerts
         """
-        # Create feed update record
-        feed_update = FeedUpdate(
-            timestamp=datetime.fromtimestamp(data['header']['timestamp']),
-            version=data['header']['version'],
-            processed_count=len(data['entities']),
-            trips_count=sum(1 for e in data['entities'] if 'trip' in e),
-            vehicles_count=sum(1 for e in data['entities'] if 'vehicle' in e),
-            alerts_count=sum(1 for e in data['entities'] if 'alert' in e)
+        try:
+            feed_update = self._feed_update(data)
+            self.db.add(feed_update)
+
+            # Process each entity
+            for trip in data['trip_updates']:
+                await self._store_trip(trip, trip['id'])
+            for vehicle in data['vehicle_positions']:
+                await self._store_vehicle_position(vehicle, vehicle['id'])
+            await self._sync_alerts(feed_id, data['alerts'])
+
+            await self.db.commit()
+        except Exception:
+            await self.db.rollback()
+            raise
+        return feed_update
+
+    async def bulk_store_feed_data(self, data: Dict, feed_id: str = '') -> FeedUpdate:
+        """
+        Store a complete feed update in a single transaction with
+        set-based statements: one trip upsert, one id lookup, one delete
+        and one multi-row insert per table instead of several round trips
+        per entity
+        Args:
+            data: Feed data in the format of MTAService._process_feed_data
+            feed_id: Feed the data came from, scoping its alerts
+        """
+        try:
+            feed_update = await self._bulk_store(data, feed_id)
+            await self.db.commit()
+        except Exception:
+            await self.db.rollback()
+            raise
+        return feed_update
+
+    async def _bulk_store(self, data: Dict, feed_id: str = '') -> FeedUpdate:
+        """
+        Statements of bulk_store_feed_data, without transaction handling
+        """
+        feed_update = self._feed_update(data)
+        self.db.add(feed_update)
+
+        # Trips referenced by trip updates, plus vehicle-only trips
+        trips = {trip_key(trip): trip for trip in data['trip_updates']}
+        for vehicle in data['vehicle_positions']:
+            if 'trip' in vehicle:
+                trips.setdefault(trip_key(vehicle['trip']), vehicle['trip'])
+
+        trip_ids = await self._upsert_trips(list(trips.values()))
+        await self._replace_stop_time_updates(data['trip_updates'], trip_ids)
+        await self._upsert_vehicle_positions(data['vehicle_positions'], trip_ids)
+
+        await self._sync_alerts(feed_id, data['alerts'])
+
+        return feed_update
+
+    async def apply_feed_changes(self, changes: ChangeSet, feed_id: str = '') -> FeedUpdate:
+        """
+        Write only the rows that changed since the previously stored
+        version of a feed, in a single transaction. Trips and vehicles that
+        left the feed are kept, as with full stores; the stop time updates
+        of trips still in the feed are deleted when their stop drops out.
+        Args:
+            changes: Changes from the stored version to the new one
+            feed_id: Feed the changes came from, scoping its alerts
+        """
+        try:
+            feed_update = await self._apply_changes(changes, feed_id)
+            await self.db.commit()
+        except Exception:
+            await self.db.rollback()
+            raise
+        return feed_update
+
+    async def _apply_changes(self, changes: ChangeSet, feed_id: str = '') -> FeedUpdate:
+        """
+        Statements of apply_feed_changes, without transaction handling
+        """
+        feed_update = self._feed_update_record(
+            changes.header, changes.counts['trips'], changes.counts['vehicles'], changes.counts['alerts']
         )
         self.db.add(feed_update)
-        
-        # Process each entity
-        for entity in data['entities']:
-            if 'trip' in entity:
-                self._store_trip(entity['trip'], entity['id'])
-            if 'vehicle' in entity:
-                self._store_vehicle_position(entity['vehicle'], entity['id'])
-            if 'alert' in entity:
-                self._store_alert(entity['alert'], entity['id'])
-        
-        self.db.commit()
+
+        stop_time_updates = changes.stop_time_updates
+        vehicles = changes.vehicle_positions.changed()
+        trip_ids = await self._upsert_trips(changes.trips.changed())
+
+        def stored_key(trip_id: str) -> TripKey:
+            return trip_id, changes.trip_dates.get(trip_id) or ''
+
+        # Trips whose stops or vehicle changed without the trip itself changing
+        missing = {update['trip_id'] for update in stop_time_updates.changed()}
+        missing.update(vehicle['trip']['trip_id'] for vehicle in vehicles if 'trip' in vehicle)
+        missing.difference_update(trip_ids)
+        if missing:
+            trip_ids.update(await self._trip_ids([stored_key(trip_id) for trip_id in missing]))
+        # Trips with no stored row: first seen through their vehicle, pruned
+        # by prune_live or never stored because an earlier store failed
+        unstored_trips = {
+            vehicle['trip']['trip_id']: vehicle['trip']
+            for vehicle in vehicles
+            if 'trip' in vehicle and vehicle['trip']['trip_id'] not in trip_ids
+        }
+        for row in stop_time_updates.changed():
+            trip_id = row['trip_id']
+            if trip_id not in trip_ids and trip_id not in unstored_trips:
+                unstored_trips[trip_id] = {
+                    'trip_id': trip_id,
+                    'route_id': changes.trip_routes.get(trip_id) or '',
+                    'start_date': changes.trip_dates.get(trip_id)
+                }
+        updated_stops, inserted_stops = stop_time_updates.updated, stop_time_updates.inserted
+        if unstored_trips:
+            trip_ids.update(await self._upsert_trips(list(unstored_trips.values())))
+            # Their stop rows went with the trip, so changed stops are inserted
+            inserted_stops = inserted_stops + [row for row in updated_stops if row['trip_id'] in unstored_trips]
+            updated_stops = [row for row in updated_stops if row['trip_id'] not in unstored_trips]
+
+        deleted_trips = set(changes.trips.deleted)
+        deleted_stops = [
+            (trip_id, stop_id) for trip_id, stop_id in stop_time_updates.deleted
+            if trip_id not in deleted_trips
+        ]
+        if deleted_stops:
+            stored_trip_ids = await self._trip_ids(list({stored_key(trip_id) for trip_id, _ in deleted_stops}))
+            keys = [
+                (stored_trip_ids[trip_id], stop_id)
+                for trip_id, stop_id in deleted_stops
+                if trip_id in stored_trip_ids
+            ]
+            for chunk in _chunks(keys):
+                await self.db.execute(
+                    delete(StopTimeUpdate)
+                    .where(tuple_(StopTimeUpdate.trip_id, StopTimeUpdate.stop_id).in_(chunk))
+                    .execution_options(synchronize_session=False)
+                )
+
+        if updated_stops:
+            table = StopTimeUpdate.__table__
+            columns = (
+                'arrival_time', 'arrival_delay', 'departure_time', 'departure_delay',
+                'schedule_relationship', 'updated_at'
+            )
+            await self.db.execute(
+                update(table).where(and_(
+                    table.c.trip_id == bindparam('b_trip_id'),
+                    table.c.stop_id == bindparam('b_stop_id')
+                )),
+                [
+                    {'b_trip_id': row['trip_id'], 'b_stop_id': row['stop_id'], **{column: row[column] for column in columns}}
+                    for row in self._stop_time_rows(updated_stops, trip_ids)
+                ]
+            )
+        if inserted_stops:
+            await self.db.execute(
+                StopTimeUpdate.__table__.insert(),
+                self._stop_time_rows(inserted_stops, trip_ids)
+            )
+
+        await self._upsert_vehicle_positions(vehicles, trip_ids)
+        await self._sync_alerts(feed_id, changes.alerts.changed(), changes.alerts.deleted)
         return feed_update
 
-    def _store_trip(self, trip_data: Dict, entity_id: str) -> Trip:
+    def _feed_update(self, data: Dict) -> FeedUpdate:
+        """
+        Build the feed update record for a feed
+        """
+        return self._feed_update_record(
+            data['header'], len(data['trip_updates']), len(data['vehicle_positions']), len(data['alerts'])
+        )
+
+    def _feed_update_record(self, header: Dict, trips_count: int, vehicles_count: int, alerts_count: int) -> FeedUpdate:
+        """
+        Build the feed update record for a feed version with the given
+        entity counts
+        """
+        return FeedUpdate(
+            timestamp=datetime.fromtimestamp(header['timestamp']),
+            version=header['version'],
+            processed_count=trips_count + vehicles_count + alerts_count,
+            trips_count=trips_count,
+            vehicles_count=vehicles_count,
+            alerts_count=alerts_count
+        )
+
+    def _insert(self, model):
+        """
+        Dialect-specific INSERT supporting ON CONFLICT
+        """
+        dialect = self.db.bind.dialect.name
+        if dialect == 'postgresql':
+            return postgresql.insert(model)
+        if dialect == 'sqlite':
+            return sqlite.insert(model)
+        raise NotImplementedError(f"Bulk ingestion is not supported on {dialect}")
+
+    async def _trip_ids(self, keys: List[TripKey]) -> Dict[str, int]:
+        """
+        Map stored trip keys to database ids with one query per chunk. The
+        result is keyed by GTFS trip id: within one feed version a trip id
+        has a single start date.
+        """
+        ids = {}
+        for chunk in _chunks(keys):
+            result = await self.db.execute(
+                select(Trip.trip_id, Trip.id).where(tuple_(Trip.trip_id, Trip.start_date).in_(chunk))
+            )
+            ids.update(result.all())
+        return ids
+
+    async def _upsert_trips(self, trips: List[Dict]) -> Dict[str, int]:
+        """
+        Insert or update trips by (trip_id, start_date) and return their
+        database ids by trip id
+        """
+        if not trips:
+            return {}
+        now = datetime.utcnow()
+        statement = self._insert(Trip)
+        statement = statement.on_conflict_do_update(
+            index_elements=[Trip.trip_id, Trip.start_date],
+            set_={
+                'route_id': statement.excluded.route_id,
+                'start_time': statement.excluded.start_time,
+                'schedule_relationship': statement.excluded.schedule_relationship,
+                'updated_at': now
+            }
+        )
+        await self.db.execute(statement, [
+            {
+                'trip_id': trip['trip_id'],
+                'route_id': trip['route_id'],
+                'start_time': trip.get('start_time'),
+                'start_date': trip.get('start_date') or '',
+                'schedule_relationship': TripScheduleRelationship(trip.get('schedule_relationship', 0)),
+                'created_at': now,
+                'updated_at': now
+            }
+            for trip in trips
+        ])
+        return await self._trip_ids(list({trip_key(trip) for trip in trips}))
+
+    async def _replace_stop_time_updates(self, trip_updates: List[Dict], trip_ids: Dict[str, int]):
+        """
+        Replace the stop time updates of every trip in the feed
+        """
+        ids = [trip_ids[trip['trip_id']] for trip in trip_updates if 'stop_time_updates' in trip]
+        for chunk in _chunks(ids):
+            await self.db.execute(delete(StopTimeUpdate).where(StopTimeUpdate.trip_id.in_(chunk)))
+
+        rows = self._stop_time_rows(
+            [{'trip_id': trip['trip_id'], **update} for trip in trip_updates for update in trip.get('stop_time_updates', [])],
+            trip_ids
+        )
+        if rows:
+            await self.db.execute(StopTimeUpdate.__table__.insert(), rows)
+
+    def _stop_time_rows(self, updates: List[Dict], trip_ids: Dict[str, int]) -> List[Dict]:
+        """
+        Table rows for stop time updates tagged with their GTFS trip id
+        """
+        now = datetime.utcnow()
+        return [
+            {
+                'trip_id': trip_ids[update['trip_id']],
+                'stop_id': update['stop_id'],
+                'arrival_time': datetime.fromtimestamp(update['arrival']['time']) if update.get('arrival') else None,
+                'arrival_delay': update.get('arrival', {}).get('delay'),
+                'departure_time': datetime.fromtimestamp(update['departure']['time']) if update.get('departure') else None,
+                'departure_delay': update.get('departure', {}).get('delay'),
+                'schedule_relationship': StopTimeScheduleRelationship(update.get('schedule_relationship', 0)),
+                'created_at': now,
+                'updated_at': now
+            }
+            for update in updates
+        ]
+
+    async def _alert_ids(self, feed_id: str, keys: List[Tuple[str, str]]) -> Dict[Tuple[str, str], int]:
+        """
+        Map (entity id, content hash) keys of a feed's alerts to database ids
+        """
+        ids = {}
+        for chunk in _chunks(keys):
+            result = await self.db.execute(
+                select(Alert.entity_id, Alert.content_hash, Alert.id).where(and_(
+                    Alert.feed_id == feed_id,
+                    tuple_(Alert.entity_id, Alert.content_hash).in_(chunk)
+                ))
+            )
+            ids.update(((entity_id, content_hash), id) for entity_id, content_hash, id in result.all())
+        return ids
+
+    async def _sync_alerts(self, feed_id: str, alerts: List[Dict], left_feed: Optional[List[str]] = None):
+        """
+        Upsert alerts keyed by feed, entity id and content hash, index the
+        informed entities of new ones, and expire the rows they replace
+        Args:
+            feed_id: Feed the alerts came from
+            alerts: Alerts to store
+            left_feed: Content hashes of alerts that left the feed, when
+                `alerts` only holds the new ones; when None, `alerts` is
+                the feed's complete alert set and every other active alert
+                of the feed is expired
+        """
+        now = datetime.utcnow()
+        keyed = {(alert['id'], alert.get('content_hash') or alert_content_hash(alert)): alert for alert in alerts}
+        known = await self._alert_ids(feed_id, list(keyed))
+        if keyed:
+            statement = self._insert(Alert)
+            statement = statement.on_conflict_do_update(
+                index_elements=[Alert.feed_id, Alert.entity_id, Alert.content_hash],
+                set_={'active': True, 'expired_at': None, 'updated_at': now}
+            )
+            await self.db.execute(statement, [
+                {
+                    'feed_id': feed_id,
+                    'entity_id': entity_id,
+                    'content_hash': content_hash,
+                    'effect': AlertEffect(alert['effect']),
+                    'header_text': alert.get('header_text'),
+                    'description_text': alert.get('description_text'),
+                    'active': True,
+                    'expired_at': None,
+                    'informed_entities': alert.get('informed_entity', []),
+                    'created_at': now,
+                    'updated_at': now
+                }
+                for (entity_id, content_hash), alert in keyed.items()
+            ])
+        ids = {**known, **await self._alert_ids(feed_id, [key for key in keyed if key not in known])}
+
+        # Informed entities are part of the content hash, so rows never change them
+        informed = [
+            {
+                'alert_id': ids[key],
+                'route_id': entity.get('route_id') or entity.get('trip', {}).get('route_id'),
+                'stop_id': entity.get('stop_id'),
+                'trip_id': entity.get('trip', {}).get('trip_id')
+            }
+            for key, alert in keyed.items() if key not in known
+            for entity in alert.get('informed_entity', [])
+        ]
+        if informed:
+            await self.db.execute(AlertInformedEntity.__table__.insert(), informed)
+
+        active = select(Alert.id).where(and_(Alert.feed_id == feed_id, Alert.active == True))
+        if left_feed is not None:
+            if not left_feed:
+                return
+            active = active.where(Alert.content_hash.in_(left_feed))
+        current = set(ids.values())
+        expired = [id for id in (await self.db.execute(active)).scalars().all() if id not in current]
+        for chunk in _chunks(expired):
+            await self.db.execute(
+                update(Alert)
+                .where(Alert.id.in_(chunk))
+                .values(active=False, expired_at=now, updated_at=now)
+                .execution_options(synchronize_session=False)
+            )
+
+    async def _upsert_vehicle_positions(self, vehicles: List[Dict], trip_ids: Dict[str, int]):
+        """
+        Insert or update the position of every vehicle with a known trip
+        """
+        now = datetime.utcnow()
+        rows = {}
+        for vehicle_data in vehicles:
+            if 'trip' not in vehicle_data:
+                continue
+            position = vehicle_data.get('position') or {}
+            trip_id = trip_ids[vehicle_data['trip']['trip_id']]
+            rows[trip_id] = {
+                'trip_id': trip_id,
+                'latitude': position.get('latitude'),
+                'longitude': position.get('longitude'),
+                'bearing': position.get('bearing'),
+                'speed': position.get('speed'),
+                'current_stop_sequence': vehicle_data.get('current_stop_sequence'),
+                'current_stop_id': vehicle_data.get('stop_id'),
+                'current_status': VehicleStopStatus(vehicle_data.get('current_status', 0)),
+                'timestamp': datetime.fromtimestamp(vehicle_data['timestamp']) if 'timestamp' in vehicle_data else now,
+                'created_at': now,
+                'updated_at': now
+            }
+        if not rows:
+            return
+
+        statement = self._insert(VehiclePosition)
+        statement = statement.on_conflict_do_update(
+            index_elements=[VehiclePosition.trip_id],
+            set_={
+                column: getattr(statement.excluded, column)
+                for column in (
+                    'latitude', 'longitude', 'bearing', 'speed', 'current_stop_sequence',
+                    'current_stop_id', 'current_status', 'timestamp', 'updated_at'
+                )
+            }
+        )
+        await self.db.execute(statement, list(rows.values()))
+
+    async def _store_trip(self, trip_data: Dict, entity_id: str) -> Trip:
         """
         Store trip and its stop time updates
         """
         # Check if trip exists
-        trip = self.db.query(Trip).filter(Trip.trip_id == trip_data['trip_id']).first()
+        trip_id, start_date = trip_key(trip_data)
+        result = await self.db.execute(select(Trip).where(Trip.trip_id == trip_id, Trip.start_date == start_date))
+        trip = result.scalars().first()
         
         if not trip:
             trip = Trip(
-                trip_id=trip_data['trip_id'],
+                trip_id=trip_id,
                 route_id=trip_data['route_id'],
                 start_time=trip_data['start_time'],
-                start_date=trip_data['start_date'],
+                start_date=start_date,
                 schedule_relationship=TripScheduleRelationship(trip_data.get('schedule_relationship', 0))
             )
             self.db.add(trip)
-            self.db.flush()  # Get ID without committing
+            await self.db.flush()  # Get ID without committing
         
         # Update stop times
         if 'stop_time_updates' in trip_data:
             # Remove old updates
-            self.db.query(StopTimeUpdate).filter(StopTimeUpdate.trip_id == trip.id).delete()
+            await self.db.execute(delete(StopTimeUpdate).where(StopTimeUpdate.trip_id == trip.id))
             
             # Add new updates
             for update in trip_data['stop_time_updates']:
@@ -79,22 +490,25 @@ class DBService:
         
         return trip
 
-    def _store_vehicle_position(self, vehicle_data: Dict, entity_id: str) -> VehiclePosition:
+    async def _store_vehicle_position(self, vehicle_data: Dict, entity_id: str) -> Optional[VehiclePosition]:
         """
         Store vehicle position
         """
         # Get associated trip
         trip = None
         if 'trip' in vehicle_data:
-            trip = self.db.query(Trip).filter(Trip.trip_id == vehicle_data['trip']['trip_id']).first()
+            trip_id, start_date = trip_key(vehicle_data['trip'])
+            result = await self.db.execute(select(Trip).where(Trip.trip_id == trip_id, Trip.start_date == start_date))
+            trip = result.scalars().first()
             if not trip:
-                trip = self._store_trip(vehicle_data['trip'], entity_id)
+                trip = await self._store_trip(vehicle_data['trip'], entity_id)
         
         if not trip:
             return None
         
         # Update or create vehicle position
-        vehicle = self.db.query(VehiclePosition).filter(VehiclePosition.trip_id == trip.id).first()
+        result = await self.db.execute(select(VehiclePosition).where(VehiclePosition.trip_id == trip.id))
+        vehicle = result.scalars().first()
         
         if not vehicle:
             vehicle = VehiclePosition(trip_id=trip.id)
@@ -114,43 +528,86 @@ class DBService:
         self.db.add(vehicle)
         return vehicle
 
-    def _store_alert(self, alert_data: Dict, entity_id: str) -> Alert:
+    async def get_active_trips(self) -> List[Trip]:
         """
-        Store service alert
+        Get all active trips with their latest updates
         """
-        alert = Alert(
-            effect=AlertEffect(alert_data['effect']),
-            header_text=alert_data.get('header_text'),
-            description_text=alert_data.get('description_text'),
-            informed_entities=alert_data.get('informed_entity', [])
-        )
-        self.db.add(alert)
-        return alert
+        # Arrival times are stored in local time (datetime.fromtimestamp)
+        upcoming = select(StopTimeUpdate.trip_id).where(StopTimeUpdate.arrival_time >= datetime.now())
+        result = await self.db.execute(select(Trip).where(Trip.id.in_(upcoming)))
+        return result.scalars().all()
 
-    def get_active_trips(self) -> List[Trip]:
+    async def get_active_alerts(self) -> List[Alert]:
         """
-        Get all active trips with their latest updates
+        Get all active service alerts
         """
-        return self.db.query(Trip)\
-            .join(StopTimeUpdate)\
-            .filter(StopTimeUpdate.arrival_time >= datetime.utcnow())\
-            .distinct()\
-            .all()
+        result = await self.db.execute(
+            select(Alert)
+            .where(Alert.active == True)
+            .order_by(Alert.created_at.desc())
+        )
+        return result.scalars().all()
 
-    def get_active_alerts(self) -> List[Alert]:
+    async def get_alerts_for(self, route_id: Optional[str] = None, stop_id: Optional[str] = None) -> List[Alert]:
         """
-        Get all active service alerts
+        Active alerts informing a route or a stop, looked up through the
+        informed entity index
+        Args:
+            route_id: GTFS route id
+            stop_id: GTFS stop id; parent and directional ids match each other
         """
-        return self.db.query(Alert)\
-            .filter(Alert.active == True)\
-            .order_by(Alert.created_at.desc())\
-            .all()
+        conditions = []
+        if route_id:
+            conditions.append(AlertInformedEntity.route_id == route_id)
+        if stop_id:
+            if stop_id[-1:] in ('N', 'S'):
+                stop_ids = [stop_id, stop_id[:-1]]
+            else:
+                stop_ids = [stop_id, f"{stop_id}N", f"{stop_id}S"]
+            conditions.append(AlertInformedEntity.stop_id.in_(stop_ids))
+        if not conditions:
+            return await self.get_active_alerts()
 
-    def get_vehicle_positions(self) -> List[VehiclePosition]:
+        informed = select(AlertInformedEntity.alert_id).where(or_(*conditions))
+        result = await self.db.execute(
+            select(Alert)
+            .where(and_(Alert.active == True, Alert.id.in_(informed)))
+            .order_by(Alert.created_at.desc())
+        )
+        return result.scalars().all()
+
+    async def get_vehicle_positions(self) -> List[VehiclePosition]:
         """
         Get all current vehicle positions
         """
         cutoff_time = datetime.utcnow() - timedelta(minutes=5)  # Last 5 minutes
-        return self.db.query(VehiclePosition)\
-            .filter(VehiclePosition.timestamp >= cutoff_time)\
-            .all() 
\ No newline at end of file
+        result = await self.db.execute(
+            select(VehiclePosition)
+            .where(VehiclePosition.timestamp >= cutoff_time)
+        )
+        return result.scalars().all() 
+
+
+# Last feed version successfully written by store_snapshot, per feed
+_stored_versions: Dict[str, DecodedFeed] = {}
+
+
+async def store_snapshot(snapshot, previous=None) -> FeedUpdate:
+    """
+    Feed poller listener persisting each new feed version in one
+    transaction. The first version seen by this process is stored in full;
+    later ones only write what changed since the last version stored, so a
+    failed write is folded into the next diff.
+    """
+    stored = _stored_versions.get(snapshot.feed_id)
+    async with AsyncSessionLocal() as session:
+        service = DBService(session)
+        with DB_INGEST_SECONDS.labels(snapshot.feed_id, 'bulk' if stored is None else 'changes').time():
+            if stored is None:
+                feed_update = await service.bulk_store_feed_data(snapshot.data, snapshot.feed_id)
+            elif previous is not None and previous.decoded is stored:
+                feed_update = await service.apply_feed_changes(snapshot.changes(previous), snapshot.feed_id)
+            else:
+                feed_update = await service.apply_feed_changes(diff_feeds(stored, snapshot.decoded), snapshot.feed_id)
+    _stored_versions[snapshot.feed_id] = snapshot.decoded
+    return feed_update
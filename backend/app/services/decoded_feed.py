@@ -0,0 +1,443 @@
+import sys
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Bits in StopTimeColumns.flags recording which optional fields were present
+HAS_ARRIVAL = 1
+HAS_ARRIVAL_DELAY = 2
+HAS_DEPARTURE = 4
+HAS_DEPARTURE_DELAY = 8
+HAS_SCHEDULE_RELATIONSHIP = 16
+
+
+# Typed array columns of StopTimeColumns
+ARRAY_COLUMNS = (
+    'trip_offsets', 'trip_index', 'stop_code', 'arrival_time', 'arrival_delay',
+    'departure_time', 'departure_delay', 'schedule_relationship', 'flags'
+)
+
+
+class StopTimeColumns:
+    """
+    Columnar store of every stop time update in a feed. Row i describes one
+    stop of trip `trip_index[i]`; stop ids are interned per feed and stored
+    as codes into `stop_ids`. Rows added with add_trip are buffered and
+    only land in the value columns once finish() is called.
+    """
+
+    __slots__ = (
+        'stop_ids', '_stop_codes', '_rows', 'trip_offsets', 'trip_index', 'stop_code',
+        'arrival_time', 'arrival_delay', 'departure_time', 'departure_delay',
+        'schedule_relationship', 'flags'
+    )
+
+    def __init__(self):
+        self.stop_ids: List[str] = []
+        self._stop_codes: Dict[str, int] = {}
+        self._rows: List[Tuple] = []
+        self.trip_offsets = array('I', [0])
+        self.trip_index = array('I')
+        self.stop_code = array('I')
+        self.arrival_time = array('q')
+        self.arrival_delay = array('i')
+        self.departure_time = array('q')
+        self.departure_delay = array('i')
+        self.schedule_relationship = array('B')
+        self.flags = array('B')
+
+    def __len__(self) -> int:
+        return len(self.trip_index) + len(self._rows)
+
+    def __getstate__(self):
+        self.finish()
+        return {name: getattr(self, name) for name in self.__slots__ if name not in ('_stop_codes', '_rows')}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._stop_codes = {stop_id: code for code, stop_id in enumerate(self.stop_ids)}
+        self._rows = []
+
+    def to_primitive(self) -> Dict:
+        """
+        Columns as raw array bytes plus the stop id table, for serializers
+        limited to plain types such as msgpack
+        """
+        self.finish()
+        state = {name: getattr(self, name).tobytes() for name in ARRAY_COLUMNS}
+        state['stop_ids'] = self.stop_ids
+        state['byteorder'] = sys.byteorder
+        return state
+
+    @classmethod
+    def from_primitive(cls, state: Dict) -> 'StopTimeColumns':
+        """
+        Rebuild columns from the output of to_primitive
+        """
+        columns = cls()
+        for name in ARRAY_COLUMNS:
+            column = array(getattr(columns, name).typecode)
+            column.frombytes(state[name])
+            if state['byteorder'] != sys.byteorder:
+                column.byteswap()
+            setattr(columns, name, column)
+        for stop_id in state['stop_ids']:
+            columns.intern_stop(stop_id)
+
+        rows = len(columns.trip_index)
+        if any(len(getattr(columns, name)) != rows for name in ARRAY_COLUMNS[2:]):
+            raise ValueError("Stop time columns differ in length")
+        if rows and max(columns.stop_code) >= len(columns.stop_ids):
+            raise ValueError("Stop code outside the stop id table")
+        return columns
+
+    def intern_stop(self, stop_id: str) -> int:
+        """
+        Code for a stop id, allocating one on first use
+        """
+        code = self._stop_codes.get(stop_id)
+        if code is None:
+            code = self._stop_codes[stop_id] = len(self.stop_ids)
+            self.stop_ids.append(sys.intern(stop_id))
+        return code
+
+    def add_trip(self, stop_time_updates: Iterable) -> int:
+        """
+        Append the stop time updates of the next trip
+        Args:
+            stop_time_updates: Repeated GTFS-RT TripUpdate.StopTimeUpdate
+        Returns:
+            Index of the trip the rows were added for
+        """
+        trip = len(self.trip_offsets) - 1
+        rows = self._rows
+        start = len(rows)
+        # One tuple per row, transposed into the columns by finish(): far
+        # cheaper than appending to eight typed arrays per row
+        append = rows.append
+        stop_codes = self._stop_codes
+        try:
+            for update in stop_time_updates:
+                flags = 0
+                arrival_delay = departure_delay = relationship = 0
+
+                # A present arrival or departure carries a non-zero time, so
+                # HasField is only needed to tell an absent event from one
+                # at time 0; it costs as much as reading the event itself
+                arrival = update.arrival
+                arrival_time = arrival.time
+                if arrival_time or update.HasField('arrival'):
+                    flags = HAS_ARRIVAL
+                    if arrival.HasField('delay'):
+                        flags |= HAS_ARRIVAL_DELAY
+                        arrival_delay = arrival.delay
+
+                departure = update.departure
+                departure_time = departure.time
+                if departure_time or update.HasField('departure'):
+                    flags |= HAS_DEPARTURE
+                    if departure.HasField('delay'):
+                        flags |= HAS_DEPARTURE_DELAY
+                        departure_delay = departure.delay
+
+                if update.HasField('schedule_relationship'):
+                    flags |= HAS_SCHEDULE_RELATIONSHIP
+                    relationship = update.schedule_relationship
+
+                stop_id = update.stop_id
+                code = stop_codes.get(stop_id)
+                if code is None:
+                    code = self.intern_stop(stop_id)
+                append((trip, code, arrival_time, arrival_delay, departure_time, departure_delay, relationship, flags))
+        except Exception:
+            del rows[start:]
+            raise
+
+        self.trip_offsets.append(len(self))
+        return trip
+
+    def finish(self) -> 'StopTimeColumns':
+        """
+        Move the rows buffered by add_trip into the value columns
+        """
+        rows, self._rows = self._rows, []
+        if rows:
+            columns = (
+                self.trip_index, self.stop_code, self.arrival_time, self.arrival_delay,
+                self.departure_time, self.departure_delay, self.schedule_relationship, self.flags
+            )
+            for column, values in zip(columns, zip(*rows)):
+                column.extend(array(column.typecode, values))
+        return self
+
+    def row_dicts(self) -> List[Dict]:
+        """
+        JSON view of every stop time update, in row order
+        """
+        stop_ids = self.stop_ids
+        arrival_and_departure = HAS_ARRIVAL | HAS_DEPARTURE
+        rows = []
+        append = rows.append
+        columns = zip(self.stop_code, self.flags, self.arrival_time, self.departure_time)
+        for row, (code, flags, arrival_time, departure_time) in enumerate(columns):
+            if flags == arrival_and_departure:
+                # The usual shape of an MTA stop time update, built in one go
+                append({
+                    'stop_id': stop_ids[code],
+                    'arrival': {'time': arrival_time},
+                    'departure': {'time': departure_time}
+                })
+            else:
+                append(self.row_dict(row))
+        return rows
+
+    def row_dict(self, row: int) -> Dict:
+        """
+        JSON view of a single stop time update
+        """
+        flags = self.flags[row]
+        stop_update = {'stop_id': self.stop_ids[self.stop_code[row]]}
+        if flags & HAS_ARRIVAL:
+            stop_update['arrival'] = {'time': self.arrival_time[row]}
+            if flags & HAS_ARRIVAL_DELAY:
+                stop_update['arrival']['delay'] = self.arrival_delay[row]
+        if flags & HAS_DEPARTURE:
+            stop_update['departure'] = {'time': self.departure_time[row]}
+            if flags & HAS_DEPARTURE_DELAY:
+                stop_update['departure']['delay'] = self.departure_delay[row]
+        if flags & HAS_SCHEDULE_RELATIONSHIP:
+            stop_update['schedule_relationship'] = self.schedule_relationship[row]
+        return stop_update
+
+    def trip_rows(self, trip: int) -> range:
+        """
+        Row numbers belonging to a trip
+        """
+        return range(self.trip_offsets[trip], self.trip_offsets[trip + 1])
+
+    def event_time(self, row: int) -> int:
+        """
+        Arrival time of a row, falling back to its departure time
+        """
+        return self.arrival_time[row] if self.flags[row] & HAS_ARRIVAL else self.departure_time[row]
+
+
+class Record:
+    """
+    Base of the slotted records decoded feed entities are kept as. Records
+    compare equal when every field but the entity id matches, since MTA
+    entity ids are positional and change between feed versions.
+    """
+
+    __slots__ = ('entity_id',)
+    _fields: Tuple[str, ...] = ()
+
+    def __init__(self, entity_id: str, *values):
+        self.entity_id = entity_id
+        for name, value in zip(self._fields, values):
+            setattr(self, name, value)
+
+    def __eq__(self, other) -> bool:
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self._fields)
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return self.astuple()
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def astuple(self) -> Tuple:
+        """
+        Entity id followed by the field values, the arguments of __init__
+        """
+        return (self.entity_id, *(getattr(self, name) for name in self._fields))
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self._fields)
+        return f"{type(self).__name__}({self.entity_id!r}, {fields})"
+
+
+class TripRecord(Record):
+    """
+    Trip descriptor of a trip update entity
+    """
+
+    __slots__ = _fields = ('trip_id', 'route_id', 'start_time', 'start_date', 'schedule_relationship')
+
+    def to_dict(self) -> Dict:
+        trip = {
+            'id': self.entity_id,
+            'trip_id': self.trip_id,
+            'route_id': self.route_id,
+            'start_time': self.start_time,
+            'start_date': self.start_date
+        }
+        if self.schedule_relationship is not None:
+            trip['schedule_relationship'] = self.schedule_relationship
+        return trip
+
+
+class VehicleRecord(Record):
+    """
+    Vehicle position entity. Trip fields are None when the vehicle has no
+    trip descriptor, position fields when it reported no position; other
+    optional fields are None when absent.
+    """
+
+    __slots__ = _fields = (
+        'trip_id', 'route_id', 'start_time', 'start_date',
+        'latitude', 'longitude', 'bearing', 'speed',
+        'current_stop_sequence', 'stop_id', 'current_status', 'timestamp'
+    )
+
+    def to_dict(self) -> Dict:
+        vehicle = {'id': self.entity_id}
+        if self.trip_id is not None:
+            vehicle['trip'] = {
+                'trip_id': self.trip_id,
+                'route_id': self.route_id,
+                'start_time': self.start_time,
+                'start_date': self.start_date
+            }
+        if self.latitude is not None:
+            vehicle['position'] = {
+                'latitude': self.latitude,
+                'longitude': self.longitude,
+                'bearing': self.bearing,
+                'speed': self.speed
+            }
+        for name in ('current_stop_sequence', 'stop_id', 'current_status', 'timestamp'):
+            value = getattr(self, name)
+            if value is not None:
+                vehicle[name] = value
+        return vehicle
+
+
+class AlertRecord(Record):
+    """
+    Service alert entity
+    """
+
+    __slots__ = _fields = ('effect', 'header_text', 'description_text', 'informed_entity')
+
+    def to_dict(self) -> Dict:
+        alert = {'id': self.entity_id, 'effect': self.effect}
+        if self.header_text is not None:
+            alert['header_text'] = self.header_text
+        if self.description_text is not None:
+            alert['description_text'] = self.description_text
+        if self.informed_entity is not None:
+            alert['informed_entity'] = list(self.informed_entity)
+        return alert
+
+
+class DecodedFeed:
+    """
+    Decoded GTFS-RT feed. Entities are kept as slotted records with
+    interned ids and trip updates keep their stop time updates in
+    StopTimeColumns; the nested JSON form is only built on demand.
+    `timings` holds the seconds spent in each decode stage.
+    """
+
+    __slots__ = ('header', 'vehicle_positions', 'alerts', 'trips', 'stop_times', 'timings', '_dict')
+
+    def __init__(
+        self,
+        header: Dict,
+        vehicle_positions: List[VehicleRecord],
+        alerts: List[AlertRecord],
+        trips: List[TripRecord],
+        stop_times: StopTimeColumns,
+        timings: Optional[Dict[str, float]] = None
+    ):
+        self.header = header
+        self.vehicle_positions = vehicle_positions
+        self.alerts = alerts
+        self.trips = trips
+        self.stop_times = stop_times
+        self.timings = timings or {}
+        self._dict = None
+
+    def __getstate__(self):
+        return (self.header, self.vehicle_positions, self.alerts, self.trips, self.stop_times, self.timings)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def trip_updates(self) -> List[Dict]:
+        """
+        Trip updates with nested stop time update dicts
+        """
+        offsets = self.stop_times.trip_offsets
+        rows = self.stop_times.row_dicts()
+        trip_updates = []
+        for i, trip in enumerate(self.trips):
+            trip_update = trip.to_dict()
+            trip_update['stop_time_updates'] = rows[offsets[i]:offsets[i + 1]]
+            trip_updates.append(trip_update)
+        return trip_updates
+
+    def to_dict(self) -> Dict:
+        """
+        JSON view in the format of MTAService._process_feed_data, built once
+        """
+        if self._dict is None:
+            self._dict = {
+                'header': self.header,
+                'vehicle_positions': [vehicle.to_dict() for vehicle in self.vehicle_positions],
+                'alerts': [alert.to_dict() for alert in self.alerts],
+                'trip_updates': self.trip_updates()
+            }
+        return self._dict
+
+    def to_primitive(self) -> Dict:
+        """
+        The feed as plain dicts, lists, numbers, strings and bytes, for
+        serializers that cannot carry arbitrary objects such as msgpack
+        """
+        return {
+            'header': self.header,
+            'vehicle_positions': [vehicle.astuple() for vehicle in self.vehicle_positions],
+            'alerts': [alert.astuple() for alert in self.alerts],
+            'trips': [trip.astuple() for trip in self.trips],
+            'stop_times': self.stop_times.to_primitive(),
+            'timings': self.timings
+        }
+
+    @classmethod
+    def from_primitive(cls, state: Dict) -> 'DecodedFeed':
+        """
+        Rebuild a feed from the output of to_primitive. Ids are interned
+        again, as the decoder does.
+        """
+        def record(record_cls, values, intern=True):
+            if len(values) != len(record_cls._fields) + 1:
+                raise ValueError(f"Expected {len(record_cls._fields) + 1} values for {record_cls.__name__}")
+            if intern:
+                values = [sys.intern(value) if type(value) is str else value for value in values]
+            return record_cls(*values)
+
+        alerts = []
+        for values in state['alerts']:
+            alert = record(AlertRecord, values, intern=False)
+            if alert.informed_entity is not None:
+                alert.informed_entity = tuple(alert.informed_entity)
+            alerts.append(alert)
+
+        trips = [record(TripRecord, values) for values in state['trips']]
+        stop_times = StopTimeColumns.from_primitive(state['stop_times'])
+        offsets = stop_times.trip_offsets
+        if len(offsets) != len(trips) + 1 or offsets[0] != 0 or offsets[-1] != len(stop_times):
+            raise ValueError("Stop time columns do not match the trips")
+        return cls(
+            state['header'],
+            [record(VehicleRecord, values) for values in state['vehicle_positions']],
+            alerts,
+            trips,
+            stop_times,
+            state['timings']
+        )
@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import os
+import time
+import zlib
+from typing import Dict, FrozenSet, Iterable, List, Optional, Sequence, Set, Tuple
+
+from .arrivals_index import ArrivalsIndex, arrivals_index
+from .feed_poller import FeedSnapshot
+
+logger = logging.getLogger(__name__)
+
+# Boards as "name=stop_id,stop_id;name=stop_id", e.g. "lobby=127N,127S;home=R16"
+DISPLAY_BOARDS = os.getenv("DISPLAY_BOARDS", "")
+# Rows rendered per board
+DISPLAY_BOARD_ROWS = int(os.getenv("DISPLAY_BOARD_ROWS", "4"))
+# Longest a long-poll request waits for its board to change
+DISPLAY_LONG_POLL_TIMEOUT = float(os.getenv("DISPLAY_LONG_POLL_TIMEOUT", "30"))
+# Seconds between re-renders of every board, so minutes count down (and
+# passed trains drop off) between feed updates and during outages. Each
+# arrival's minute changes at its own second, so this bounds how late a
+# row shows it.
+DISPLAY_REFRESH_INTERVAL = float(os.getenv("DISPLAY_REFRESH_INTERVAL", "10"))
+
+# Fixed row layout: route (3, left aligned), direction (1), minutes away
+# (3, right aligned) and a newline
+ROW_WIDTH = 8
+MAX_MINUTES = 999
+
+
+def parse_boards(config: str) -> Dict[str, Tuple[str, ...]]:
+    """
+    Board name to stop ids from a DISPLAY_BOARDS style string
+    """
+    boards = {}
+    for entry in config.split(";"):
+        name, _, stops = entry.partition("=")
+        stop_ids = tuple(stop_id.strip() for stop_id in stops.split(",") if stop_id.strip())
+        if name.strip() and stop_ids:
+            boards[name.strip()] = stop_ids
+    return boards
+
+
+def render_row(route_id: str, direction: Optional[str], minutes: int) -> bytes:
+    """
+    One fixed-width board row
+    """
+    return f"{route_id[:3]:<3}{direction or ' '}{min(max(minutes, 0), MAX_MINUTES):>3}\n".encode('ascii', 'replace')
+
+
+def render_rows(arrivals: Sequence[Dict], now: int, rows: int) -> bytes:
+    """
+    Board body for arrivals sorted soonest first, padded to `rows` rows
+    """
+    body = b"".join(
+        render_row(arrival['route_id'], arrival['direction'], (arrival['time'] - now) // 60)
+        for arrival in arrivals[:rows]
+    )
+    return body + (b" " * (ROW_WIDTH - 1) + b"\n") * (rows - min(len(arrivals), rows))
+
+
+class Board:
+    """
+    Pre-rendered rows of one display board and the requests waiting for
+    them to change
+    """
+
+    __slots__ = ('name', 'stop_ids', 'child_stop_ids', 'rows', 'body', 'etag', 'updated_at', '_waiters')
+
+    def __init__(self, name: str, stop_ids: Tuple[str, ...], rows: int = DISPLAY_BOARD_ROWS):
+        self.name = name
+        self.stop_ids = stop_ids
+        # Directional stop ids as they appear in the feeds
+        self.child_stop_ids: FrozenSet[str] = frozenset(
+            child_id
+            for stop_id in stop_ids
+            for child_id in ([stop_id] if stop_id[-1:] in ('N', 'S') else [f"{stop_id}N", f"{stop_id}S"])
+        )
+        self.rows = rows
+        self.updated_at: Optional[float] = None
+        self._waiters: List[asyncio.Future] = []
+        self.set_body(render_rows((), 0, rows))
+
+    def set_body(self, body: bytes) -> bool:
+        """
+        Replace the rendered rows, waking waiting requests if they changed
+        """
+        if self.updated_at is not None and body == self.body:
+            return False
+        self.body = body
+        self.etag = f'"{self.name}-{zlib.crc32(body):08x}"'
+        self.updated_at = time.time()
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        return True
+
+    async def wait_for_change(self, etag: str, timeout: float) -> bool:
+        """
+        Wait until the board no longer renders as `etag`
+        Args:
+            etag: Entity tag the client already has
+            timeout: Seconds to wait at most
+        Returns:
+            Whether the board changed before the timeout
+        """
+        if etag != self.etag:
+            return True
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+
+class DisplayBoards:
+    """
+    Configured display boards, re-rendered from the arrivals index when a
+    feed serving their stops updates and on a short timer, so board
+    requests only ever return cached bytes
+    """
+
+    def __init__(
+        self,
+        index: ArrivalsIndex,
+        boards: Optional[Dict[str, Tuple[str, ...]]] = None,
+        rows: int = DISPLAY_BOARD_ROWS,
+        refresh_interval: float = DISPLAY_REFRESH_INTERVAL
+    ):
+        self.index = index
+        self.refresh_interval = refresh_interval
+        self.boards: Dict[str, Board] = {
+            name: Board(name, stop_ids, rows)
+            for name, stop_ids in (parse_boards(DISPLAY_BOARDS) if boards is None else boards).items()
+        }
+        self._task: Optional[asyncio.Task] = None
+
+    def get(self, name: str) -> Optional[Board]:
+        return self.boards.get(name)
+
+    async def start(self):
+        """
+        Start re-rendering the boards on the refresh interval
+        """
+        if self._task is None and self.boards:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """
+        Cancel the refresh loop
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                self.refresh(self.boards.values())
+            except Exception as e:
+                logger.error(f"Error refreshing display boards: {str(e)}")
+
+    def render(self, board: Board, now: Optional[int] = None) -> bytes:
+        """
+        Current rows of a board from the arrivals index
+        """
+        if now is None:
+            now = int(time.time())
+        arrivals = sorted(
+            (arrival for stop_id in board.stop_ids for arrival in self.index.next_arrivals(stop_id, board.rows, now)),
+            key=lambda arrival: arrival['time']
+        )
+        return render_rows(arrivals, now, board.rows)
+
+    def refresh(self, boards: Iterable[Board], now: Optional[int] = None):
+        """
+        Re-render boards, waking the requests waiting on those that changed
+        """
+        if now is None:
+            now = int(time.time())
+        for board in boards:
+            if board.set_body(self.render(board, now)):
+                logger.debug(f"Display board {board.name} changed")
+
+    def update(self, snapshot: FeedSnapshot, previous: Optional[FeedSnapshot] = None):
+        """
+        Feed poller listener re-rendering the boards showing stops of the
+        updated feed; must run after the arrivals index has taken the
+        snapshot
+        """
+        stop_ids: Set[str] = set(snapshot.decoded.stop_times.stop_ids)
+        if previous is not None:
+            stop_ids.update(previous.decoded.stop_times.stop_ids)
+        self.refresh(board for board in self.boards.values() if not board.child_stop_ids.isdisjoint(stop_ids))
+
+
+display_boards = DisplayBoards(arrivals_index)
+
+
+def get_display_boards() -> DisplayBoards:
+    """
+    Get the application-wide display boards
+    """
+    return display_boards
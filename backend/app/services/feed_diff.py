@@ -0,0 +1,331 @@
+import hashlib
+import json
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from .decoded_feed import AlertRecord, DecodedFeed, Record, StopTimeColumns, VehicleRecord
+from .mta_service import MTAService
+
+# (trip_id, stop_id) identifying one stop time update across feed versions
+StopTimeKey = Tuple[str, str]
+
+
+def alert_content_hash(alert: Dict) -> str:
+    """
+    Digest of an alert's content, including its informed entities. MTA
+    entity ids are positional, so this is what identifies an alert across
+    feed versions.
+    """
+    content = [alert['effect'], alert.get('header_text'), alert.get('description_text'), alert.get('informed_entity', [])]
+    return hashlib.sha1(json.dumps(content, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def vehicle_key(vehicle: VehicleRecord) -> str:
+    """
+    Vehicles are identified by their trip, falling back to the entity id
+    """
+    return vehicle.trip_id or vehicle.entity_id
+
+
+class EntityChanges:
+    """
+    Inserted, updated and deleted entities of one kind. Inserted and
+    updated entries hold the entity's new JSON form, deleted entries only
+    its key.
+    """
+
+    __slots__ = ('inserted', 'updated', 'deleted')
+
+    def __init__(self, inserted: List = None, updated: List = None, deleted: List = None):
+        self.inserted = inserted or []
+        self.updated = updated or []
+        self.deleted = deleted or []
+
+    def __len__(self) -> int:
+        return len(self.inserted) + len(self.updated) + len(self.deleted)
+
+    def changed(self) -> List:
+        """
+        Inserted and updated entities
+        """
+        return self.inserted + self.updated
+
+    def filter(self, keep, keep_key) -> 'EntityChanges':
+        """
+        Subset of the changes accepted by `keep` (entities) and `keep_key`
+        (deleted keys)
+        """
+        return EntityChanges(
+            [entity for entity in self.inserted if keep(entity)],
+            [entity for entity in self.updated if keep(entity)],
+            [key for key in self.deleted if keep_key(key)]
+        )
+
+    def to_dict(self) -> Dict:
+        return {'inserted': self.inserted, 'updated': self.updated, 'deleted': self.deleted}
+
+
+class ChangeSet:
+    """
+    Changes between two consecutive versions of a feed.
+
+    `trips` holds trip descriptors without their stop time updates, keyed
+    by trip_id. `stop_time_updates` entries are stop time update dicts with
+    their `trip_id`, keyed by (trip_id, stop_id); deleted keys include the
+    stops of deleted trips. A trip listed again with a new start date is
+    updated and all its stops inserted. Vehicles are keyed by trip_id (see
+    vehicle_key). Entity ids are positional in MTA feeds, so trips and
+    vehicles are not reported as updated when only their `id` moved, and
+    alerts are keyed by their content hash (see alert_content_hash): an
+    edited alert is deleted and inserted again, and inserted alerts carry
+    their `content_hash`. When a version repeats a key (a trip listed
+    twice, a loop visiting a stop twice) its last entry wins; the number
+    of entries dropped that way is counted in `counts['duplicates']`.
+    `trip_routes` and `trip_dates` give the route and start date of every
+    trip seen in either version, `alert_routes` the informed routes of
+    every alert.
+    """
+
+    __slots__ = (
+        'header', 'counts', 'trip_routes', 'trip_dates', 'alert_routes',
+        'trips', 'stop_time_updates', 'vehicle_positions', 'alerts'
+    )
+
+    def __init__(
+        self,
+        header: Dict,
+        counts: Dict[str, int],
+        trip_routes: Dict[str, str],
+        trip_dates: Dict[str, str],
+        alert_routes: Dict[str, FrozenSet[str]],
+        trips: EntityChanges,
+        stop_time_updates: EntityChanges,
+        vehicle_positions: EntityChanges,
+        alerts: EntityChanges
+    ):
+        self.header = header
+        self.counts = counts
+        self.trip_routes = trip_routes
+        self.trip_dates = trip_dates
+        self.alert_routes = alert_routes
+        self.trips = trips
+        self.stop_time_updates = stop_time_updates
+        self.vehicle_positions = vehicle_positions
+        self.alerts = alerts
+
+    def __len__(self) -> int:
+        return len(self.trips) + len(self.stop_time_updates) + len(self.vehicle_positions) + len(self.alerts)
+
+    def filter_routes(self, routes: Optional[FrozenSet[str]]) -> 'ChangeSet':
+        """
+        Changes restricted to a set of routes
+        Args:
+            routes: Route ids to keep, or None to keep everything
+        """
+        if routes is None:
+            return self
+
+        def trip_kept(trip_id: str) -> bool:
+            return self.trip_routes.get(trip_id) in routes
+
+        def vehicle_kept(vehicle: Dict) -> bool:
+            return vehicle.get('trip', {}).get('route_id') in routes
+
+        def alert_kept(key: str) -> bool:
+            # Alerts without route information apply to the whole feed
+            alert_routes = self.alert_routes.get(key)
+            return not alert_routes or not alert_routes.isdisjoint(routes)
+
+        return ChangeSet(
+            self.header,
+            self.counts,
+            self.trip_routes,
+            self.trip_dates,
+            self.alert_routes,
+            self.trips.filter(lambda trip: trip['route_id'] in routes, trip_kept),
+            self.stop_time_updates.filter(lambda update: trip_kept(update['trip_id']), lambda key: trip_kept(key[0])),
+            self.vehicle_positions.filter(vehicle_kept, trip_kept),
+            self.alerts.filter(lambda alert: alert_kept(alert['content_hash']), alert_kept)
+        )
+
+    def to_dict(self) -> Dict:
+        """
+        JSON view of the change set
+        """
+        stop_time_updates = self.stop_time_updates.to_dict()
+        stop_time_updates['deleted'] = [
+            {'trip_id': trip_id, 'stop_id': stop_id} for trip_id, stop_id in self.stop_time_updates.deleted
+        ]
+        return {
+            'header': self.header,
+            'trips': self.trips.to_dict(),
+            'stop_time_updates': stop_time_updates,
+            'vehicle_positions': self.vehicle_positions.to_dict(),
+            'alerts': self.alerts.to_dict()
+        }
+
+
+def _diff_keyed(old: Dict[str, Record], new: Dict[str, Record]) -> EntityChanges:
+    """
+    Compare two key -> record maps. Records compare without their entity
+    id; only changed ones are turned into dicts.
+    """
+    changes = EntityChanges()
+    for key, entity in new.items():
+        previous = old.get(key)
+        if previous is None:
+            changes.inserted.append(entity.to_dict())
+        elif previous != entity:
+            changes.updated.append(entity.to_dict())
+    changes.deleted = [key for key in old if key not in new]
+    return changes
+
+
+def _stop_time_rows(decoded: DecodedFeed) -> Dict[StopTimeKey, int]:
+    """
+    Row of every stop time update in a feed by (trip_id, stop_id)
+    """
+    stop_times = decoded.stop_times
+    stop_ids = stop_times.stop_ids
+    stop_code = stop_times.stop_code
+    return {
+        (trip.trip_id, stop_ids[stop_code[row]]): row
+        for i, trip in enumerate(decoded.trips)
+        for row in stop_times.trip_rows(i)
+    }
+
+
+def _row_values(stop_times: StopTimeColumns, row: int) -> Tuple:
+    """
+    Comparable values of one stop time update
+    """
+    return (
+        stop_times.flags[row],
+        stop_times.arrival_time[row],
+        stop_times.arrival_delay[row],
+        stop_times.departure_time[row],
+        stop_times.departure_delay[row],
+        stop_times.schedule_relationship[row]
+    )
+
+
+def _stop_time_update(stop_times: StopTimeColumns, trip_id: str, row: int) -> Dict:
+    """
+    JSON view of a stop time update tagged with its trip
+    """
+    update = stop_times.row_dict(row)
+    update['trip_id'] = trip_id
+    return update
+
+
+def _diff_stop_times(
+    old: Optional[DecodedFeed],
+    new: DecodedFeed,
+    old_rows: Dict[StopTimeKey, int],
+    new_rows: Dict[StopTimeKey, int],
+    restarted: FrozenSet[str] = frozenset()
+) -> EntityChanges:
+    """
+    Compare stop time updates column-wise, only building dicts for the
+    rows that changed. Every stop of a restarted trip (same trip id, new
+    service day) is inserted.
+    """
+    new_stop_times = new.stop_times
+    if old is None:
+        return EntityChanges([_stop_time_update(new_stop_times, key[0], row) for key, row in new_rows.items()])
+
+    old_stop_times = old.stop_times
+    changes = EntityChanges()
+    for key, row in new_rows.items():
+        old_row = old_rows.get(key)
+        if old_row is None or key[0] in restarted:
+            changes.inserted.append(_stop_time_update(new_stop_times, key[0], row))
+        elif _row_values(old_stop_times, old_row) != _row_values(new_stop_times, row):
+            changes.updated.append(_stop_time_update(new_stop_times, key[0], row))
+    changes.deleted = [key for key in old_rows if key not in new_rows]
+    return changes
+
+
+def _alerts_by_content(alerts: Iterable[AlertRecord]) -> Dict[str, Dict]:
+    """
+    JSON form of alerts by content hash, tagged with it
+    """
+    keyed = {}
+    for alert in alerts:
+        alert = alert.to_dict()
+        alert['content_hash'] = alert_content_hash(alert)
+        keyed[alert['content_hash']] = alert
+    return keyed
+
+
+def _diff_alerts(old: Dict[str, Dict], new: Dict[str, Dict]) -> EntityChanges:
+    """
+    Compare alerts by content; edited alerts show up as a deletion and an
+    insertion, never as updates
+    """
+    return EntityChanges(
+        [alert for key, alert in new.items() if key not in old],
+        [],
+        [key for key in old if key not in new]
+    )
+
+
+def _by_key(entities: Iterable[Record], key) -> Dict[str, Record]:
+    return {key(entity): entity for entity in entities}
+
+
+def diff_feeds(old: Optional[DecodedFeed], new: DecodedFeed) -> ChangeSet:
+    """
+    Changes from one decoded version of a feed to the next
+    Args:
+        old: Previous version, or None to treat every entity as inserted
+        new: Current version
+    """
+    empty: List[Record] = []
+    trip_key = lambda trip: trip.trip_id
+    old_trips = _by_key(old.trips if old else empty, trip_key)
+    new_trips = _by_key(new.trips, trip_key)
+    old_vehicles = _by_key(old.vehicle_positions if old else empty, vehicle_key)
+    new_vehicles = _by_key(new.vehicle_positions, vehicle_key)
+    old_stop_rows = _stop_time_rows(old) if old else {}
+    new_stop_rows = _stop_time_rows(new)
+    old_alerts = _alerts_by_content(old.alerts if old else empty)
+    new_alerts = _alerts_by_content(new.alerts)
+
+    trip_routes = {trip_id: trip.route_id for trip_id, trip in old_trips.items()}
+    trip_routes.update((trip_id, trip.route_id) for trip_id, trip in new_trips.items())
+    trip_dates = {trip_id: trip.start_date for trip_id, trip in old_trips.items()}
+    trip_dates.update((trip_id, trip.start_date) for trip_id, trip in new_trips.items())
+    for vehicle in (old.vehicle_positions if old else empty) + new.vehicle_positions:
+        if vehicle.trip_id is not None:
+            trip_routes.setdefault(vehicle.trip_id, vehicle.route_id)
+            trip_dates.setdefault(vehicle.trip_id, vehicle.start_date)
+    # Trip ids repeat daily: a trip whose start date changed is a new trip
+    restarted = frozenset(
+        trip_id for trip_id, trip in new_trips.items()
+        if trip_id in old_trips and old_trips[trip_id].start_date != trip.start_date
+    )
+    alert_routes = {
+        key: MTAService.informed_routes(alert) for alerts in (old_alerts, new_alerts) for key, alert in alerts.items()
+    }
+
+    return ChangeSet(
+        new.header,
+        {
+            'trips': len(new.trips),
+            'vehicles': len(new.vehicle_positions),
+            'alerts': len(new.alerts),
+            'duplicates': (
+                len(new.trips) - len(new_trips)
+                + len(new.vehicle_positions) - len(new_vehicles)
+                + len(new.stop_times) - len(new_stop_rows)
+                + len(new.alerts) - len(new_alerts)
+            )
+        },
+        trip_routes,
+        trip_dates,
+        alert_routes,
+        _diff_keyed(old_trips, new_trips),
+        _diff_stop_times(old, new, old_stop_rows, new_stop_rows, restarted),
+        _diff_keyed(old_vehicles, new_vehicles),
+        _diff_alerts(old_alerts, new_alerts)
+    )
@@ -0,0 +1,207 @@
+import gzip
+import json
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from google.transit import gtfs_realtime_pb2
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Response formats in server preference order, with the media types each
+# one is requested and served as
+FORMATS: Dict[str, Tuple[str, ...]] = {
+    'json': ('application/json',),
+    'msgpack': ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack'),
+    'protobuf': ('application/x-protobuf', 'application/protobuf', 'application/vnd.google.protobuf')
+}
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+class NotAcceptable(Exception):
+    """
+    None of the formats the client accepts can be produced
+    """
+
+
+def available_formats() -> List[str]:
+    """
+    Formats servable with the installed optional dependencies
+    """
+    return [fmt for fmt in FORMATS if fmt != 'msgpack' or msgpack is not None]
+
+
+def available_encodings() -> List[str]:
+    """
+    Content encodings servable with the installed optional dependencies,
+    in server preference order
+    """
+    return (['br'] if brotli is not None else []) + ['gzip']
+
+
+def _parse_header(header: str) -> List[Tuple[str, float]]:
+    """
+    (value, q) pairs of an Accept-style header
+    """
+    ranges = []
+    for part in header.split(','):
+        value, _, params = part.strip().partition(';')
+        if not value:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, raw = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(raw)
+                except ValueError:
+                    q = 0.0
+        ranges.append((value.strip().lower(), q))
+    return ranges
+
+
+def _media_quality(ranges: List[Tuple[str, float]], media_type: str) -> float:
+    """
+    Quality the client gives a media type, using its most specific range
+    """
+    main_type = media_type.split('/')[0]
+    best, specificity = 0.0, -1
+    for value, q in ranges:
+        if value == media_type:
+            rank = 2
+        elif value == f"{main_type}/*":
+            rank = 1
+        elif value == '*/*':
+            rank = 0
+        else:
+            continue
+        if rank > specificity:
+            best, specificity = q, rank
+    return best
+
+
+def negotiate_format(accept: Optional[str], formats: Iterable[str] = None) -> str:
+    """
+    Best response format for an Accept header. JSON is served when the
+    header is missing.
+    Args:
+        accept: Value of the Accept request header
+        formats: Candidate formats in server preference order
+    Raises:
+        NotAcceptable: If no candidate format is accepted
+    """
+    formats = list(formats if formats is not None else available_formats())
+    if not accept:
+        return formats[0]
+    ranges = _parse_header(accept)
+    best, best_q = None, 0.0
+    for fmt in formats:
+        q = max(_media_quality(ranges, media_type) for media_type in FORMATS[fmt])
+        if q > best_q:
+            best, best_q = fmt, q
+    if best is None:
+        raise NotAcceptable(accept)
+    return best
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Best content encoding for an Accept-Encoding header, or None for an
+    uncompressed response
+    """
+    if not accept_encoding:
+        return None
+    qualities = dict(_parse_header(accept_encoding))
+    best, best_q = None, 0.0
+    for encoding in available_encodings():
+        q = qualities.get(encoding, qualities.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def media_type(fmt: str) -> str:
+    """
+    Content-Type a format is served with
+    """
+    return FORMATS[fmt][0]
+
+
+def serialize(payload: Any, fmt: str) -> bytes:
+    """
+    Serialize a JSON-compatible payload as JSON or msgpack
+    """
+    if fmt == 'msgpack':
+        if msgpack is None:
+            raise NotAcceptable(fmt)
+        return msgpack.packb(payload, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':')).encode()
+
+
+def compress(body: bytes, encoding: Optional[str]) -> bytes:
+    """
+    Apply a content encoding to a response body
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return body
+
+
+def filter_feed_bytes(content: bytes, routes: Optional[FrozenSet[str]], data_type: Optional[str] = None) -> bytes:
+    """
+    Raw GTFS-RT payload restricted to a line group's routes and one kind of
+    entity. The upstream bytes are passed through untouched when nothing
+    needs to be removed.
+    Args:
+        content: Serialized upstream FeedMessage
+        routes: Route ids to keep, or None to keep everything
+        data_type: Optional entity kind to keep (trip_updates, vehicle_positions, alerts)
+    """
+    if routes is None and data_type is None:
+        return content
+
+    field = {'trip_updates': 'trip_update', 'vehicle_positions': 'vehicle', 'alerts': 'alert'}.get(data_type)
+    feed = gtfs_realtime_pb2.FeedMessage.FromString(content)
+    kept = gtfs_realtime_pb2.FeedMessage()
+    kept.header.CopyFrom(feed.header)
+
+    for entity in feed.entity:
+        if field is not None and not entity.HasField(field):
+            continue
+        if routes is not None:
+            if entity.HasField('trip_update'):
+                if entity.trip_update.trip.route_id not in routes:
+                    continue
+            elif entity.HasField('vehicle'):
+                if entity.vehicle.trip.route_id not in routes:
+                    continue
+            elif entity.HasField('alert'):
+                alert_routes = set()
+                for informed in entity.alert.informed_entity:
+                    if informed.route_id:
+                        alert_routes.add(informed.route_id)
+                    if informed.HasField('trip'):
+                        alert_routes.add(informed.trip.route_id)
+                # Alerts without route information apply to the whole feed
+                if alert_routes and alert_routes.isdisjoint(routes):
+                    continue
+        kept.entity.add().CopyFrom(entity)
+
+    return kept.SerializeToString()
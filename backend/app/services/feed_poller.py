@@ -0,0 +1,644 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Union
+
+from .decoded_feed import DecodedFeed
+from .feed_diff import ChangeSet, diff_feeds
+from .feed_encoding import compress, filter_feed_bytes, serialize
+from .metrics import ENCODED_CACHE, RESPONSE_BYTES, SERIALIZE_SECONDS, Counter, Gauge, Metric, observe_decode
+from .mta_service import MTAService, decode_feed
+from .snapshot_store import INGEST_LEADER_TTL, RedisSnapshotStore
+from .static_gtfs import get_static_gtfs
+
+logger = logging.getLogger(__name__)
+
+# Polling configuration (seconds)
+FEED_POLL_INTERVAL = float(os.getenv("FEED_POLL_INTERVAL", "30"))
+FEED_STALE_AFTER = float(os.getenv("FEED_STALE_AFTER", str(FEED_POLL_INTERVAL * 3)))
+# How often workers that are not ingesting check the shared store
+SNAPSHOT_FOLLOW_INTERVAL = float(os.getenv("SNAPSHOT_FOLLOW_INTERVAL", "5"))
+# How often the ingest lease is renewed, independently of feed polling so
+# feeds backing off behind an open breaker never let it expire
+INGEST_LEASE_RENEW_INTERVAL = float(os.getenv("INGEST_LEASE_RENEW_INTERVAL", str(INGEST_LEADER_TTL / 3)))
+
+# Parse stage configuration: "process" parses feeds in parallel across
+# cores, "thread" only moves parsing off the event loop
+FEED_PARSE_EXECUTOR = os.getenv("FEED_PARSE_EXECUTOR", "process")
+FEED_PARSE_WORKERS = int(os.getenv("FEED_PARSE_WORKERS", str(min(len(MTAService.FEEDS), os.cpu_count() or 1))))
+
+# Circuit breaker: consecutive upstream failures after which a feed stops
+# being fetched, backing off exponentially from the poll interval up to
+# FEED_BACKOFF_MAX seconds while the last good snapshot keeps being served
+FEED_BREAKER_THRESHOLD = int(os.getenv("FEED_BREAKER_THRESHOLD", "3"))
+FEED_BACKOFF_MAX = float(os.getenv("FEED_BACKOFF_MAX", "600"))
+
+
+class FeedUnavailable(Exception):
+    """
+    Raised when a feed has no snapshot to serve and its upstream is failing
+    """
+
+    def __init__(self, feed_id: str, retry_after: float):
+        super().__init__(f"Feed {feed_id} is unavailable")
+        self.feed_id = feed_id
+        self.retry_after = retry_after
+
+
+class FeedSnapshot:
+    """
+    Immutable parsed view of one upstream feed at a point in time.
+    Snapshots are shared by every request handler, so callers must treat
+    `decoded` and `data` as read-only. `content` holds the raw upstream
+    payload when it is known.
+    """
+
+    __slots__ = ('feed_id', 'decoded', 'fetched_at', 'content', '_views', '_encoded', '_changes')
+
+    def __init__(self, feed_id: str, decoded: DecodedFeed, fetched_at: float, content: Optional[bytes] = None):
+        object.__setattr__(self, 'feed_id', feed_id)
+        object.__setattr__(self, 'decoded', decoded)
+        object.__setattr__(self, 'fetched_at', fetched_at)
+        object.__setattr__(self, 'content', content)
+        object.__setattr__(self, '_views', {})
+        object.__setattr__(self, '_encoded', {})
+        object.__setattr__(self, '_changes', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FeedSnapshot is immutable")
+
+    @property
+    def data(self) -> Dict:
+        """
+        JSON view of the whole feed, built on first access
+        """
+        return self.decoded.to_dict()
+
+    def revalidated(self, fetched_at: float) -> 'FeedSnapshot':
+        """
+        Copy of this snapshot confirmed current at a later time. Data,
+        cached views and encoded payloads are shared since the feed content
+        is unchanged.
+        """
+        snapshot = FeedSnapshot(self.feed_id, self.decoded, fetched_at, self.content)
+        object.__setattr__(snapshot, '_views', self._views)
+        object.__setattr__(snapshot, '_encoded', self._encoded)
+        return snapshot
+
+    def view(self, line_group: str) -> Dict:
+        """
+        Feed data restricted to a line group's routes and enriched from the
+        static schedule when one is installed, computed at most once per
+        snapshot
+        """
+        view = self._views.get(line_group)
+        if view is None:
+            routes = MTAService.LINE_GROUPS[line_group].routes
+            view = MTAService.filter_routes(self.data, routes)
+            static = get_static_gtfs()
+            if static is not None:
+                view = static.enrich(view)
+            self._views[line_group] = view
+        return view
+
+    def encoded(self, line_group: str, data_type: Optional[str], fmt: str, encoding: Optional[str] = None) -> bytes:
+        """
+        Response body for a line group in a wire format, serialized and
+        compressed at most once per snapshot
+        Args:
+            line_group: Line group whose view to encode
+            data_type: Optional single entity list of the view to encode
+            fmt: json, msgpack or protobuf (the upstream GTFS-RT bytes)
+            encoding: Optional content encoding (gzip or br)
+        """
+        key = (line_group, data_type, fmt, encoding)
+        body = self._encoded.get(key)
+        if body is not None:
+            ENCODED_CACHE.labels(self.feed_id, 'hit').inc()
+            return body
+
+        ENCODED_CACHE.labels(self.feed_id, 'miss').inc()
+        return self._encode(line_group, data_type, fmt, encoding)
+
+    def _encode(self, line_group: str, data_type: Optional[str], fmt: str, encoding: Optional[str] = None) -> bytes:
+        """
+        Build and cache an encoded body for encoded(). The uncompressed body
+        a compressed one starts from is reused from the cache without
+        counting as a second cache lookup.
+        """
+        key = (line_group, data_type, fmt, encoding)
+        body = self._encoded.get(key)
+        if body is not None:
+            return body
+
+        if encoding is not None:
+            body = self._encode(line_group, data_type, fmt)
+        with SERIALIZE_SECONDS.labels(self.feed_id, fmt, encoding or 'identity').time():
+            if encoding is not None:
+                body = compress(body, encoding)
+            elif fmt == 'protobuf':
+                if self.content is None:
+                    raise LookupError(f"No upstream payload for feed {self.feed_id}")
+                body = filter_feed_bytes(self.content, MTAService.LINE_GROUPS[line_group].routes, data_type)
+            else:
+                view = self.view(line_group)
+                body = serialize(view[data_type] if data_type else view, fmt)
+        RESPONSE_BYTES.labels(self.feed_id, fmt, encoding or 'identity').observe(len(body))
+        self._encoded[key] = body
+        return body
+
+    def etag(self, line_group: str, data_type: Optional[str], fmt: str, encoding: Optional[str] = None) -> str:
+        """
+        Strong entity tag of an encoded variant, derived from the feed
+        version so it can be computed without building the body
+        """
+        tag = '-'.join((
+            self.feed_id, str(self.decoded.header['timestamp']), line_group, data_type or 'all', fmt, encoding or 'identity'
+        ))
+        return f'"{tag}"'
+
+    def changes(self, previous: Optional['FeedSnapshot']) -> ChangeSet:
+        """
+        Changes since a previous version of the feed. The change set against
+        the most recently requested version is kept, so listeners notified
+        of the same update share one diff.
+        """
+        old = previous.decoded if previous is not None else None
+        if self._changes is None or self._changes[0] is not old:
+            object.__setattr__(self, '_changes', (old, diff_feeds(old, self.decoded)))
+        return self._changes[1]
+
+    @property
+    def age(self) -> float:
+        """
+        Seconds elapsed since the snapshot was fetched
+        """
+        return max(0.0, time.time() - self.fetched_at)
+
+    def is_stale(self, stale_after: float = FEED_STALE_AFTER) -> bool:
+        """
+        Whether the snapshot is older than the staleness threshold
+        """
+        return self.age > stale_after
+
+    def status(self, stale_after: float = FEED_STALE_AFTER) -> Dict:
+        """
+        Age and staleness information exposed alongside feed data
+        """
+        return {
+            'fetched_at': self.fetched_at,
+            'age_seconds': round(self.age, 3),
+            'stale': self.is_stale(stale_after)
+        }
+
+
+# Called with (new snapshot, previous snapshot) whenever a feed publishes a
+# new version; may be a plain function or a coroutine function
+SnapshotListener = Callable[['FeedSnapshot', Optional['FeedSnapshot']], Union[None, Awaitable[None]]]
+
+
+class FeedState:
+    """
+    Fetch bookkeeping for one upstream feed
+    """
+
+    def __init__(self, feed_id: str):
+        self.feed_id = feed_id
+        self.content: Optional[bytes] = None
+        self.not_modified = 0  # upstream answered 304
+        self.unchanged = 0     # body or header timestamp matched the last snapshot
+        self.updated = 0       # new feed version parsed and published
+        self.failed = 0        # fetch or decode raised
+        self.consecutive_failures = 0
+        self.last_success: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.last_error_at: Optional[float] = None
+        self.open_until = 0.0  # monotonic time the circuit breaker closes again
+
+    def record_success(self):
+        """
+        Note a successful fetch, closing the circuit breaker
+        """
+        self.last_success = time.time()
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self, error: Exception, backoff: float):
+        """
+        Note a failed fetch, opening the circuit breaker once failures
+        reach FEED_BREAKER_THRESHOLD
+        Args:
+            error: What the fetch or decode raised
+            backoff: Seconds the breaker stays open on the first trip,
+                doubling with every further failure
+        """
+        self.failed += 1
+        self.consecutive_failures += 1
+        self.last_error = f"{type(error).__name__}: {error}"
+        self.last_error_at = time.time()
+        if self.consecutive_failures >= FEED_BREAKER_THRESHOLD:
+            trips = self.consecutive_failures - FEED_BREAKER_THRESHOLD
+            self.open_until = time.monotonic() + min(FEED_BACKOFF_MAX, backoff * 2 ** min(trips, 32))
+
+    @property
+    def retry_in(self) -> float:
+        """
+        Seconds until the upstream may be fetched again
+        """
+        return max(0.0, self.open_until - time.monotonic())
+
+    @property
+    def circuit_open(self) -> bool:
+        return self.retry_in > 0
+
+    def to_dict(self) -> Dict:
+        """
+        Counters and upstream health exposed by the feeds status endpoint
+        """
+        hits = self.not_modified + self.unchanged
+        total = hits + self.updated
+        return {
+            'not_modified': self.not_modified,
+            'unchanged': self.unchanged,
+            'updated': self.updated,
+            'failed': self.failed,
+            'hit_ratio': round(hits / total, 3) if total else None,
+            'last_success': self.last_success,
+            'last_error': self.last_error,
+            'last_error_at': self.last_error_at,
+            'consecutive_failures': self.consecutive_failures,
+            'circuit': 'open' if self.circuit_open else 'closed',
+            'retry_in': round(self.retry_in, 3)
+        }
+
+
+class FeedPoller:
+    """
+    Background task that polls every distinct MTA feed and publishes
+    parsed snapshots for request handlers to serve from memory. With a
+    shared snapshot store, only the worker holding the ingest lock polls
+    the MTA; the others follow the snapshots it publishes.
+    """
+
+    def __init__(
+        self,
+        mta_service: Optional[MTAService] = None,
+        interval: float = FEED_POLL_INTERVAL,
+        stale_after: float = FEED_STALE_AFTER,
+        executor: Optional[Executor] = None,
+        store: Optional[RedisSnapshotStore] = None,
+        follow_interval: float = SNAPSHOT_FOLLOW_INTERVAL,
+        lease_interval: float = INGEST_LEASE_RENEW_INTERVAL
+    ):
+        self.mta_service = mta_service or MTAService()
+        self._executor = executor
+        self.store = store
+        self.interval = interval
+        self.follow_interval = follow_interval
+        self.lease_interval = lease_interval
+        self.stale_after = stale_after
+        self.leading = store is None
+        self._snapshots: Dict[str, FeedSnapshot] = {}
+        self._states: Dict[str, FeedState] = {feed_id: FeedState(feed_id) for feed_id in MTAService.FEEDS}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._listeners: List[SnapshotListener] = []
+        self._leader_listeners: List[SnapshotListener] = []
+
+    def subscribe(self, listener: SnapshotListener, leader_only: bool = False):
+        """
+        Register a callback run for every new feed version, in publish order
+        Args:
+            listener: Callback taking (snapshot, previous snapshot)
+            leader_only: Run it only on the worker ingesting from the MTA,
+                for listeners persisting feed versions; others maintain
+                per-process state and run on every worker
+        """
+        (self._leader_listeners if leader_only else self._listeners).append(listener)
+
+    async def start(self):
+        """
+        Start one polling task per upstream feed, plus the ingest lease
+        renewal task with a shared snapshot store
+        """
+        if self._tasks:
+            return
+        if self.store is not None:
+            self._tasks.append(asyncio.create_task(self._lease_loop()))
+        for feed_id in MTAService.FEEDS:
+            self._tasks.append(asyncio.create_task(self._poll_loop(feed_id)))
+        logger.info(f"Started feed poller for {len(MTAService.FEEDS)} feeds every {self.interval}s")
+
+    async def stop(self):
+        """
+        Cancel all polling tasks and release upstream connections
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.mta_service.aclose()
+        if self.store is not None:
+            await self.store.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    @property
+    def executor(self) -> Executor:
+        """
+        Pool used to parse feeds off the event loop
+        """
+        if self._executor is None:
+            if FEED_PARSE_EXECUTOR == "process":
+                self._executor = ProcessPoolExecutor(max_workers=FEED_PARSE_WORKERS)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=FEED_PARSE_WORKERS,
+                    thread_name_prefix="feed-parse"
+                )
+        return self._executor
+
+    async def _lease_loop(self):
+        """
+        Acquire or renew the ingest lease on a fixed timer. Feed polls also
+        renew it, but all of them may be backing off for longer than the
+        lease lasts while the MTA is down.
+        """
+        while True:
+            try:
+                self.leading = await self.store.is_leader()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error renewing ingest lease: {str(e)}")
+            await asyncio.sleep(self.lease_interval)
+
+    async def _poll_loop(self, feed_id: str):
+        """
+        Refresh a single feed forever on the configured interval
+        """
+        while True:
+            started = time.monotonic()
+            try:
+                await self.refresh(feed_id)
+            except asyncio.CancelledError:
+                raise
+            except FeedUnavailable:
+                pass  # Already logged when the fetch failed
+            except Exception as e:
+                logger.error(f"Error polling feed {feed_id}: {str(e)}")
+            interval = self.interval if self.leading else self.follow_interval
+            delay = interval - (time.monotonic() - started)
+            if self.leading:
+                delay = max(delay, self._states[feed_id].retry_in)
+            await asyncio.sleep(max(0.0, delay))
+
+    async def refresh(self, feed_id: str, if_missing: bool = False) -> FeedSnapshot:
+        """
+        Fetch a feed and publish a new snapshot if it changed. Unchanged
+        feeds (304, identical body or identical header timestamp) only
+        revalidate the current snapshot and are never re-processed. While
+        the upstream fails the current snapshot is returned as is, and
+        FeedUnavailable is raised if there is none.
+        Args:
+            feed_id: Upstream feed to refresh
+            if_missing: Reuse a snapshot published while waiting for the lock
+        """
+        lock = self._locks.setdefault(feed_id, asyncio.Lock())
+        async with lock:
+            current = self._snapshots.get(feed_id)
+            if if_missing and current is not None:
+                return current
+
+            if self.store is not None:
+                try:
+                    self.leading = await self.store.is_leader()
+                    if not self.leading:
+                        snapshot = await self._follow(feed_id, current)
+                        # Fetch upstream only on a cold start with nothing shared yet
+                        if snapshot is not None or current is not None:
+                            return snapshot or current
+                except Exception as e:
+                    logger.error(f"Snapshot store unavailable, fetching {feed_id} directly: {str(e)}")
+                    self.leading = True
+
+            return await self._refresh_upstream(feed_id, current)
+
+    async def _follow(self, feed_id: str, current: Optional[FeedSnapshot]) -> Optional[FeedSnapshot]:
+        """
+        Adopt the latest version of a feed published by the ingesting worker
+        """
+        latest = await self.store.latest(feed_id)
+        if latest is None:
+            return None
+        decoded, content, fetched_at = latest
+        if current is not None and decoded.header['timestamp'] == current.decoded.header['timestamp']:
+            if fetched_at <= current.fetched_at:
+                return current
+            return self._publish(current.revalidated(fetched_at))
+        snapshot = self._publish(FeedSnapshot(feed_id, decoded, fetched_at, content))
+        await self._notify(snapshot, current)
+        return snapshot
+
+    async def _refresh_upstream(self, feed_id: str, current: Optional[FeedSnapshot]) -> FeedSnapshot:
+        """
+        Fetch a feed from the MTA and publish the result
+        """
+        state = self._states[feed_id]
+        if state.circuit_open:
+            if current is None:
+                raise FeedUnavailable(feed_id, state.retry_in)
+            return current
+
+        try:
+            content = await self.mta_service.fetch_feed(
+                MTAService.FEEDS[feed_id],
+                conditional=current is not None
+            )
+            decoded = None
+            if content is not None and (current is None or content != state.content):
+                loop = asyncio.get_running_loop()
+                decoded = await loop.run_in_executor(
+                    self.executor,
+                    decode_feed,
+                    content,
+                    current.decoded.header['timestamp'] if current is not None else None
+                )
+        except Exception as e:
+            state.record_failure(e, self.interval)
+            logger.error(
+                f"Error refreshing feed {feed_id} ({state.consecutive_failures} consecutive failures, "
+                f"retry in {state.retry_in:.0f}s): {str(e)}"
+            )
+            if current is None:
+                raise FeedUnavailable(feed_id, state.retry_in) from e
+            return current
+
+        state.record_success()
+        if content is None:
+            state.not_modified += 1
+            return await self._revalidate(current)
+        if current is not None and content == state.content:
+            state.unchanged += 1
+            return await self._revalidate(current)
+
+        state.content = content
+        if decoded is None:
+            state.unchanged += 1
+            return await self._revalidate(current)
+        observe_decode(feed_id, decoded.timings)
+
+        state.updated += 1
+        snapshot = self._publish(FeedSnapshot(feed_id, decoded, time.time(), content))
+        await self._share(snapshot, new_version=True)
+        await self._notify(snapshot, current)
+        return snapshot
+
+    async def _revalidate(self, current: FeedSnapshot) -> FeedSnapshot:
+        """
+        Mark the current snapshot as confirmed by the upstream just now
+        """
+        snapshot = self._publish(current.revalidated(time.time()))
+        await self._share(snapshot, new_version=False)
+        return snapshot
+
+    def _publish(self, snapshot: FeedSnapshot) -> FeedSnapshot:
+        """
+        Make a snapshot visible to request handlers
+        """
+        self._snapshots[snapshot.feed_id] = snapshot
+        return snapshot
+
+    async def _share(self, snapshot: FeedSnapshot, new_version: bool):
+        """
+        Publish a snapshot to the shared store for the other workers
+        """
+        if self.store is None or not self.leading:
+            return
+        try:
+            await self.store.publish(
+                snapshot.feed_id, snapshot.decoded, snapshot.fetched_at, new_version, snapshot.content
+            )
+        except Exception as e:
+            logger.error(f"Error sharing snapshot for feed {snapshot.feed_id}: {str(e)}")
+
+    async def _notify(self, snapshot: FeedSnapshot, previous: Optional[FeedSnapshot]):
+        """
+        Run listeners for a newly published feed version; leader-only ones
+        are skipped on workers following the shared store
+        """
+        listeners = self._listeners + self._leader_listeners if self.leading else self._listeners
+        for listener in listeners:
+            try:
+                result = listener(snapshot, previous)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logger.error(f"Error in snapshot listener for feed {snapshot.feed_id}: {str(e)}")
+
+    def get_snapshot(self, feed_id: str) -> Optional[FeedSnapshot]:
+        """
+        Latest published snapshot for a feed, if any
+        """
+        return self._snapshots.get(feed_id)
+
+    def feed_state(self, feed_id: str) -> FeedState:
+        """
+        Fetch bookkeeping of an upstream feed
+        """
+        return self._states[feed_id]
+
+    def feed_states(self) -> Dict[str, Dict]:
+        """
+        Snapshot age and fetch counters for every upstream feed
+        """
+        states = {}
+        for feed_id, state in self._states.items():
+            snapshot = self._snapshots.get(feed_id)
+            states[feed_id] = {
+                **state.to_dict(),
+                **(snapshot.status(self.stale_after) if snapshot else {'fetched_at': None, 'stale': True})
+            }
+        return states
+
+    def service_status(self) -> Dict:
+        """
+        Overall health from the fetchers' bookkeeping, without upstream I/O:
+        operational while every feed has a fresh snapshot, degraded while
+        some are stale, failing or not fetched yet, and unavailable while
+        no feed has anything fresh to serve, including at cold start
+        """
+        feeds = self.feed_states()
+        fresh = [feed_id for feed_id, state in feeds.items() if state['fetched_at'] and not state['stale']]
+        failing = [
+            feed_id for feed_id, state in feeds.items()
+            if state['consecutive_failures'] or (state['fetched_at'] and state['stale'])
+        ]
+        unavailable = [feed_id for feed_id in feeds if feed_id not in self._snapshots]
+        if not fresh:
+            status = "unavailable"
+        elif failing or unavailable:
+            status = "degraded"
+        else:
+            status = "operational"
+        timestamps = [snapshot.decoded.header['timestamp'] for snapshot in self._snapshots.values()]
+        return {
+            "status": status,
+            "last_update": max(timestamps) if timestamps else None,
+            "failing_feeds": failing,
+            "unavailable_feeds": unavailable,
+            "feeds": feeds
+        }
+
+    def collect_metrics(self) -> Iterator[Metric]:
+        """
+        Metrics collector reporting snapshot ages and fetch results from
+        the poller's own bookkeeping at scrape time
+        """
+        age = Gauge('subway_feed_age_seconds', 'Seconds since the feed snapshot was fetched', ('feed',))
+        stale = Gauge('subway_feed_stale', 'Whether the feed snapshot is stale', ('feed',))
+        fetches = Counter('subway_feed_fetches_total', 'Feed refreshes by result', ('feed', 'result'))
+        hit_ratio = Gauge(
+            'subway_feed_fetch_hit_ratio', 'Share of feed refreshes that did not need decoding', ('feed',)
+        )
+        failures = Gauge('subway_feed_consecutive_failures', 'Upstream failures since the last success', ('feed',))
+        circuit = Gauge('subway_feed_circuit_open', 'Whether the feed circuit breaker is open', ('feed',))
+        for feed_id, state in self._states.items():
+            snapshot = self._snapshots.get(feed_id)
+            if snapshot is not None:
+                age.labels(feed_id).set(snapshot.age)
+            stale.labels(feed_id).set(1 if snapshot is None or snapshot.is_stale(self.stale_after) else 0)
+            for result in ('not_modified', 'unchanged', 'updated', 'failed'):
+                fetches.labels(feed_id, result).set(getattr(state, result))
+            ratio = state.to_dict()['hit_ratio']
+            if ratio is not None:
+                hit_ratio.labels(feed_id).set(ratio)
+            failures.labels(feed_id).set(state.consecutive_failures)
+            circuit.labels(feed_id).set(1 if state.circuit_open else 0)
+        return iter((age, stale, fetches, hit_ratio, failures, circuit))
+
+    async def get_line_snapshot(self, line_group: str) -> Optional[FeedSnapshot]:
+        """
+        Latest snapshot for a line group, fetching it once if the poller
+        has not published one yet. Returns None for unknown line groups.
+        """
+        group = MTAService.LINE_GROUPS.get(line_group)
+        if not group:
+            return None
+        snapshot = self._snapshots.get(group.feed_id)
+        if snapshot is None:
+            snapshot = await self.refresh(group.feed_id, if_missing=True)
+        return snapshot
+
+
+feed_poller = FeedPoller(store=RedisSnapshotStore.from_env())
+
+
+def get_feed_poller() -> FeedPoller:
+    """
+    Get the application-wide feed poller
+    """
+    return feed_poller
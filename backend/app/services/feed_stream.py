@@ -0,0 +1,167 @@
+import asyncio
+import logging
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Set
+
+from .feed_encoding import serialize
+from .feed_poller import FeedPoller, FeedSnapshot, feed_poller
+from .mta_service import MTAService
+
+logger = logging.getLogger(__name__)
+
+# Messages buffered per subscriber before it is considered too slow and
+# resynchronised with a full snapshot
+STREAM_QUEUE_SIZE = 32
+
+
+class StreamMessage(NamedTuple):
+    """
+    Encoded stream message and the feed version it brings a line group to
+    """
+    line_group: str
+    version: int
+    text: str
+
+
+def _dumps(message: Dict) -> str:
+    return serialize(message, 'json').decode()
+
+
+def filter_stops(message: Dict, stops: FrozenSet[str]) -> Dict:
+    """
+    Restrict a snapshot or diff message to the given stop ids
+    """
+    filtered = dict(message)
+    if message['type'] == 'snapshot':
+        filtered['trip_updates'] = [
+            {**trip, 'stop_time_updates': updates}
+            for trip in message['trip_updates']
+            for updates in [[update for update in trip['stop_time_updates'] if update['stop_id'] in stops]]
+            if updates
+        ]
+        filtered['vehicle_positions'] = [
+            vehicle for vehicle in message['vehicle_positions'] if vehicle.get('stop_id') in stops
+        ]
+        return filtered
+
+    stop_time_updates = message['stop_time_updates']
+    filtered['stop_time_updates'] = {
+        change: [update for update in updates if update['stop_id'] in stops]
+        for change, updates in stop_time_updates.items()
+    }
+    trip_ids = {
+        update['trip_id']
+        for updates in filtered['stop_time_updates'].values()
+        for update in updates
+    }
+    trips = message['trips']
+    vehicles = message['vehicle_positions']
+    filtered['trips'] = {
+        'inserted': [trip for trip in trips['inserted'] if trip['trip_id'] in trip_ids],
+        'updated': [trip for trip in trips['updated'] if trip['trip_id'] in trip_ids],
+        'deleted': trips['deleted']
+    }
+    filtered['vehicle_positions'] = {
+        'inserted': [vehicle for vehicle in vehicles['inserted'] if vehicle.get('stop_id') in stops],
+        'updated': [vehicle for vehicle in vehicles['updated'] if vehicle.get('stop_id') in stops],
+        'deleted': vehicles['deleted']
+    }
+    return filtered
+
+
+class Subscription:
+    """
+    One connected client and the line groups / stops it asked for
+    """
+
+    def __init__(self, line_groups: FrozenSet[str], stops: Optional[FrozenSet[str]] = None):
+        self.line_groups = line_groups
+        self.stops = stops
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+    def offer(self, message: StreamMessage):
+        """
+        Queue a message for this subscriber, replacing the backlog with a
+        resync marker (None) if the client is not keeping up
+        """
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+
+class FeedBroadcaster:
+    """
+    Fans out per-update feed diffs to streaming subscribers. Each line
+    group's diff is computed and serialized once per feed update no matter
+    how many clients are connected.
+    """
+
+    def __init__(self, poller: FeedPoller):
+        self.poller = poller
+        self.subscribers: Set[Subscription] = set()
+
+    def on_snapshot(self, snapshot: FeedSnapshot, previous: Optional[FeedSnapshot]):
+        """
+        Feed poller listener broadcasting the changes of a new feed version
+        """
+        if previous is None or not self.subscribers:
+            return
+        wanted = set().union(*(subscriber.line_groups for subscriber in self.subscribers))
+        changes = snapshot.changes(previous)
+        version = snapshot.decoded.header['timestamp']
+        for line_group, group in MTAService.LINE_GROUPS.items():
+            if group.feed_id != snapshot.feed_id or line_group not in wanted:
+                continue
+            message = {
+                'type': 'diff',
+                'line_group': line_group,
+                **changes.filter_routes(group.routes).to_dict()
+            }
+            # Encoded once per distinct stop filter, None being unfiltered
+            encoded: Dict[Optional[FrozenSet[str]], str] = {None: _dumps(message)}
+            for subscriber in list(self.subscribers):
+                if line_group not in subscriber.line_groups:
+                    continue
+                text = encoded.get(subscriber.stops)
+                if text is None:
+                    text = encoded[subscriber.stops] = _dumps(filter_stops(message, subscriber.stops))
+                subscriber.offer(StreamMessage(line_group, version, text))
+
+    async def snapshot_messages(self, subscription: Subscription) -> List[StreamMessage]:
+        """
+        Full current state for every line group of a subscription
+        """
+        messages = []
+        for line_group in sorted(subscription.line_groups):
+            snapshot = await self.poller.get_line_snapshot(line_group)
+            message = {'type': 'snapshot', 'line_group': line_group, **snapshot.view(line_group)}
+            if subscription.stops is not None:
+                message = filter_stops(message, subscription.stops)
+            messages.append(StreamMessage(line_group, snapshot.decoded.header['timestamp'], _dumps(message)))
+        return messages
+
+    def subscribe(self, line_groups: FrozenSet[str], stops: Optional[FrozenSet[str]] = None) -> Subscription:
+        """
+        Register a new subscriber
+        """
+        subscription = Subscription(line_groups, stops)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """
+        Remove a subscriber
+        """
+        self.subscribers.discard(subscription)
+
+
+feed_broadcaster = FeedBroadcaster(feed_poller)
+
+
+def get_feed_broadcaster() -> FeedBroadcaster:
+    """
+    Get the application-wide feed broadcaster
+    """
+    return feed_broadcaster
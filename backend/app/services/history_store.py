@@ -0,0 +1,338 @@
+"""
+Service-day history of stop predictions and vehicle positions, and
+retention for both the history and the live tables.
+
+The live tables only hold the current state of each trip. With
+FEED_HISTORY_ENABLED every feed version's changes are also written to
+stop_time_history and vehicle_position_history. On PostgreSQL those tables
+are partitioned by service day, so expiring a day detaches or drops one
+partition instead of deleting rows.
+"""
+import asyncio
+import logging
+import os
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy import and_, delete, or_, select, text
+from ..db.session import AsyncSessionLocal
+from .db_service import DBService
+from .decoded_feed import DecodedFeed
+from .feed_diff import ChangeSet, diff_feeds
+from ..models.history import PARTITIONED_TABLES, StopTimeHistory, VehiclePositionHistory
+from ..models.subway import (
+    Alert, AlertInformedEntity, FeedUpdate, StopTimeUpdate, Trip, VehiclePosition,
+    StopTimeScheduleRelationship, VehicleStopStatus
+)
+
+logger = logging.getLogger(__name__)
+
+FEED_HISTORY_ENABLED = os.getenv("FEED_HISTORY_ENABLED", "false").lower() == "true"
+# Service days of history kept, and of trips kept in the live tables
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "90"))
+LIVE_RETENTION_DAYS = int(os.getenv("LIVE_RETENTION_DAYS", "2"))
+# Expired partitions are moved to this schema instead of dropped when set
+HISTORY_ARCHIVE_SCHEMA = os.getenv("HISTORY_ARCHIVE_SCHEMA") or None
+# Seconds between retention runs, and days of partitions created ahead
+HISTORY_MAINTENANCE_INTERVAL = float(os.getenv("HISTORY_MAINTENANCE_INTERVAL", "3600"))
+HISTORY_PARTITIONS_AHEAD = 2
+
+# (table, service day) partitions known to exist in this process
+_partitions: Set[Tuple[str, Optional[date]]] = set()
+
+
+def partition_name(table: str, day: date) -> str:
+    """
+    Name of the partition of a history table holding one service day
+    """
+    return f"{table}_{day:%Y%m%d}"
+
+
+def partition_day(table: str, name: str) -> Optional[date]:
+    """
+    Service day held by a partition, or None for the default partition
+    """
+    try:
+        return datetime.strptime(name[len(table) + 1:], "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+def service_date(start_date: Optional[str], timestamp: int) -> date:
+    """
+    Service day of a trip: its GTFS start date, falling back to the local
+    date of the feed version
+    """
+    if start_date:
+        try:
+            return datetime.strptime(start_date, "%Y%m%d").date()
+        except ValueError:
+            pass
+    return datetime.fromtimestamp(timestamp).date()
+
+
+class HistoryService(DBService):
+    """
+    History and retention operations on an async session
+    """
+
+    async def record_changes(self, changes: ChangeSet):
+        """
+        Write the stop predictions and vehicle positions that changed in a
+        feed version to the history tables. Stops that dropped out of the
+        feed keep their last prediction.
+        Args:
+            changes: Changes from the last recorded version to the new one
+        """
+        try:
+            timestamp = changes.header['timestamp']
+            days: Dict[str, date] = {}
+
+            def day_of(trip_id: str) -> date:
+                day = days.get(trip_id)
+                if day is None:
+                    day = days[trip_id] = service_date(changes.trip_dates.get(trip_id), timestamp)
+                return day
+
+            stop_rows = self._stop_history_rows(changes, day_of)
+            vehicle_rows = self._vehicle_history_rows(changes, day_of)
+            await self.ensure_partitions(set(days.values()))
+
+            if stop_rows:
+                statement = self._insert(StopTimeHistory)
+                statement = statement.on_conflict_do_update(
+                    index_elements=[StopTimeHistory.service_date, StopTimeHistory.trip_id, StopTimeHistory.stop_id],
+                    set_={
+                        column: getattr(statement.excluded, column)
+                        for column in (
+                            'route_id', 'arrival_time', 'arrival_delay', 'departure_time',
+                            'departure_delay', 'schedule_relationship', 'last_seen'
+                        )
+                    }
+                )
+                await self.db.execute(statement, stop_rows)
+            if vehicle_rows:
+                await self.db.execute(self._insert(VehiclePositionHistory).on_conflict_do_nothing(), vehicle_rows)
+            await self.db.commit()
+        except Exception:
+            await self.db.rollback()
+            raise
+
+    def _stop_history_rows(self, changes: ChangeSet, day_of) -> List[Dict]:
+        """
+        History rows for inserted and updated stop time updates
+        """
+        seen = datetime.fromtimestamp(changes.header['timestamp'])
+        return [
+            {
+                'service_date': day_of(update['trip_id']),
+                'trip_id': update['trip_id'],
+                'stop_id': update['stop_id'],
+                'route_id': changes.trip_routes.get(update['trip_id'], ''),
+                'arrival_time': datetime.fromtimestamp(update['arrival']['time']) if update.get('arrival') else None,
+                'arrival_delay': update.get('arrival', {}).get('delay'),
+                'departure_time': datetime.fromtimestamp(update['departure']['time']) if update.get('departure') else None,
+                'departure_delay': update.get('departure', {}).get('delay'),
+                'schedule_relationship': StopTimeScheduleRelationship(update.get('schedule_relationship', 0)),
+                'first_seen': seen,
+                'last_seen': seen
+            }
+            for update in changes.stop_time_updates.changed()
+        ]
+
+    def _vehicle_history_rows(self, changes: ChangeSet, day_of) -> List[Dict]:
+        """
+        History rows for changed vehicles that report a trip and timestamp
+        """
+        rows = {}
+        for vehicle in changes.vehicle_positions.changed():
+            if 'trip' not in vehicle or 'timestamp' not in vehicle:
+                continue
+            trip = vehicle['trip']
+            position = vehicle.get('position') or {}
+            row = {
+                'service_date': day_of(trip['trip_id']),
+                'trip_id': trip['trip_id'],
+                'timestamp': datetime.fromtimestamp(vehicle['timestamp']),
+                'route_id': trip['route_id'],
+                'latitude': position.get('latitude'),
+                'longitude': position.get('longitude'),
+                'bearing': position.get('bearing'),
+                'current_stop_sequence': vehicle.get('current_stop_sequence'),
+                'current_stop_id': vehicle.get('stop_id'),
+                'current_status': VehicleStopStatus(vehicle.get('current_status', 0))
+            }
+            rows[row['service_date'], row['trip_id'], row['timestamp']] = row
+        return list(rows.values())
+
+    async def ensure_partitions(self, days: Iterable[date]):
+        """
+        Create the history partitions for service days, plus a default
+        partition for anything outside them. No-op except on PostgreSQL.
+        Partitions are created in their own committed transaction, so they
+        exist whatever happens to the caller's; the process-wide cache only
+        saves repeating the DDL and is updated once it has committed, with
+        the default partition catching rows for any partition it misses.
+        """
+        if self.db.bind.dialect.name != 'postgresql':
+            return
+        wanted = [(table.name, None) for table in PARTITIONED_TABLES] + [
+            (table.name, day) for table in PARTITIONED_TABLES for day in sorted(days)
+        ]
+        missing = [partition for partition in wanted if partition not in _partitions]
+        if not missing:
+            return
+        async with self.db.bind.begin() as connection:
+            for table_name, day in missing:
+                if day is None:
+                    await connection.execute(text(
+                        f'CREATE TABLE IF NOT EXISTS "{table_name}_default" PARTITION OF "{table_name}" DEFAULT'
+                    ))
+                else:
+                    await connection.execute(text(
+                        f'CREATE TABLE IF NOT EXISTS "{partition_name(table_name, day)}" PARTITION OF "{table_name}" '
+                        f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')"
+                    ))
+        _partitions.update(missing)
+
+    async def prune_history(self, retention_days: int = HISTORY_RETENTION_DAYS,
+                            archive_schema: Optional[str] = HISTORY_ARCHIVE_SCHEMA) -> List[str]:
+        """
+        Expire history older than the retention period. On PostgreSQL whole
+        service-day partitions are dropped, or detached into the archive
+        schema; remaining old rows (other databases, default partition) are
+        deleted.
+        Returns:
+            Names of the partitions dropped or archived
+        """
+        cutoff = date.today() - timedelta(days=retention_days)
+        expired = []
+        if self.db.bind.dialect.name == 'postgresql':
+            if archive_schema:
+                await self.db.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{archive_schema}"'))
+            for table in PARTITIONED_TABLES:
+                result = await self.db.execute(text(
+                    "SELECT child.relname FROM pg_inherits "
+                    "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+                    "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                    "WHERE parent.relname = :parent"
+                ), {'parent': table.name})
+                for (name,) in result.all():
+                    day = partition_day(table.name, name)
+                    if day is None or day >= cutoff:
+                        continue
+                    if archive_schema:
+                        await self.db.execute(text(f'ALTER TABLE "{table.name}" DETACH PARTITION "{name}"'))
+                        await self.db.execute(text(f'ALTER TABLE "{name}" SET SCHEMA "{archive_schema}"'))
+                    else:
+                        await self.db.execute(text(f'DROP TABLE "{name}"'))
+                    _partitions.discard((table.name, day))
+                    expired.append(name)
+
+        for table in PARTITIONED_TABLES:
+            await self.db.execute(table.delete().where(table.c.service_date < cutoff))
+        return expired
+
+    async def prune_live(self, retention_days: int = LIVE_RETENTION_DAYS) -> int:
+        """
+        Delete trips whose service day (or last update, for trips without a
+        start date) is older than the retention period, with their stop time
+        updates and vehicle positions, old feed update records and alerts
+        expired before the retention period
+        Returns:
+            Number of trips deleted
+        """
+        cutoff = datetime.now() - timedelta(days=retention_days)
+        stale = select(Trip.id).where(or_(
+            and_(Trip.start_date != '', Trip.start_date < cutoff.strftime("%Y%m%d")),
+            Trip.updated_at < datetime.utcnow() - timedelta(days=retention_days)
+        ))
+        expired_alerts = select(Alert.id).where(Alert.expired_at < datetime.utcnow() - timedelta(days=retention_days))
+        for statement in (
+            delete(StopTimeUpdate).where(StopTimeUpdate.trip_id.in_(stale)),
+            delete(VehiclePosition).where(VehiclePosition.trip_id.in_(stale)),
+            delete(FeedUpdate).where(FeedUpdate.timestamp < cutoff),
+            delete(AlertInformedEntity).where(AlertInformedEntity.alert_id.in_(expired_alerts)),
+            delete(Alert).where(Alert.id.in_(expired_alerts))
+        ):
+            await self.db.execute(statement.execution_options(synchronize_session=False))
+        result = await self.db.execute(
+            delete(Trip).where(Trip.id.in_(stale)).execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+    async def run_maintenance(self) -> Tuple[List[str], int]:
+        """
+        Create upcoming partitions and apply retention in one transaction
+        """
+        try:
+            today = date.today()
+            await self.ensure_partitions(today + timedelta(days=offset) for offset in range(-1, HISTORY_PARTITIONS_AHEAD + 1))
+            expired = await self.prune_history()
+            trips = await self.prune_live()
+            await self.db.commit()
+        except Exception:
+            await self.db.rollback()
+            raise
+        return expired, trips
+
+
+# Last feed version recorded by record_snapshot, per feed
+_recorded_versions: Dict[str, DecodedFeed] = {}
+
+
+async def record_snapshot(snapshot, previous=None):
+    """
+    Feed poller listener writing each new feed version's changes to the
+    history tables, diffing against the last version recorded
+    """
+    recorded = _recorded_versions.get(snapshot.feed_id)
+    if (previous.decoded if previous is not None else None) is recorded:
+        changes = snapshot.changes(previous)
+    else:
+        changes = diff_feeds(recorded, snapshot.decoded)
+    async with AsyncSessionLocal() as session:
+        await HistoryService(session).record_changes(changes)
+    _recorded_versions[snapshot.feed_id] = snapshot.decoded
+
+
+class HistoryMaintenance:
+    """
+    Background task keeping history partitions ahead of the service day and
+    applying retention
+    """
+
+    def __init__(self, interval: float = HISTORY_MAINTENANCE_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """
+        Start the maintenance loop
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """
+        Cancel the maintenance loop
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                async with AsyncSessionLocal() as session:
+                    expired, trips = await HistoryService(session).run_maintenance()
+                if expired or trips:
+                    logger.info(f"History retention expired {len(expired)} partitions and {trips} live trips")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error running history maintenance: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+
+history_maintenance = HistoryMaintenance()
@@ -0,0 +1,233 @@
+"""
+Minimal Prometheus instrumentation: labelled counters, gauges and
+histograms kept in process memory and rendered in the text exposition
+format by the /metrics endpoint.
+
+Recording a sample is a dict lookup plus an add (and a bisect for
+histograms), cheap enough to leave on in the hot path. Values derived from
+state that already exists elsewhere, such as feed ages or the poller's
+fetch counters, are produced by collectors at scrape time instead.
+"""
+import math
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# Buckets in seconds for pipeline stages, from sub-millisecond to seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets in bytes for payload sizes
+SIZE_BUCKETS = tuple(float(2 ** power) for power in range(10, 25, 2))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + '}'
+
+
+class Metric:
+    """
+    A metric family: one child per combination of label values
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *values: str):
+        """
+        Child metric for a combination of label values
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self) -> Iterator[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+        """
+        (name suffix, label names, label values, value) of every sample
+        """
+        for values, child in self._children.items():
+            yield '', self.labelnames, values, child.value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values)} {_format_value(value)}")
+        return lines
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count
+    """
+
+    kind = 'counter'
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+
+class Gauge(Metric):
+    """
+    Value that can go up and down
+    """
+
+    kind = 'gauge'
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+
+class _HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        """
+        Observe the duration of a block in seconds
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observations over fixed buckets
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> _HistogramValue:
+        return _HistogramValue(self.buckets)
+
+    def samples(self):
+        names = self.labelnames + ('le',)
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                yield '_bucket', names, values + (_format_value(bound),), cumulative
+            yield '_sum', self.labelnames, values, child.sum
+            yield '_count', self.labelnames, values, child.count
+
+
+class Registry:
+    """
+    Metrics exposed together, plus collectors producing metrics at scrape
+    time
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], Iterable[Metric]]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector: Callable[[], Iterable[Metric]]):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format
+        """
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for metric in collector():
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+FETCH_SECONDS = REGISTRY.register(Histogram(
+    'subway_feed_fetch_seconds', 'Upstream GTFS-RT fetch latency', ('feed', 'status')
+))
+PAYLOAD_BYTES = REGISTRY.register(Histogram(
+    'subway_feed_payload_bytes', 'Size of upstream GTFS-RT payloads', ('feed',), SIZE_BUCKETS
+))
+DECODE_SECONDS = REGISTRY.register(Histogram(
+    'subway_feed_decode_seconds', 'Protobuf parse and entity decode time', ('feed', 'stage')
+))
+SERIALIZE_SECONDS = REGISTRY.register(Histogram(
+    'subway_feed_serialize_seconds', 'Time to build an encoded response body', ('feed', 'format', 'encoding')
+))
+RESPONSE_BYTES = REGISTRY.register(Histogram(
+    'subway_feed_response_bytes', 'Size of encoded response bodies', ('feed', 'format', 'encoding'), SIZE_BUCKETS
+))
+ENCODED_CACHE = REGISTRY.register(Counter(
+    'subway_feed_encoded_cache_total', 'Encoded response body lookups by result', ('feed', 'result')
+))
+DB_INGEST_SECONDS = REGISTRY.register(Histogram(
+    'subway_feed_db_ingest_seconds', 'Time to store one feed version', ('feed', 'mode')
+))
+
+
+def observe_decode(feed_id: str, timings: Optional[Dict[str, float]]):
+    """
+    Record the stage timings a decode measured (possibly in another process)
+    """
+    for stage, seconds in (timings or {}).items():
+        DECODE_SECONDS.labels(feed_id, stage).observe(seconds)
@@ -1,36 +1,108 @@
 from google.transit import gtfs_realtime_pb2
 from google.protobuf.message import DecodeError
-import requests
+import asyncio
+import httpx
 from fastapi import HTTPException
 import logging
-from typing import Dict, List, Optional
+import os
+import time
+from sys import intern
+from typing import Dict, FrozenSet, NamedTuple, Optional
+from .decoded_feed import AlertRecord, DecodedFeed, StopTimeColumns, TripRecord, VehicleRecord
+from .metrics import FETCH_SECONDS, PAYLOAD_BYTES, observe_decode
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
 logger = logging.getLogger(__name__)
 
+# Upstream HTTP client configuration (seconds / connections)
+MTA_CONNECT_TIMEOUT = float(os.getenv("MTA_CONNECT_TIMEOUT", "5"))
+MTA_READ_TIMEOUT = float(os.getenv("MTA_READ_TIMEOUT", "10"))
+MTA_MAX_CONNECTIONS_PER_HOST = int(os.getenv("MTA_MAX_CONNECTIONS_PER_HOST", "4"))
+# Upstream feed location; point at benchmarks.fake_mta to replay recorded feeds
+MTA_FEED_BASE_URL = os.getenv(
+    "MTA_FEED_BASE_URL", "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds"
+).rstrip("/")
+
+class LineGroup(NamedTuple):
+    """
+    A line group and the upstream feed that carries it
+    """
+    feed_id: str
+    routes: Optional[FrozenSet[str]]
+
 class MTAService:
     """
     Service for handling MTA GTFS-realtime feed interactions
     """
     
-    # MTA feed URLs for different subway lines (GTFS-RT feeds)
-    FEED_URLS = {
-        "1-2-3": "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs",  # IRT feed
-        "4-5-6": "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs",  # IRT feed
-        "7": "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs",      # IRT feed
-        "A-C-E": "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-ace",  # IND feed
-        "N-Q-R-W": "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-nqrw",  # BMT feed
-        "B-D-F-M": "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-bdfm",  # IND feed
-        "L": "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-l",    # BMT Canarsie feed
-        "G": "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-g",    # IND Crosstown feed
-        "J-Z": "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-jz",  # BMT feed
-        "S": "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-si"    # Staten Island feed
+    # Upstream MTA GTFS-RT feed paths relative to MTA_FEED_BASE_URL, keyed by feed id
+    FEED_PATHS = {
+        "irt": "nyct%2Fgtfs",       # IRT feed
+        "ace": "nyct%2Fgtfs-ace",   # IND feed
+        "nqrw": "nyct%2Fgtfs-nqrw", # BMT feed
+        "bdfm": "nyct%2Fgtfs-bdfm", # IND feed
+        "l": "nyct%2Fgtfs-l",       # BMT Canarsie feed
+        "g": "nyct%2Fgtfs-g",       # IND Crosstown feed
+        "jz": "nyct%2Fgtfs-jz",     # BMT feed
+        "si": "nyct%2Fgtfs-si"      # Staten Island feed
     }
+    FEEDS = {feed_id: f"{MTA_FEED_BASE_URL}/{path}" for feed_id, path in FEED_PATHS.items()}
+    FEED_IDS = {url: feed_id for feed_id, url in FEEDS.items()}
 
-    def __init__(self):
+    # Line groups served by each feed. Groups that share a feed carry a
+    # route filter; None means the group owns every route on its feed.
+    LINE_GROUPS = {
+        "1-2-3": LineGroup("irt", frozenset({"1", "2", "3"})),
+        "4-5-6": LineGroup("irt", frozenset({"4", "5", "6", "6X"})),
+        "7": LineGroup("irt", frozenset({"7", "7X"})),
+        "A-C-E": LineGroup("ace", None),
+        "N-Q-R-W": LineGroup("nqrw", None),
+        "B-D-F-M": LineGroup("bdfm", None),
+        "L": LineGroup("l", None),
+        "G": LineGroup("g", None),
+        "J-Z": LineGroup("jz", None),
+        "S": LineGroup("si", None)
+    }
+
+    def __init__(self, client: Optional[httpx.AsyncClient] = None):
         """
         Initialize the MTA service
+        Args:
+            client: Shared HTTP client; one is created on first use if omitted
         """
-        self.feed = gtfs_realtime_pb2.FeedMessage()
+        self._client = client
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        self._validators: Dict[str, Dict[str, str]] = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """
+        Pooled keep-alive HTTP client shared by every fetch
+        """
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                timeout=httpx.Timeout(MTA_READ_TIMEOUT, connect=MTA_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=MTA_MAX_CONNECTIONS_PER_HOST * 2,
+                    max_keepalive_connections=MTA_MAX_CONNECTIONS_PER_HOST
+                ),
+                headers={'Accept': 'application/x-google-protobuf'}
+            )
+        return self._client
+
+    async def aclose(self):
+        """
+        Close the HTTP client and its pooled connections
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
     async def get_feed_data(self, line_group: str = None, data_type: str = None) -> Dict:
         """
@@ -40,210 +112,303 @@ class MTAService:
             data_type: Type of data to return (vehicle_positions, alerts, trip_updates, or None for all)
         """
         try:
-            # Get the feed URL for the requested line group
-            feed_url = self.FEED_URLS.get(line_group)
-            if not feed_url:
+            # Get the feed for the requested line group
+            group = self.LINE_GROUPS.get(line_group)
+            if not group:
                 raise HTTPException(status_code=400, detail=f"Invalid line group: {line_group}")
 
-            response = requests.get(
-                feed_url,
-                headers={'Accept': 'application/x-google-protobuf'}
-            )
-            response.raise_for_status()
-            
+            content = await self.fetch_feed(self.FEEDS[group.feed_id])
+
             try:
-                # Parse the protocol buffer
-                self.feed.ParseFromString(response.content)
-                
-                # Process based on requested data type
-                if data_type == 'vehicle_positions':
-                    return self._process_vehicle_positions(self.feed)
-                elif data_type == 'alerts':
-                    return self._process_alerts(self.feed)
-                elif data_type == 'trip_updates':
-                    return self._process_trip_updates(self.feed)
-                else:
-                    return self._process_feed_data(self.feed)
+                # Parse the protocol buffer off the event loop
+                loop = asyncio.get_running_loop()
+                decoded = await loop.run_in_executor(None, decode_feed, content)
+                observe_decode(group.feed_id, decoded.timings)
+                data = self.filter_routes(decoded.to_dict(), group.routes)
+                if data_type in ('vehicle_positions', 'alerts', 'trip_updates'):
+                    return data[data_type]
+                return data
             except DecodeError as e:
                 logger.error(f"Failed to decode GTFS-RT data: {str(e)}")
                 raise HTTPException(
                     status_code=500,
                     detail="Failed to decode GTFS-RT data from MTA feed"
                 )
-            
-        except requests.exceptions.RequestException as e:
+
+        except HTTPException:
+            raise
+        except httpx.HTTPError as e:
             logger.error(f"Error fetching MTA data: {str(e)}")
             raise HTTPException(status_code=503, detail="Unable to fetch MTA data")
         except Exception as e:
             logger.error(f"Error processing MTA data: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Error processing MTA data: {str(e)}")
 
-    def _process_feed_data(self, feed: gtfs_realtime_pb2.FeedMessage) -> Dict:
+    async def fetch_feed(self, feed_url: str, conditional: bool = False) -> Optional[bytes]:
         """
-        Process all GTFS feed data into a more usable format
+        Download the raw GTFS-RT protobuf for a feed URL without blocking
+        the event loop, limiting concurrent requests per upstream host
+        Args:
+            feed_url: Upstream feed to download
+            conditional: Send the validators from the previous response and
+                return None if the upstream answers 304 Not Modified
         """
-        return {
-            'header': {
-                'timestamp': feed.header.timestamp,
-                'version': feed.header.gtfs_realtime_version
-            },
-            'vehicle_positions': self._process_vehicle_positions(feed),
-            'alerts': self._process_alerts(feed),
-            'trip_updates': self._process_trip_updates(feed)
+        host = httpx.URL(feed_url).host
+        slots = self._host_slots.get(host)
+        if slots is None:
+            slots = self._host_slots[host] = asyncio.Semaphore(MTA_MAX_CONNECTIONS_PER_HOST)
+
+        headers = {}
+        validators = self._validators.get(feed_url, {})
+        if conditional:
+            if 'etag' in validators:
+                headers['If-None-Match'] = validators['etag']
+            if 'last-modified' in validators:
+                headers['If-Modified-Since'] = validators['last-modified']
+
+        feed_id = self.FEED_IDS.get(feed_url, host)
+        started = time.perf_counter()
+        try:
+            async with slots:
+                response = await self.client.get(feed_url, headers=headers)
+        except httpx.HTTPError:
+            FETCH_SECONDS.labels(feed_id, 'error').observe(time.perf_counter() - started)
+            raise
+        FETCH_SECONDS.labels(feed_id, str(response.status_code)).observe(time.perf_counter() - started)
+        if conditional and response.status_code == 304:
+            return None
+        response.raise_for_status()
+        PAYLOAD_BYTES.labels(feed_id).observe(len(response.content))
+
+        self._validators[feed_url] = {
+            name: response.headers[name]
+            for name in ('etag', 'last-modified')
+            if name in response.headers
         }
+        return response.content
 
-    def _process_vehicle_positions(self, feed: gtfs_realtime_pb2.FeedMessage) -> List[Dict]:
+    def parse_feed(self, content: bytes) -> gtfs_realtime_pb2.FeedMessage:
         """
-        Process only vehicle position data
+        Parse raw GTFS-RT bytes into a new feed message. Each call returns
+        a fresh message so concurrent parses never share state.
         """
-        vehicles = []
-        for entity in feed.entity:
-            if entity.HasField('vehicle'):
-                vehicle_data = self._process_vehicle(entity.vehicle)
-                if vehicle_data:
-                    vehicles.append({'id': entity.id, **vehicle_data})
-        return vehicles
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(content)
+        return feed
 
-    def _process_alerts(self, feed: gtfs_realtime_pb2.FeedMessage) -> List[Dict]:
+    def decode(self, content: bytes, last_timestamp: Optional[int] = None) -> Optional[DecodedFeed]:
         """
-        Process only alert data
+        Parse and decode raw GTFS-RT bytes into a new DecodedFeed
+        Args:
+            content: Raw protobuf bytes
+            last_timestamp: Header timestamp of the currently published
+                version; if the parsed feed matches it, None is returned
+                and processing is skipped
         """
-        alerts = []
-        for entity in feed.entity:
-            if entity.HasField('alert'):
-                alert_data = self._process_alert(entity.alert)
-                if alert_data:
-                    alerts.append({'id': entity.id, **alert_data})
-        return alerts
+        started = time.perf_counter()
+        feed = self.parse_feed(content)
+        parse_seconds = time.perf_counter() - started
+        if last_timestamp is not None and feed.header.timestamp == last_timestamp:
+            return None
+        decoded = self._decode_feed(feed)
+        decoded.timings['parse'] = parse_seconds
+        return decoded
 
-    def _process_trip_updates(self, feed: gtfs_realtime_pb2.FeedMessage) -> List[Dict]:
+    @staticmethod
+    def informed_routes(alert: Dict) -> FrozenSet[str]:
+        """
+        Routes an alert informs, directly or through a trip
         """
-        Process only trip update data
+        routes = set()
+        for entity in alert.get('informed_entity', []):
+            if 'route_id' in entity:
+                routes.add(entity['route_id'])
+            if 'trip' in entity:
+                routes.add(entity['trip']['route_id'])
+        return frozenset(routes)
+
+    @staticmethod
+    def filter_routes(data: Dict, routes: Optional[FrozenSet[str]]) -> Dict:
+        """
+        Restrict processed feed data to the given routes
+        Args:
+            data: Output of _process_feed_data
+            routes: Route ids to keep, or None to keep everything
         """
-        updates = []
+        if routes is None:
+            return data
+
+        def alert_matches(alert: Dict) -> bool:
+            alert_routes = MTAService.informed_routes(alert)
+            # Alerts without route information apply to the whole feed
+            return not alert_routes or not alert_routes.isdisjoint(routes)
+
+        return {
+            'header': data['header'],
+            'vehicle_positions': [
+                v for v in data['vehicle_positions']
+                if v.get('trip', {}).get('route_id') in routes
+            ],
+            'alerts': [a for a in data['alerts'] if alert_matches(a)],
+            'trip_updates': [t for t in data['trip_updates'] if t['route_id'] in routes]
+        }
+
+    def _process_feed_data(self, feed: gtfs_realtime_pb2.FeedMessage) -> Dict:
+        """
+        Process all GTFS feed data into a more usable format
+        """
+        return self._decode_feed(feed).to_dict()
+
+    def _decode_feed(self, feed: gtfs_realtime_pb2.FeedMessage) -> DecodedFeed:
+        """
+        Decode all GTFS feed data, classifying each entity in a single pass
+        over the feed. Entities become slotted records and stop time updates
+        go into columnar storage; the nested dict form is built lazily by
+        DecodedFeed.to_dict().
+        """
+        vehicles = []
+        alerts = []
+        trips = []
+        stop_times = StopTimeColumns()
+        # Timed once around the whole pass: per-entity clock calls cost
+        # more than the decoding of small entities
+        started = time.perf_counter()
         for entity in feed.entity:
             if entity.HasField('trip_update'):
-                trip_data = self._process_trip_update(entity.trip_update)
-                if trip_data:
-                    updates.append({'id': entity.id, **trip_data})
-        return updates
+                trip = self._process_trip_update(entity.id, entity.trip_update, stop_times)
+                if trip:
+                    trips.append(trip)
+            if entity.HasField('vehicle'):
+                vehicle = self._process_vehicle(entity.id, entity.vehicle)
+                if vehicle:
+                    vehicles.append(vehicle)
+            if entity.HasField('alert'):
+                alert = self._process_alert(entity.id, entity.alert)
+                if alert:
+                    alerts.append(alert)
+        stop_times.finish()
+        entity_seconds = time.perf_counter() - started
+
+        header = {
+            'timestamp': feed.header.timestamp,
+            'version': feed.header.gtfs_realtime_version
+        }
+        timings = {'entities': entity_seconds}
+        return DecodedFeed(header, vehicles, alerts, trips, stop_times, timings)
 
-    def _process_trip_update(self, trip_update: gtfs_realtime_pb2.TripUpdate) -> Optional[Dict]:
+    def _process_trip_update(
+        self,
+        entity_id: str,
+        trip_update: gtfs_realtime_pb2.TripUpdate,
+        stop_times: StopTimeColumns
+    ) -> Optional[TripRecord]:
         """
-        Process trip update data
+        Process trip update data. Stop time updates are appended to
+        `stop_times` under the next trip index rather than returned.
         """
         try:
             if not trip_update or not trip_update.trip:
                 return None
 
-            result = {
-                'trip_id': trip_update.trip.trip_id,
-                'route_id': trip_update.trip.route_id,
-                'start_time': trip_update.trip.start_time,
-                'start_date': trip_update.trip.start_date
-            }
-
-            # Add schedule relationship if present
-            if trip_update.trip.HasField('schedule_relationship'):
-                result['schedule_relationship'] = trip_update.trip.schedule_relationship
+            trip = trip_update.trip
+            result = TripRecord(
+                entity_id,
+                intern(trip.trip_id),
+                intern(trip.route_id),
+                intern(trip.start_time),
+                intern(trip.start_date),
+                trip.schedule_relationship if trip.HasField('schedule_relationship') else None
+            )
 
             # Process stop time updates
-            if hasattr(trip_update, 'stop_time_update'):
-                result['stop_time_updates'] = []
-                for update in trip_update.stop_time_update:
-                    stop_update = {'stop_id': update.stop_id}
-                    
-                    if update.HasField('arrival'):
-                        stop_update['arrival'] = {
-                            'time': update.arrival.time
-                        }
-                        if update.arrival.HasField('delay'):
-                            stop_update['arrival']['delay'] = update.arrival.delay
-                    
-                    if update.HasField('departure'):
-                        stop_update['departure'] = {
-                            'time': update.departure.time
-                        }
-                        if update.departure.HasField('delay'):
-                            stop_update['departure']['delay'] = update.departure.delay
-                    
-                    if update.HasField('schedule_relationship'):
-                        stop_update['schedule_relationship'] = update.schedule_relationship
-                    
-                    result['stop_time_updates'].append(stop_update)
+            stop_times.add_trip(trip_update.stop_time_update)
 
             return result
         except Exception as e:
             logger.error(f"Error processing trip update: {str(e)}")
             return None
 
-    def _process_vehicle(self, vehicle: gtfs_realtime_pb2.VehiclePosition) -> Optional[Dict]:
+    def _process_vehicle(self, entity_id: str, vehicle: gtfs_realtime_pb2.VehiclePosition) -> Optional[VehicleRecord]:
         """
         Process vehicle position data
         """
         try:
-            result = {}
-            
+            result = VehicleRecord(entity_id, *(None,) * len(VehicleRecord._fields))
+
             if vehicle.HasField('trip'):
-                result['trip'] = {
-                    'trip_id': vehicle.trip.trip_id,
-                    'route_id': vehicle.trip.route_id,
-                    'start_time': vehicle.trip.start_time,
-                    'start_date': vehicle.trip.start_date
-                }
-            
+                result.trip_id = intern(vehicle.trip.trip_id)
+                result.route_id = intern(vehicle.trip.route_id)
+                result.start_time = intern(vehicle.trip.start_time)
+                result.start_date = intern(vehicle.trip.start_date)
+
             if vehicle.HasField('position'):
-                result['position'] = {
-                    'latitude': vehicle.position.latitude,
-                    'longitude': vehicle.position.longitude,
-                    'bearing': vehicle.position.bearing if vehicle.position.HasField('bearing') else None,
-                    'speed': vehicle.position.speed if vehicle.position.HasField('speed') else None
-                }
-            
+                position = vehicle.position
+                result.latitude = position.latitude
+                result.longitude = position.longitude
+                result.bearing = position.bearing if position.HasField('bearing') else None
+                result.speed = position.speed if position.HasField('speed') else None
+
             if vehicle.HasField('current_stop_sequence'):
-                result['current_stop_sequence'] = vehicle.current_stop_sequence
-            
+                result.current_stop_sequence = vehicle.current_stop_sequence
+
             if vehicle.HasField('stop_id'):
-                result['stop_id'] = vehicle.stop_id
-            
+                result.stop_id = intern(vehicle.stop_id)
+
             if vehicle.HasField('current_status'):
-                result['current_status'] = vehicle.current_status
-            
+                result.current_status = vehicle.current_status
+
             if vehicle.HasField('timestamp'):
-                result['timestamp'] = vehicle.timestamp
+                result.timestamp = vehicle.timestamp
 
-            return result if result else None
+            if all(getattr(result, name) is None for name in VehicleRecord._fields):
+                return None
+            return result
         except Exception as e:
             logger.error(f"Error processing vehicle position: {str(e)}")
             return None
 
-    def _process_alert(self, alert: gtfs_realtime_pb2.Alert) -> Optional[Dict]:
+    def _process_alert(self, entity_id: str, alert: gtfs_realtime_pb2.Alert) -> Optional[AlertRecord]:
         """
         Process alert data
         """
         try:
-            result = {'effect': alert.effect}
-            
+            header_text = None
             if alert.header_text.translation:
-                result['header_text'] = alert.header_text.translation[0].text
-            
+                header_text = alert.header_text.translation[0].text
+
+            description_text = None
             if alert.description_text.translation:
-                result['description_text'] = alert.description_text.translation[0].text
-            
+                description_text = alert.description_text.translation[0].text
+
+            informed_entities = None
             if alert.informed_entity:
-                result['informed_entity'] = []
+                informed_entities = []
                 for entity in alert.informed_entity:
                     informed_entity = {}
                     if entity.HasField('trip'):
                         informed_entity['trip'] = {
-                            'trip_id': entity.trip.trip_id,
-                            'route_id': entity.trip.route_id
+                            'trip_id': intern(entity.trip.trip_id),
+                            'route_id': intern(entity.trip.route_id)
                         }
+                    if entity.HasField('route_id'):
+                        informed_entity['route_id'] = intern(entity.route_id)
                     if entity.HasField('stop_id'):
-                        informed_entity['stop_id'] = entity.stop_id
-                    result['informed_entity'].append(informed_entity)
+                        informed_entity['stop_id'] = intern(entity.stop_id)
+                    informed_entities.append(informed_entity)
+                informed_entities = tuple(informed_entities)
 
-            return result
+            return AlertRecord(entity_id, alert.effect, header_text, description_text, informed_entities)
         except Exception as e:
             logger.error(f"Error processing alert: {str(e)}")
-            return None 
\ No newline at end of file
+            return None
+
+
+_decoder = MTAService()
+
+
+def decode_feed(content: bytes, last_timestamp: Optional[int] = None) -> Optional[DecodedFeed]:
+    """
+    Module-level entry point for MTAService.decode, so parsing can be
+    submitted to a thread or process pool
+    """
+    return _decoder.decode(content, last_timestamp)
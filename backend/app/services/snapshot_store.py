@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from .decoded_feed import DecodedFeed
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL")
+SNAPSHOT_STORE_ENABLED = os.getenv("SNAPSHOT_STORE_ENABLED", "true").lower() == "true"
+SNAPSHOT_LOCAL_CACHE_SIZE = int(os.getenv("SNAPSHOT_LOCAL_CACHE_SIZE", "16"))
+SNAPSHOT_TTL = int(os.getenv("SNAPSHOT_TTL", "600"))
+INGEST_LEADER_TTL = int(os.getenv("INGEST_LEADER_TTL", "90"))
+
+KEY_PREFIX = "subway"
+
+# Extend the ingest lease only while this worker still holds it, in one
+# atomic step so a lease that expired and was taken over is left alone
+RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class RedisSnapshotStore:
+    """
+    Shares decoded feed snapshots between API workers through Redis.
+
+    One worker at a time holds the ingest leadership lock, fetches the MTA
+    feeds and publishes each version under subway:snapshot:<feed>:<timestamp>
+    along with a subway:snapshot:<feed>:latest pointer. Every other worker
+    reads snapshots from Redis instead of fetching and parsing them, keeping
+    a small local LRU of deserialized versions. Versions carry the raw
+    upstream payload next to the decoded feed. Versions are stored as
+    msgpack of the feed's records and raw column arrays, so reading one
+    cannot run code whatever was written to Redis.
+    """
+
+    def __init__(self, redis, local_cache_size: int = SNAPSHOT_LOCAL_CACHE_SIZE):
+        self.redis = redis
+        self.token = uuid.uuid4().hex
+        self.local_cache_size = local_cache_size
+        self._local: "OrderedDict[Tuple[str, int], Tuple[DecodedFeed, Optional[bytes]]]" = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> Optional["RedisSnapshotStore"]:
+        """
+        Store configured from REDIS_URL, or None when Redis is not configured
+        """
+        if not REDIS_URL or not SNAPSHOT_STORE_ENABLED:
+            return None
+        if msgpack is None:
+            logger.warning("msgpack is not installed, snapshot store disabled")
+            return None
+        from redis import asyncio as redis_asyncio
+        return cls(redis_asyncio.from_url(REDIS_URL))
+
+    async def close(self):
+        """
+        Close the Redis connection pool
+        """
+        await self.redis.close()
+
+    async def is_leader(self) -> bool:
+        """
+        Acquire or renew the ingest leadership lock. Returns True if this
+        worker should fetch from the MTA.
+        """
+        key = f"{KEY_PREFIX}:ingest:leader"
+        if await self.redis.set(key, self.token, nx=True, ex=INGEST_LEADER_TTL):
+            return True
+        renewed = await self.redis.eval(RENEW_LEASE_SCRIPT, 1, key, self.token, INGEST_LEADER_TTL)
+        return bool(renewed)
+
+    async def publish(
+        self,
+        feed_id: str,
+        decoded: DecodedFeed,
+        fetched_at: float,
+        new_version: bool = True,
+        content: Optional[bytes] = None
+    ):
+        """
+        Publish a feed version, or only refresh its fetch time when the
+        leader revalidated an unchanged feed
+        """
+        timestamp = decoded.header['timestamp']
+        if new_version:
+            version = (decoded, content)
+            payload = zlib.compress(msgpack.packb(
+                {'decoded': decoded.to_primitive(), 'content': content}, use_bin_type=True
+            ))
+            await self.redis.set(f"{KEY_PREFIX}:snapshot:{feed_id}:{timestamp}", payload, ex=SNAPSHOT_TTL)
+            self._remember(feed_id, timestamp, version)
+        pointer = json.dumps({'timestamp': timestamp, 'fetched_at': fetched_at})
+        await self.redis.set(f"{KEY_PREFIX}:snapshot:{feed_id}:latest", pointer, ex=SNAPSHOT_TTL)
+
+    async def latest(self, feed_id: str) -> Optional[Tuple[DecodedFeed, Optional[bytes], float]]:
+        """
+        Latest published version of a feed, its raw payload and the time
+        the leader last confirmed it, or None if nothing has been published
+        """
+        pointer = await self.redis.get(f"{KEY_PREFIX}:snapshot:{feed_id}:latest")
+        if pointer is None:
+            return None
+        pointer = json.loads(pointer)
+        timestamp = pointer['timestamp']
+
+        key = (feed_id, timestamp)
+        version = self._local.get(key)
+        if version is not None:
+            self._local.move_to_end(key)
+        else:
+            payload = await self.redis.get(f"{KEY_PREFIX}:snapshot:{feed_id}:{timestamp}")
+            if payload is None:
+                return None
+            try:
+                state = msgpack.unpackb(zlib.decompress(payload))
+                version = (DecodedFeed.from_primitive(state['decoded']), state['content'])
+            except Exception as e:
+                logger.error(f"Discarding unreadable snapshot {feed_id}:{timestamp}: {str(e)}")
+                return None
+            self._remember(feed_id, timestamp, version)
+        decoded, content = version
+        return decoded, content, pointer['fetched_at']
+
+    def _remember(self, feed_id: str, timestamp: int, version: Tuple[DecodedFeed, Optional[bytes]]):
+        """
+        Add a version to the local LRU
+        """
+        self._local[(feed_id, timestamp)] = version
+        self._local.move_to_end((feed_id, timestamp))
+        while len(self._local) > self.local_cache_size:
+            self._local.popitem(last=False)
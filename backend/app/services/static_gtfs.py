@@ -0,0 +1,545 @@
+"""
+Static GTFS schedule index.
+
+The MTA static GTFS zip (stops.txt, routes.txt, trips.txt, stop_times.txt,
+calendar.txt, calendar_dates.txt) is compiled offline into a single binary
+file of interned strings and sorted fixed-width columns:
+
+    python -m app.services.static_gtfs google_transit.zip gtfs_static.idx
+
+At startup the file is memory-mapped read-only and its columns are exposed
+as memoryviews, so opening it costs no parsing or copying and every worker
+process shares the same page cache pages.
+"""
+import csv
+import io
+import logging
+import mmap
+import os
+import struct
+import sys
+import zipfile
+from array import array
+from datetime import date, datetime, time as dt_time
+from typing import Dict, Iterator, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+STATIC_GTFS_PATH = os.getenv("STATIC_GTFS_PATH", "data/gtfs_static.idx")
+STATIC_GTFS_TIMEZONE = os.getenv("STATIC_GTFS_TIMEZONE", "America/New_York")
+
+MAGIC = b"GTFSIDX\x01"
+HEADER = struct.Struct("<8sII")
+SECTION = struct.Struct("<24sQQc7x")
+ALIGNMENT = 8
+
+# String index used for missing optional values
+NO_STRING = 0xFFFFFFFF
+# Scheduled time used for stop times without one
+NO_TIME = -2 ** 31
+
+# calendar.txt weekday columns, in datetime.weekday() order
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+EXCEPTION_ADDED = 1
+EXCEPTION_REMOVED = 2
+
+
+def realtime_trip_key(trip_id: str) -> str:
+    """
+    Realtime form of a static trip id. MTA static trip ids prefix the
+    realtime id with the schedule and service, e.g.
+    "AFA23GEN-1038-Weekday-00_000650_1..N03R" for "000650_1..N03R".
+    """
+    return trip_id.split("_", 1)[1] if "_" in trip_id else trip_id
+
+
+def _parse_time(value: str) -> int:
+    """
+    Seconds since the start of the service day of a GTFS HH:MM:SS time,
+    which may be past 24:00:00
+    """
+    if not value:
+        return NO_TIME
+    hours, minutes, seconds = value.strip().split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+class _Strings:
+    """
+    Interning table for the compiler
+    """
+
+    def __init__(self):
+        self.index: Dict[str, int] = {}
+        self.offsets = array("I", [0])
+        self.data = bytearray()
+
+    def __call__(self, value: Optional[str]) -> int:
+        if value is None or value == "":
+            return NO_STRING
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.offsets) - 1
+            self.data += value.encode()
+            self.offsets.append(len(self.data))
+        return code
+
+
+def _read_csv(archive: zipfile.ZipFile, name: str) -> Iterator[Dict[str, str]]:
+    """
+    Rows of a GTFS table, or nothing if the archive does not have it
+    """
+    if name not in archive.namelist():
+        return iter(())
+    return csv.DictReader(io.TextIOWrapper(archive.open(name), encoding="utf-8-sig"))
+
+
+def _columns(rows: List[Tuple], typecodes: str) -> List[array]:
+    """
+    Transpose rows into typed arrays
+    """
+    return [array(typecode, (row[i] for row in rows)) for i, typecode in enumerate(typecodes)]
+
+
+def compile_gtfs(source: str, target: str) -> Dict[str, int]:
+    """
+    Compile a static GTFS zip into a binary index file
+    Args:
+        source: Path of the GTFS zip
+        target: Path of the index file to write
+    Returns:
+        Number of stops, routes, trips and stop times compiled
+    """
+    strings = _Strings()
+    sort_key = lambda row: strings.data[strings.offsets[row[0]]:strings.offsets[row[0] + 1]]
+
+    with zipfile.ZipFile(source) as archive:
+        stops = sorted((
+            (
+                strings(row["stop_id"]),
+                strings(row.get("stop_name")),
+                strings(row.get("parent_station")),
+                float(row.get("stop_lat") or 0),
+                float(row.get("stop_lon") or 0)
+            )
+            for row in _read_csv(archive, "stops.txt")
+        ), key=sort_key)
+
+        routes = sorted((
+            (
+                strings(row["route_id"]),
+                strings(row.get("route_short_name")),
+                strings(row.get("route_long_name")),
+                strings(row.get("route_color"))
+            )
+            for row in _read_csv(archive, "routes.txt")
+        ), key=sort_key)
+
+        services: Dict[str, Tuple] = {}
+        for row in _read_csv(archive, "calendar.txt"):
+            days = sum(1 << i for i, day in enumerate(WEEKDAYS) if row.get(day) == "1")
+            services[row["service_id"]] = (days, int(row["start_date"]), int(row["end_date"]))
+        exceptions: Dict[str, List[Tuple[int, int]]] = {}
+        for row in _read_csv(archive, "calendar_dates.txt"):
+            services.setdefault(row["service_id"], (0, 0, 0))
+            exceptions.setdefault(row["service_id"], []).append((int(row["date"]), int(row["exception_type"])))
+        service_ids = sorted(services)
+        service_index = {service_id: i for i, service_id in enumerate(service_ids)}
+
+        trips = sorted((
+            (
+                strings(realtime_trip_key(row["trip_id"])),
+                strings(row["trip_id"]),
+                strings(row["route_id"]),
+                strings(row.get("trip_headsign")),
+                service_index.get(row.get("service_id"), NO_STRING)
+            )
+            for row in _read_csv(archive, "trips.txt")
+        ), key=lambda row: (sort_key(row), row[1]))
+        trip_position = {trip[1]: i for i, trip in enumerate(trips)}
+
+        st_trip, st_sequence = array("I"), array("I")
+        st_stop, st_arrival, st_departure = array("I"), array("i"), array("i")
+        for row in _read_csv(archive, "stop_times.txt"):
+            position = trip_position.get(strings.index.get(row["trip_id"]))
+            if position is None:
+                continue
+            st_trip.append(position)
+            st_sequence.append(int(row["stop_sequence"]))
+            st_stop.append(strings(row["stop_id"]))
+            st_arrival.append(_parse_time(row.get("arrival_time")))
+            st_departure.append(_parse_time(row.get("departure_time")))
+
+    order = sorted(range(len(st_trip)), key=lambda i: (st_trip[i], st_sequence[i]))
+    trip_stop_offsets = array("I", [0] * (len(trips) + 1))
+    for i in order:
+        trip_stop_offsets[st_trip[i] + 1] += 1
+    for i in range(len(trips)):
+        trip_stop_offsets[i + 1] += trip_stop_offsets[i]
+
+    exception_offsets, exception_date, exception_type = array("I", [0]), array("I"), array("B")
+    for service_id in service_ids:
+        for day, kind in sorted(exceptions.get(service_id, [])):
+            exception_date.append(day)
+            exception_type.append(kind)
+        exception_offsets.append(len(exception_date))
+
+    stop_id, stop_name, stop_parent, stop_lat, stop_lon = _columns(stops, "IIIff")
+    route_id, route_short_name, route_long_name, route_color = _columns(routes, "IIII")
+    trip_key, trip_id, trip_route, trip_headsign, trip_service = _columns(trips, "IIIII")
+    service_rows = [(strings(service_id), *services[service_id]) for service_id in service_ids]
+    service_id, service_days, service_start, service_end = _columns(service_rows, "IBII")
+
+    sections = {
+        "string_offsets": strings.offsets,
+        "string_data": array("B", bytes(strings.data)),
+        "stop_id": stop_id, "stop_name": stop_name, "stop_parent": stop_parent,
+        "stop_lat": stop_lat, "stop_lon": stop_lon,
+        "route_id": route_id, "route_short_name": route_short_name,
+        "route_long_name": route_long_name, "route_color": route_color,
+        "service_id": service_id, "service_days": service_days,
+        "service_start": service_start, "service_end": service_end,
+        "exception_offsets": exception_offsets, "exception_date": exception_date,
+        "exception_type": exception_type,
+        "trip_key": trip_key, "trip_id": trip_id, "trip_route": trip_route,
+        "trip_headsign": trip_headsign, "trip_service": trip_service,
+        "trip_stop_offsets": trip_stop_offsets,
+        "st_stop": array("I", (st_stop[i] for i in order)),
+        "st_arrival": array("i", (st_arrival[i] for i in order)),
+        "st_departure": array("i", (st_departure[i] for i in order)),
+    }
+    _write_sections(target, sections)
+    return {"stops": len(stops), "routes": len(routes), "trips": len(trips), "stop_times": len(order)}
+
+
+def _write_sections(target: str, sections: Dict[str, array]):
+    """
+    Write named arrays as aligned little-endian sections behind a table
+    of contents
+    """
+    offset = HEADER.size + SECTION.size * len(sections)
+    table, payloads = [], []
+    for name, column in sections.items():
+        assert len(name) <= 24, name
+        if sys.byteorder != "little":
+            column = array(column.typecode, column)
+            column.byteswap()
+        offset += -offset % ALIGNMENT
+        payload = column.tobytes()
+        table.append(SECTION.pack(name.encode(), offset, len(payload), column.typecode.encode()))
+        payloads.append((offset, payload))
+        offset += len(payload)
+
+    temporary = f"{target}.tmp"
+    with open(temporary, "wb") as out:
+        out.write(HEADER.pack(MAGIC, len(sections), 0))
+        for entry in table:
+            out.write(entry)
+        for offset, payload in payloads:
+            out.write(b"\0" * (offset - out.tell()))
+            out.write(payload)
+    os.replace(temporary, target)
+
+
+class StaticGTFS:
+    """
+    Read-only lookups over a memory-mapped static GTFS index. Columns are
+    memoryviews into the mapping; only small caches of resolved ids live
+    on the Python heap.
+    """
+
+    def __init__(self, path: str, timezone: str = STATIC_GTFS_TIMEZONE):
+        if sys.byteorder != "little":
+            raise RuntimeError("Static GTFS indexes are only supported on little-endian hosts")
+        self.path = path
+        self.timezone = ZoneInfo(timezone)
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffer = memoryview(self._mmap)
+
+        magic, count, _ = HEADER.unpack_from(self._buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a static GTFS index")
+        self._columns: Dict[str, memoryview] = {}
+        for i in range(count):
+            name, offset, length, typecode = SECTION.unpack_from(self._buffer, HEADER.size + i * SECTION.size)
+            self._columns[name.rstrip(b"\0").decode()] = self._buffer[offset:offset + length].cast(typecode.decode())
+
+        self._strings = self._columns["string_data"]
+        self._string_offsets = self._columns["string_offsets"]
+        self._stop_cache: Dict[str, Optional[int]] = {}
+        self._trip_cache: Dict[Tuple[str, Optional[str]], Optional[int]] = {}
+
+    @classmethod
+    def from_env(cls) -> Optional["StaticGTFS"]:
+        """
+        Index at STATIC_GTFS_PATH, or None when it has not been compiled
+        """
+        if not STATIC_GTFS_PATH or not os.path.exists(STATIC_GTFS_PATH):
+            return None
+        try:
+            return cls(STATIC_GTFS_PATH)
+        except Exception as e:
+            logger.error(f"Unable to open static GTFS index {STATIC_GTFS_PATH}: {str(e)}")
+            return None
+
+    def close(self):
+        """
+        Release the memory mapping
+        """
+        self._columns.clear()
+        self._strings = self._string_offsets = None
+        self._buffer.release()
+        self._mmap.close()
+
+    def __len__(self) -> int:
+        return len(self._columns["trip_key"])
+
+    def string(self, code: int) -> Optional[str]:
+        """
+        Interned string for a code
+        """
+        if code == NO_STRING:
+            return None
+        return str(self._strings[self._string_offsets[code]:self._string_offsets[code + 1]], "utf-8")
+
+    def _string_bytes(self, code: int) -> bytes:
+        return self._strings[self._string_offsets[code]:self._string_offsets[code + 1]].tobytes()
+
+    def _lower_bound(self, column: str, key: str) -> int:
+        """
+        First row of a string-sorted column not less than a key
+        """
+        codes = self._columns[column]
+        target = key.encode()
+        low, high = 0, len(codes)
+        while low < high:
+            mid = (low + high) // 2
+            if self._string_bytes(codes[mid]) < target:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _find(self, column: str, key: str) -> Optional[int]:
+        row = self._lower_bound(column, key)
+        codes = self._columns[column]
+        if row < len(codes) and self.string(codes[row]) == key:
+            return row
+        return None
+
+    def stop_row(self, stop_id: str) -> Optional[int]:
+        """
+        Row of a stop in the stops table
+        """
+        if stop_id not in self._stop_cache:
+            self._stop_cache[stop_id] = self._find("stop_id", stop_id)
+        return self._stop_cache[stop_id]
+
+    def stop(self, stop_id: str) -> Optional[Dict]:
+        """
+        Name, location and parent station of a stop
+        """
+        row = self.stop_row(stop_id)
+        if row is None:
+            return None
+        columns = self._columns
+        return {
+            'stop_id': stop_id,
+            'name': self.string(columns["stop_name"][row]),
+            'parent_station': self.string(columns["stop_parent"][row]),
+            'latitude': columns["stop_lat"][row],
+            'longitude': columns["stop_lon"][row]
+        }
+
+    def stop_name(self, stop_id: str) -> Optional[str]:
+        """
+        Name of a stop, if it is in the schedule
+        """
+        row = self.stop_row(stop_id)
+        return self.string(self._columns["stop_name"][row]) if row is not None else None
+
+    def route(self, route_id: str) -> Optional[Dict]:
+        """
+        Names and color of a route
+        """
+        row = self._find("route_id", route_id)
+        if row is None:
+            return None
+        columns = self._columns
+        return {
+            'route_id': route_id,
+            'short_name': self.string(columns["route_short_name"][row]),
+            'long_name': self.string(columns["route_long_name"][row]),
+            'color': self.string(columns["route_color"][row])
+        }
+
+    def service_runs(self, service: int, service_date: int) -> bool:
+        """
+        Whether a service operates on a YYYYMMDD date
+        """
+        columns = self._columns
+        offsets = columns["exception_offsets"]
+        for i in range(offsets[service], offsets[service + 1]):
+            if columns["exception_date"][i] == service_date:
+                return columns["exception_type"][i] == EXCEPTION_ADDED
+        if not columns["service_start"][service] <= service_date <= columns["service_end"][service]:
+            return False
+        weekday = date(service_date // 10000, service_date // 100 % 100, service_date % 100).weekday()
+        return bool(columns["service_days"][service] & (1 << weekday))
+
+    def find_trip(self, trip_id: str, start_date: Optional[str] = None) -> Optional[int]:
+        """
+        Scheduled trip matching a realtime trip id. Several services
+        (weekday, Saturday, Sunday) share a realtime id; the one running on
+        the trip's start date wins.
+        Args:
+            trip_id: Realtime trip id
+            start_date: Realtime trip start date (YYYYMMDD)
+        """
+        cache_key = (trip_id, start_date)
+        if cache_key in self._trip_cache:
+            return self._trip_cache[cache_key]
+
+        keys = self._columns["trip_key"]
+        row = self._lower_bound("trip_key", trip_id)
+        candidates = []
+        while row < len(keys) and self.string(keys[row]) == trip_id:
+            candidates.append(row)
+            row += 1
+
+        match = candidates[0] if candidates else None
+        if start_date and len(candidates) > 1:
+            try:
+                day = int(start_date)
+            except ValueError:
+                # Not a YYYYMMDD date, so the running service is unknown
+                return None
+            services = self._columns["trip_service"]
+            for candidate in candidates:
+                service = services[candidate]
+                if service != NO_STRING and self.service_runs(service, day):
+                    match = candidate
+                    break
+
+        if len(self._trip_cache) > 100000:
+            self._trip_cache.clear()
+        self._trip_cache[cache_key] = match
+        return match
+
+    def trip(self, row: int) -> Dict:
+        """
+        Static description of a trip row
+        """
+        columns = self._columns
+        return {
+            'trip_id': self.string(columns["trip_id"][row]),
+            'route_id': self.string(columns["trip_route"][row]),
+            'headsign': self.string(columns["trip_headsign"][row])
+        }
+
+    def headsign(self, row: int) -> Optional[str]:
+        return self.string(self._columns["trip_headsign"][row])
+
+    def service_day_start(self, service_date: str) -> int:
+        """
+        POSIX time GTFS schedule times of a service date count from: noon
+        local time minus 12 hours
+        """
+        day = datetime.strptime(service_date, "%Y%m%d").date()
+        noon = datetime.combine(day, dt_time(12), tzinfo=self.timezone)
+        return int(noon.timestamp()) - 12 * 3600
+
+    def trip_schedule(self, row: int) -> Dict[str, int]:
+        """
+        Scheduled arrival (or departure) of a trip at each of its stops, in
+        seconds from the start of the service day
+        """
+        columns = self._columns
+        offsets = columns["trip_stop_offsets"]
+        stops, arrivals, departures = columns["st_stop"], columns["st_arrival"], columns["st_departure"]
+        schedule = {}
+        for i in range(offsets[row], offsets[row + 1]):
+            seconds = arrivals[i] if arrivals[i] != NO_TIME else departures[i]
+            if seconds != NO_TIME:
+                schedule[self.string(stops[i])] = seconds
+        return schedule
+
+    def scheduled_time(self, row: int, stop_id: str, service_date: str) -> Optional[int]:
+        """
+        Scheduled arrival (or departure) of a trip at a stop as POSIX time
+        """
+        seconds = self.trip_schedule(row).get(stop_id)
+        return self.service_day_start(service_date) + seconds if seconds is not None else None
+
+    def enrich(self, data: Dict) -> Dict:
+        """
+        Copy of processed feed data with stop names, trip headsigns and
+        scheduled times and delays joined in from the schedule
+        Args:
+            data: Output of _process_feed_data or FeedSnapshot.view
+        """
+        today = datetime.now(self.timezone).strftime("%Y%m%d")
+        day_starts: Dict[str, int] = {}
+        stop_names: Dict[str, Optional[str]] = {}
+
+        def stop_name(stop_id: str) -> Optional[str]:
+            if stop_id not in stop_names:
+                stop_names[stop_id] = self.stop_name(stop_id)
+            return stop_names[stop_id]
+
+        def enrich_trip(trip: Dict) -> Dict:
+            service_date = trip.get('start_date') or today
+            row = self.find_trip(trip['trip_id'], service_date)
+            enriched = dict(trip)
+            schedule: Dict[str, int] = {}
+            if row is not None:
+                enriched['headsign'] = self.headsign(row)
+                schedule = self.trip_schedule(row)
+                if service_date not in day_starts:
+                    day_starts[service_date] = self.service_day_start(service_date)
+            updates = []
+            for update in trip.get('stop_time_updates', []):
+                update = dict(update)
+                name = stop_name(update['stop_id'])
+                if name is not None:
+                    update['stop_name'] = name
+                seconds = schedule.get(update['stop_id'])
+                if seconds is not None:
+                    scheduled = update['scheduled_time'] = day_starts[service_date] + seconds
+                    event = update.get('arrival') or update.get('departure')
+                    if event:
+                        update['schedule_delay'] = event['time'] - scheduled
+                updates.append(update)
+            if 'stop_time_updates' in trip:
+                enriched['stop_time_updates'] = updates
+            return enriched
+
+        def enrich_vehicle(vehicle: Dict) -> Dict:
+            name = stop_name(vehicle['stop_id']) if vehicle.get('stop_id') else None
+            return {**vehicle, 'stop_name': name} if name is not None else vehicle
+
+        return {
+            **data,
+            'trip_updates': [enrich_trip(trip) for trip in data['trip_updates']],
+            'vehicle_positions': [enrich_vehicle(vehicle) for vehicle in data['vehicle_positions']]
+        }
+
+
+static_gtfs = StaticGTFS.from_env()
+
+
+def get_static_gtfs() -> Optional[StaticGTFS]:
+    """
+    Get the application-wide static schedule, if one is installed
+    """
+    return static_gtfs
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 3:
+        sys.exit("usage: python -m app.services.static_gtfs <gtfs.zip> <index file>")
+    counts = compile_gtfs(sys.argv[1], sys.argv[2])
+    logger.info(f"Compiled {sys.argv[1]} into {sys.argv[2]}: {counts}")
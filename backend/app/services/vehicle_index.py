@@ -0,0 +1,156 @@
+import math
+import os
+from array import array
+from typing import Dict, FrozenSet, Iterator, List, Optional, Tuple
+
+from .feed_poller import FeedSnapshot
+from .static_gtfs import get_static_gtfs
+
+# Grid cell size in degrees; 0.01 is roughly 1.1 km north-south and 0.85 km
+# east-west at New York's latitude
+VEHICLE_GRID_CELL = float(os.getenv("VEHICLE_GRID_CELL", "0.01"))
+
+# (min_latitude, min_longitude, max_latitude, max_longitude)
+BoundingBox = Tuple[float, float, float, float]
+
+
+class FeedVehicles:
+    """
+    Per-snapshot uniform grid over the feed's vehicle positions. Vehicles
+    that report no position are placed at their current stop when the
+    static schedule is installed, and left out otherwise.
+    """
+
+    __slots__ = ('snapshot', 'cell', 'rows', 'latitudes', 'longitudes', 'routes', 'located_at_stop', 'grid', '_dicts')
+
+    def __init__(self, snapshot: FeedSnapshot, cell: float = VEHICLE_GRID_CELL):
+        self.snapshot = snapshot
+        self.cell = cell
+        self.rows = array('I')
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.routes: List[Optional[str]] = []
+        self.located_at_stop: Dict[int, bool] = {}
+        self.grid: Dict[Tuple[int, int], array] = {}
+        self._dicts: Dict[int, Dict] = {}
+
+        static = get_static_gtfs()
+        for row, vehicle in enumerate(snapshot.decoded.vehicle_positions):
+            latitude, longitude = vehicle.latitude, vehicle.longitude
+            if latitude is None and static is not None and vehicle.stop_id:
+                stop = static.stop(vehicle.stop_id)
+                if stop is not None:
+                    latitude, longitude = stop['latitude'], stop['longitude']
+                    self.located_at_stop[row] = True
+            if latitude is None or longitude is None or (latitude == 0 and longitude == 0):
+                continue
+            index = len(self.rows)
+            self.rows.append(row)
+            self.latitudes.append(latitude)
+            self.longitudes.append(longitude)
+            self.routes.append(vehicle.route_id)
+            key = (math.floor(latitude / cell), math.floor(longitude / cell))
+            bucket = self.grid.get(key)
+            if bucket is None:
+                bucket = self.grid[key] = array('I')
+            bucket.append(index)
+
+    def _cells(self, bbox: BoundingBox) -> Iterator[array]:
+        """
+        Buckets of the grid cells overlapping a bounding box
+        """
+        min_lat, min_lon, max_lat, max_lon = bbox
+        cell = self.cell
+        lat_range = range(math.floor(min_lat / cell), math.floor(max_lat / cell) + 1)
+        lon_range = range(math.floor(min_lon / cell), math.floor(max_lon / cell) + 1)
+        if len(lat_range) * len(lon_range) > len(self.grid):
+            # Box wider than the occupied grid: scan occupied cells instead
+            return (
+                bucket for (lat_cell, lon_cell), bucket in self.grid.items()
+                if lat_cell in lat_range and lon_cell in lon_range
+            )
+        grid = self.grid
+        return (grid[key] for key in ((i, j) for i in lat_range for j in lon_range) if key in grid)
+
+    def within(self, bbox: BoundingBox, routes: Optional[FrozenSet[str]] = None) -> Iterator[int]:
+        """
+        Grid indexes of the vehicles inside a bounding box, optionally
+        restricted to some routes
+        """
+        min_lat, min_lon, max_lat, max_lon = bbox
+        latitudes, longitudes, vehicle_routes = self.latitudes, self.longitudes, self.routes
+        for bucket in self._cells(bbox):
+            for index in bucket:
+                if (
+                    min_lat <= latitudes[index] <= max_lat
+                    and min_lon <= longitudes[index] <= max_lon
+                    and (routes is None or vehicle_routes[index] in routes)
+                ):
+                    yield index
+
+    def vehicle(self, index: int) -> Dict:
+        """
+        JSON form of an indexed vehicle, built once per snapshot
+        """
+        vehicle = self._dicts.get(index)
+        if vehicle is None:
+            row = self.rows[index]
+            vehicle = self.snapshot.decoded.vehicle_positions[row].to_dict()
+            if row in self.located_at_stop:
+                vehicle['position'] = {
+                    'latitude': self.latitudes[index],
+                    'longitude': self.longitudes[index],
+                    'bearing': None,
+                    'speed': None
+                }
+                vehicle['position_source'] = 'stop'
+            self._dicts[index] = vehicle
+        return vehicle
+
+
+class VehicleIndex:
+    """
+    Current vehicle positions across every feed by location. Each feed's
+    grid is rebuilt only when that feed publishes a new snapshot.
+    """
+
+    def __init__(self, cell: float = VEHICLE_GRID_CELL):
+        self.cell = cell
+        self._feeds: Dict[str, FeedVehicles] = {}
+
+    def update(self, snapshot: FeedSnapshot, previous: Optional[FeedSnapshot] = None):
+        """
+        Replace the index for the snapshot's feed
+        """
+        self._feeds[snapshot.feed_id] = FeedVehicles(snapshot, self.cell)
+
+    def within(
+        self,
+        bbox: BoundingBox,
+        routes: Optional[FrozenSet[str]] = None,
+        limit: Optional[int] = None
+    ) -> List[Dict]:
+        """
+        Vehicles inside a bounding box across all feeds
+        Args:
+            bbox: (min_latitude, min_longitude, max_latitude, max_longitude)
+            routes: Optional route ids to restrict the result to
+            limit: Maximum number of vehicles to return
+        """
+        vehicles = []
+        for feed in list(self._feeds.values()):
+            for index in feed.within(bbox, routes):
+                if limit is not None and len(vehicles) >= limit:
+                    return vehicles
+                vehicles.append(feed.vehicle(index))
+        return vehicles
+
+
+vehicle_index = VehicleIndex()
+
+
+def get_vehicle_index() -> VehicleIndex:
+    """
+    Get the application-wide vehicle index
+    """
+    return vehicle_index
@@ -0,0 +1,3 @@
+"""
+Performance benchmarks for the subway feed pipeline
+"""
@@ -0,0 +1,75 @@
+"""
+Compare per-entity, bulk and change-only ingestion of consecutive feed
+versions.
+
+    python -m benchmarks.bench_db_ingest [database_url]
+
+Defaults to an in-memory SQLite database; pass a postgresql+asyncpg://
+URL to measure against a local Postgres.
+"""
+import asyncio
+import sys
+import time
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from app.models.base import Base
+from app.models.subway import StopTimeUpdate, Trip, VehiclePosition
+from app.services.db_service import DBService
+from app.services.feed_diff import diff_feeds
+from app.services.mta_service import MTAService
+from benchmarks.feed_fixtures import advance_feed, build_feed
+
+
+async def run(database_url: str = "sqlite+aiosqlite://"):
+    """
+    Ingest a feed and then its next version (insert, then update) with
+    each strategy
+    """
+    service = MTAService()
+    feed = build_feed()
+    versions = [service._decode_feed(feed), service._decode_feed(advance_feed(feed))]
+    data = versions[0].to_dict()
+    changes = diff_feeds(*versions)
+    rows = (
+        len(data['trip_updates'])
+        + sum(len(trip['stop_time_updates']) for trip in data['trip_updates'])
+        + len(data['vehicle_positions'])
+        + len(data['alerts'])
+    )
+    print(f"\nFeed: {len(data['trip_updates'])} trips, {len(data['vehicle_positions'])} vehicles, {rows} rows")
+    print(f"Next version: {len(changes)} changed rows")
+
+    strategies = (
+        ("per-entity", DBService.store_feed_data, DBService.store_feed_data, versions[1].to_dict()),
+        ("bulk", DBService.bulk_store_feed_data, DBService.bulk_store_feed_data, versions[1].to_dict()),
+        ("changes", DBService.bulk_store_feed_data, DBService.apply_feed_changes, changes),
+    )
+    for label, insert, update, next_version in strategies:
+        engine = create_async_engine(database_url, poolclass=StaticPool)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+
+        async with sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)() as session:
+            service = DBService(session)
+            for phase, method, argument in (("insert", insert, data), ("update", update, next_version)):
+                started = time.perf_counter()
+                await method(service, argument)
+                elapsed = time.perf_counter() - started
+                print(f"  {label:<11} {phase:<7} {elapsed * 1000:9.1f} ms  {rows / elapsed:10.0f} rows/s")
+
+            counts = [
+                (await session.execute(select(func.count()).select_from(model))).scalar()
+                for model in (Trip, StopTimeUpdate, VehiclePosition)
+            ]
+            print(f"  {label:<11} stored trips/stop updates/vehicles: {counts}")
+
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(*sys.argv[1:2]))
@@ -0,0 +1,165 @@
+"""
+Compare the single-pass columnar feed decoder against the original
+three-pass dict implementation.
+
+    python -m benchmarks.bench_decode [feed_id] [repeat]
+"""
+import sys
+import timeit
+import tracemalloc
+from typing import Dict, Optional
+from google.transit import gtfs_realtime_pb2
+from app.services.mta_service import MTAService
+from benchmarks.feed_fixtures import load_feed_payloads
+
+
+class ThreePassMTAService(MTAService):
+    """
+    Frozen copy of the original decoder: one full walk over feed.entity per
+    output section and repeated sub-message lookups per stop time update.
+    Informed entities also carry their route_id, as added since, so both
+    decoders produce the same output.
+    """
+
+    def _process_feed_data(self, feed: gtfs_realtime_pb2.FeedMessage) -> Dict:
+        return {
+            'header': {
+                'timestamp': feed.header.timestamp,
+                'version': feed.header.gtfs_realtime_version
+            },
+            'vehicle_positions': [
+                {'id': entity.id, **vehicle}
+                for entity in feed.entity
+                if entity.HasField('vehicle')
+                for vehicle in [self._legacy_vehicle(entity.vehicle)]
+                if vehicle
+            ],
+            'alerts': [
+                {'id': entity.id, **self._legacy_alert(entity.alert)}
+                for entity in feed.entity
+                if entity.HasField('alert')
+            ],
+            'trip_updates': [
+                {'id': entity.id, **self._legacy_trip_update(entity.trip_update)}
+                for entity in feed.entity
+                if entity.HasField('trip_update')
+            ]
+        }
+
+    def _legacy_vehicle(self, vehicle: gtfs_realtime_pb2.VehiclePosition) -> Optional[Dict]:
+        result = {}
+        if vehicle.HasField('trip'):
+            result['trip'] = {
+                'trip_id': vehicle.trip.trip_id,
+                'route_id': vehicle.trip.route_id,
+                'start_time': vehicle.trip.start_time,
+                'start_date': vehicle.trip.start_date
+            }
+        if vehicle.HasField('position'):
+            result['position'] = {
+                'latitude': vehicle.position.latitude,
+                'longitude': vehicle.position.longitude,
+                'bearing': vehicle.position.bearing if vehicle.position.HasField('bearing') else None,
+                'speed': vehicle.position.speed if vehicle.position.HasField('speed') else None
+            }
+        if vehicle.HasField('current_stop_sequence'):
+            result['current_stop_sequence'] = vehicle.current_stop_sequence
+        if vehicle.HasField('stop_id'):
+            result['stop_id'] = vehicle.stop_id
+        if vehicle.HasField('current_status'):
+            result['current_status'] = vehicle.current_status
+        if vehicle.HasField('timestamp'):
+            result['timestamp'] = vehicle.timestamp
+        return result if result else None
+
+    def _legacy_alert(self, alert: gtfs_realtime_pb2.Alert) -> Dict:
+        result = {'effect': alert.effect}
+        if alert.header_text.translation:
+            result['header_text'] = alert.header_text.translation[0].text
+        if alert.description_text.translation:
+            result['description_text'] = alert.description_text.translation[0].text
+        if alert.informed_entity:
+            result['informed_entity'] = []
+            for entity in alert.informed_entity:
+                informed_entity = {}
+                if entity.HasField('trip'):
+                    informed_entity['trip'] = {
+                        'trip_id': entity.trip.trip_id,
+                        'route_id': entity.trip.route_id
+                    }
+                if entity.HasField('route_id'):
+                    informed_entity['route_id'] = entity.route_id
+                if entity.HasField('stop_id'):
+                    informed_entity['stop_id'] = entity.stop_id
+                result['informed_entity'].append(informed_entity)
+        return result
+
+    def _legacy_trip_update(self, trip_update: gtfs_realtime_pb2.TripUpdate) -> Dict:
+        result = {
+            'trip_id': trip_update.trip.trip_id,
+            'route_id': trip_update.trip.route_id,
+            'start_time': trip_update.trip.start_time,
+            'start_date': trip_update.trip.start_date
+        }
+        if trip_update.trip.HasField('schedule_relationship'):
+            result['schedule_relationship'] = trip_update.trip.schedule_relationship
+
+        result['stop_time_updates'] = []
+        for update in trip_update.stop_time_update:
+            stop_update = {'stop_id': update.stop_id}
+            if update.HasField('arrival'):
+                stop_update['arrival'] = {'time': update.arrival.time}
+                if update.arrival.HasField('delay'):
+                    stop_update['arrival']['delay'] = update.arrival.delay
+            if update.HasField('departure'):
+                stop_update['departure'] = {'time': update.departure.time}
+                if update.departure.HasField('delay'):
+                    stop_update['departure']['delay'] = update.departure.delay
+            if update.HasField('schedule_relationship'):
+                stop_update['schedule_relationship'] = update.schedule_relationship
+            result['stop_time_updates'].append(stop_update)
+        return result
+
+
+def run(feed_id: str = "irt", repeat: int = 5):
+    """
+    Time both decoders on every fixture payload for a feed
+    """
+    single_pass = MTAService()
+    three_pass = ThreePassMTAService()
+    for name, content in load_feed_payloads(feed_id).items():
+        feed = single_pass.parse_feed(content)
+        # Also warms up lazily-initialised protobuf field accessors
+        assert single_pass._process_feed_data(feed) == three_pass._process_feed_data(feed)
+
+        stop_updates = sum(len(e.trip_update.stop_time_update) for e in feed.entity)
+        print(f"\n{feed_id} {name}: {len(content)} bytes, {len(feed.entity)} entities, "
+              f"{stop_updates} stop time updates")
+        timings = (
+            ("three-pass dicts", lambda: three_pass._process_feed_data(feed)),
+            ("single-pass dicts", lambda: single_pass._process_feed_data(feed)),
+            ("records+columns", lambda: single_pass._decode_feed(feed)),
+        )
+        for label, func in timings:
+            best = min(timeit.repeat(func, number=1, repeat=repeat))
+            print(f"  {label:<18} {best * 1000:8.2f} ms")
+
+        print(f"  retained memory: dicts {retained_kib(lambda: three_pass._process_feed_data(feed))} KiB, "
+              f"records+columns {retained_kib(lambda: single_pass._decode_feed(feed))} KiB")
+
+
+def retained_kib(build) -> int:
+    """
+    Memory held by the object returned from `build`
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return retained // 1024
+
+
+if __name__ == "__main__":
+    run(*sys.argv[1:2], *[int(arg) for arg in sys.argv[2:3]])
@@ -0,0 +1,79 @@
+"""
+Measure compiling, opening and querying the static GTFS index.
+
+    python -m benchmarks.bench_static_gtfs [gtfs.zip]
+
+Without an argument a synthetic schedule matching the synthetic realtime
+feed is generated.
+"""
+import os
+import sys
+import tempfile
+import time
+import zipfile
+from app.services.mta_service import MTAService
+from app.services.static_gtfs import StaticGTFS, compile_gtfs
+from benchmarks.feed_fixtures import IRT_ROUTES, build_feed
+
+
+def build_schedule(path: str, trips: int = 6000, stops_per_trip: int = 70):
+    """
+    Write a synthetic GTFS zip whose trip and stop ids cover build_feed's
+    """
+    stops = ["stop_id,stop_name,stop_lat,stop_lon,parent_station"]
+    trip_rows = ["route_id,trip_id,service_id,trip_headsign"]
+    stop_times = ["trip_id,arrival_time,departure_time,stop_id,stop_sequence"]
+    for route_id in IRT_ROUTES:
+        for number in range(1, stops_per_trip + 1):
+            for direction in "NS":
+                stops.append(f"{route_id}{number:02d}{direction},Station {route_id}{number:02d},40.7,-73.9,")
+    for i in range(trips):
+        route_id = IRT_ROUTES[i % len(IRT_ROUTES)]
+        direction = "N" if i % 2 else "S"
+        for service in ("Weekday", "Saturday", "Sunday"):
+            trip_id = f"AFA23GEN-{service}_{(i * 37) % 144000:06d}_{route_id}..{direction}03R"
+            trip_rows.append(f"{route_id},{trip_id},{service},Terminal {route_id}{direction}")
+            seconds = (i * 97) % 86400
+            for number in range(1, stops_per_trip + 1):
+                clock = f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+                stop_times.append(f"{trip_id},{clock},{clock},{route_id}{number:02d}{direction},{number}")
+                seconds += 90
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("stops.txt", "\n".join(stops))
+        archive.writestr("routes.txt", "route_id,route_short_name\n" + "\n".join(f"{r},{r}" for r in IRT_ROUTES))
+        archive.writestr("calendar.txt", (
+            "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+            "Weekday,1,1,1,1,1,0,0,20230101,20251231\n"
+            "Saturday,0,0,0,0,0,1,0,20230101,20251231\n"
+            "Sunday,0,0,0,0,0,0,1,20230101,20251231\n"
+        ))
+        archive.writestr("trips.txt", "\n".join(trip_rows))
+        archive.writestr("stop_times.txt", "\n".join(stop_times))
+
+
+def run(source: str = None):
+    with tempfile.TemporaryDirectory() as directory:
+        if source is None:
+            source = os.path.join(directory, "gtfs.zip")
+            build_schedule(source)
+        target = os.path.join(directory, "gtfs.idx")
+
+        started = time.perf_counter()
+        counts = compile_gtfs(source, target)
+        print(f"\nCompiled {counts} in {time.perf_counter() - started:.2f} s, {os.path.getsize(target) / 2 ** 20:.1f} MiB")
+
+        started = time.perf_counter()
+        static = StaticGTFS(target)
+        print(f"Opened index in {(time.perf_counter() - started) * 1000:.2f} ms")
+
+        data = MTAService()._process_feed_data(build_feed())
+        for label in ("cold", "warm"):
+            started = time.perf_counter()
+            static.enrich(data)
+            print(f"Enriched feed ({label} caches) in {(time.perf_counter() - started) * 1000:.1f} ms")
+        static.close()
+
+
+if __name__ == "__main__":
+    run(*sys.argv[1:2])
@@ -0,0 +1,170 @@
+"""
+pytest-benchmark suite over the feed pipeline, run on recorded feeds when
+benchmarks/fixtures has any (see benchmarks.record_feeds) and on the
+deterministic synthetic feed otherwise.
+
+    python -m pytest benchmarks/bench_suite.py --benchmark-autosave
+    python -m pytest benchmarks/bench_suite.py --benchmark-compare
+
+Saved runs land in .benchmarks/ and can be compared across commits. DB
+ingestion runs against in-memory SQLite unless BENCH_DATABASE_URL points
+at a (scratch) database, e.g. postgresql+asyncpg://postgres@localhost/bench;
+its tables are dropped and recreated.
+"""
+import asyncio
+import os
+import httpx
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from app.models.base import Base
+from app.services import feed_encoding
+from app.services.db_service import DBService
+from app.services.feed_diff import diff_feeds
+from app.services.feed_poller import FeedPoller, get_feed_poller
+from app.services.mta_service import MTAService
+from benchmarks.fake_mta import FakeMTA, synthetic_payloads
+from benchmarks.feed_fixtures import load_recorded_feeds
+
+pytest.importorskip("pytest_benchmark")
+
+BENCH_DATABASE_URL = os.getenv("BENCH_DATABASE_URL")
+FEED_ID = os.getenv("BENCH_FEED_ID", "irt")
+
+
+@pytest.fixture(scope="module")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="module")
+def payloads():
+    """
+    Consecutive raw versions of the benchmarked feed
+    """
+    return load_recorded_feeds(FEED_ID) or synthetic_payloads(FEED_ID, versions=3)
+
+
+@pytest.fixture(scope="module")
+def service():
+    return MTAService()
+
+
+@pytest.fixture(scope="module")
+def decoded(service, payloads):
+    return [service.decode(content) for content in payloads[:2]]
+
+
+def test_parse(benchmark, service, payloads):
+    benchmark(service.parse_feed, payloads[0])
+
+
+def test_decode(benchmark, service, payloads):
+    feed = service.parse_feed(payloads[0])
+    benchmark(service._decode_feed, feed)
+
+
+def test_to_dict(benchmark, service, payloads):
+    feed = service.parse_feed(payloads[0])
+    benchmark(lambda: service._decode_feed(feed).to_dict())
+
+
+def test_diff(benchmark, decoded):
+    benchmark(diff_feeds, decoded[0], decoded[1])
+
+
+@pytest.mark.parametrize("fmt", [fmt for fmt in feed_encoding.available_formats() if fmt != 'protobuf'])
+def test_serialize(benchmark, decoded, fmt):
+    data = decoded[0].to_dict()
+    benchmark(feed_encoding.serialize, data, fmt)
+
+
+@pytest.fixture
+def db_service(loop):
+    """
+    DBService on freshly created tables
+    """
+    if BENCH_DATABASE_URL:
+        engine = create_async_engine(BENCH_DATABASE_URL)
+    else:
+        engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+
+    async def setup():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+        return sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)()
+
+    session = loop.run_until_complete(setup())
+    yield DBService(session)
+    loop.run_until_complete(session.close())
+    loop.run_until_complete(engine.dispose())
+
+
+def test_db_bulk_store(benchmark, loop, db_service, decoded):
+    data = decoded[0].to_dict()
+    benchmark.pedantic(lambda: loop.run_until_complete(db_service.bulk_store_feed_data(data)), rounds=5)
+
+
+def test_db_apply_changes(benchmark, loop, db_service, decoded):
+    loop.run_until_complete(db_service.bulk_store_feed_data(decoded[0].to_dict()))
+    forward, backward = diff_feeds(decoded[0], decoded[1]), diff_feeds(decoded[1], decoded[0])
+    steps = iter(range(1_000_000))
+
+    def apply():
+        # Alternate between the two versions so every round writes changes
+        changes = forward if next(steps) % 2 == 0 else backward
+        loop.run_until_complete(db_service.apply_feed_changes(changes))
+
+    benchmark.pedantic(apply, rounds=10)
+
+
+@pytest.fixture
+def replay_poller(loop):
+    """
+    Feed poller fetching from an in-process replay, one version per request
+    """
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=FakeMTA(speed=0, synthetic_versions=3)))
+    poller = FeedPoller(MTAService(client))
+    yield poller
+    loop.run_until_complete(poller.stop())
+
+
+def test_end_to_end_refresh(benchmark, loop, replay_poller):
+    """
+    Fetch, decode and publish one feed version from the replayed upstream
+    """
+    benchmark.pedantic(lambda: loop.run_until_complete(replay_poller.refresh(FEED_ID)), rounds=10, warmup_rounds=1)
+
+
+@pytest.mark.parametrize("accept", ["application/json", "application/msgpack", "application/x-protobuf"])
+def test_end_to_end_requests(benchmark, loop, replay_poller, accept):
+    """
+    Throughput of concurrent line group feed requests served from a snapshot
+    """
+    from app.main import app
+
+    loop.run_until_complete(replay_poller.refresh(FEED_ID))
+    app.dependency_overrides[get_feed_poller] = lambda: replay_poller
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+    line_group = next(name for name, group in MTAService.LINE_GROUPS.items() if group.feed_id == FEED_ID)
+    concurrency = 50
+
+    async def burst():
+        responses = await asyncio.gather(*(
+            client.get(f"/api/subway/feed/{line_group}", headers={"Accept": accept, "Accept-Encoding": "gzip"})
+            for _ in range(concurrency)
+        ))
+        assert all(response.status_code == 200 for response in responses)
+
+    try:
+        benchmark.pedantic(lambda: loop.run_until_complete(burst()), rounds=10, warmup_rounds=1)
+        # No stats are collected under --benchmark-disable
+        if benchmark.stats is not None:
+            benchmark.extra_info["requests_per_second"] = round(concurrency / benchmark.stats.stats.mean)
+    finally:
+        app.dependency_overrides.pop(get_feed_poller, None)
+        loop.run_until_complete(client.aclose())
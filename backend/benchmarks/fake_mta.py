@@ -0,0 +1,155 @@
+"""
+Local stand-in for the MTA GTFS-RT endpoints, replaying recorded payloads.
+
+    python -m benchmarks.fake_mta [--speed 10] [--port 8001]
+    MTA_FEED_BASE_URL=http://localhost:8001 uvicorn app.main:app
+
+Each feed replays its recorded versions (see benchmarks.record_feeds) on
+the recording's own clock, sped up by `speed` and looping at the end. With
+a speed of 0 every request gets the next version instead. Feeds without
+recordings replay a synthetic sequence built from build_feed and
+advance_feed. Responses carry an ETag and answer a matching If-None-Match
+with 304, like the real endpoints.
+"""
+import argparse
+import time
+from bisect import bisect_right
+from typing import Dict, List, Optional
+from urllib.parse import unquote
+from google.transit import gtfs_realtime_pb2
+from app.services.mta_service import MTAService
+from benchmarks.feed_fixtures import advance_feed, build_feed, load_recorded_feeds
+
+SYNTHETIC_VERSIONS = 10
+SYNTHETIC_INTERVAL = 30
+
+
+def synthetic_payloads(feed_id: str, versions: int = SYNTHETIC_VERSIONS) -> List[bytes]:
+    """
+    Consecutive synthetic versions of a feed carrying its line groups' routes
+    """
+    routes = []
+    for name, group in MTAService.LINE_GROUPS.items():
+        if group.feed_id == feed_id:
+            routes.extend(sorted(group.routes) if group.routes else name.split("-"))
+    feed = build_feed(routes=routes)
+    payloads = [feed.SerializeToString()]
+    for seed in range(1, versions):
+        feed = advance_feed(feed, seconds=SYNTHETIC_INTERVAL, seed=seed)
+        payloads.append(feed.SerializeToString())
+    return payloads
+
+
+class FeedReplay:
+    """
+    Versions of one feed and their offsets on the recording's clock
+    """
+
+    __slots__ = ('payloads', 'offsets', 'period', 'cursor')
+
+    def __init__(self, payloads: List[bytes]):
+        timestamps = [gtfs_realtime_pb2.FeedMessage.FromString(content).header.timestamp for content in payloads]
+        self.payloads = payloads
+        self.offsets = [timestamp - timestamps[0] for timestamp in timestamps]
+        gaps = sorted(b - a for a, b in zip(self.offsets, self.offsets[1:]))
+        # The last version is served for a typical gap before looping
+        self.period = self.offsets[-1] + (gaps[len(gaps) // 2] if gaps else SYNTHETIC_INTERVAL)
+        self.cursor = 0
+
+    def version_at(self, elapsed: float, speed: float) -> int:
+        """
+        Index of the version to serve `elapsed` seconds into the replay
+        """
+        if speed <= 0:
+            index = self.cursor
+            self.cursor = (index + 1) % len(self.payloads)
+            return index
+        position = (elapsed * speed) % self.period if self.period else 0
+        return bisect_right(self.offsets, position) - 1
+
+
+class FakeMTA:
+    """
+    ASGI application serving replayed feeds under MTAService.FEED_PATHS
+    """
+
+    def __init__(
+        self,
+        speed: float = 1.0,
+        feeds: Optional[Dict[str, List[bytes]]] = None,
+        synthetic_versions: int = SYNTHETIC_VERSIONS
+    ):
+        """
+        Args:
+            speed: Replay speed relative to the recording, or 0 to step one
+                version per request
+            feeds: Payloads per feed id; recorded or synthetic ones are
+                loaded on first request for feeds not given
+            synthetic_versions: Versions generated for feeds without recordings
+        """
+        self.speed = speed
+        self.synthetic_versions = synthetic_versions
+        self.replays = {feed_id: FeedReplay(payloads) for feed_id, payloads in (feeds or {}).items()}
+        self.paths = {unquote(path): feed_id for feed_id, path in MTAService.FEED_PATHS.items()}
+        self.started = time.monotonic()
+        self.requests = 0
+
+    def replay(self, feed_id: str) -> FeedReplay:
+        replay = self.replays.get(feed_id)
+        if replay is None:
+            replay = self.replays[feed_id] = FeedReplay(
+                load_recorded_feeds(feed_id) or synthetic_payloads(feed_id, self.synthetic_versions)
+            )
+        return replay
+
+    def feed_for(self, path: str) -> Optional[str]:
+        """
+        Feed id served at a request path, ignoring any base path prefix
+        """
+        for feed_path, feed_id in self.paths.items():
+            if path.endswith("/" + feed_path):
+                return feed_id
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                await send({'type': message['type'] + '.complete'})
+                if message['type'] == 'lifespan.shutdown':
+                    return
+        if scope['type'] != 'http':
+            return
+
+        self.requests += 1
+        feed_id = self.feed_for(scope['path'])
+        if feed_id is None:
+            await send({'type': 'http.response.start', 'status': 404, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        replay = self.replay(feed_id)
+        index = replay.version_at(time.monotonic() - self.started, self.speed)
+        etag = f'"{feed_id}-{index}"'.encode()
+        headers = [(b'etag', etag)]
+        request_headers = dict(scope['headers'])
+        if request_headers.get(b'if-none-match') == etag:
+            await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        body = replay.payloads[index]
+        headers += [(b'content-type', b'application/x-protobuf'), (b'content-length', str(len(body)).encode())]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 0 for one version per request")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+    uvicorn.run(FakeMTA(args.speed), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,125 @@
+import os
+import random
+from pathlib import Path
+from typing import Dict, List
+from google.transit import gtfs_realtime_pb2
+
+# Recorded raw GTFS-RT payloads live in <FIXTURES_DIR>/<feed_id>/*.pb
+FIXTURES_DIR = Path(os.getenv("FEED_FIXTURES_DIR", Path(__file__).parent / "fixtures"))
+
+IRT_ROUTES = ["1", "2", "3", "4", "5", "6", "7"]
+
+
+def build_feed(
+    timestamp: int = 1700000000,
+    routes: List[str] = IRT_ROUTES,
+    trips: int = 350,
+    stops_per_trip: int = 30,
+    alerts: int = 5,
+    seed: int = 42
+) -> gtfs_realtime_pb2.FeedMessage:
+    """
+    Build a deterministic synthetic feed shaped like the MTA IRT feed: one
+    trip update entity per trip, a vehicle entity for most trips and a
+    handful of alerts
+    """
+    rng = random.Random(seed)
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "1.0"
+    feed.header.timestamp = timestamp
+
+    for i in range(trips):
+        route_id = routes[i % len(routes)]
+        direction = "N" if i % 2 else "S"
+        trip_id = f"{(i * 37) % 144000:06d}_{route_id}..{direction}03R"
+        first_stop = rng.randrange(1, 40)
+
+        entity = feed.entity.add()
+        entity.id = f"{i * 2:06d}"
+        trip = entity.trip_update.trip
+        trip.trip_id = trip_id
+        trip.route_id = route_id
+        trip.start_date = "20231114"
+        arrival = timestamp + rng.randrange(0, 300)
+        for offset in range(stops_per_trip):
+            update = entity.trip_update.stop_time_update.add()
+            update.stop_id = f"{route_id}{first_stop + offset:02d}{direction}"
+            update.arrival.time = arrival
+            update.departure.time = arrival + 30
+            arrival += rng.randrange(60, 180)
+
+        if i % 4:
+            entity = feed.entity.add()
+            entity.id = f"{i * 2 + 1:06d}"
+            vehicle = entity.vehicle
+            vehicle.trip.trip_id = trip_id
+            vehicle.trip.route_id = route_id
+            vehicle.trip.start_date = "20231114"
+            vehicle.current_stop_sequence = first_stop
+            vehicle.stop_id = f"{route_id}{first_stop:02d}{direction}"
+            vehicle.current_status = rng.randrange(0, 3)
+            vehicle.timestamp = timestamp - rng.randrange(0, 60)
+            vehicle.position.latitude = 40.7 + rng.random() * 0.15
+            vehicle.position.longitude = -74.0 + rng.random() * 0.1
+
+    for i in range(alerts):
+        entity = feed.entity.add()
+        entity.id = f"alert_{i}"
+        alert = entity.alert
+        alert.effect = gtfs_realtime_pb2.Alert.SIGNIFICANT_DELAYS
+        alert.header_text.translation.add().text = f"Delays on the {routes[i % len(routes)]}"
+        informed = alert.informed_entity.add()
+        informed.route_id = routes[i % len(routes)]
+
+    return feed
+
+
+def advance_feed(
+    feed: gtfs_realtime_pb2.FeedMessage,
+    seconds: int = 30,
+    seed: int = 42
+) -> gtfs_realtime_pb2.FeedMessage:
+    """
+    Next version of a feed, changed the way consecutive MTA updates
+    usually are: a few trains pass their next stop, a few pick up a delay
+    on their remaining stops, and vehicle reports move on
+    """
+    rng = random.Random(seed)
+    feed = gtfs_realtime_pb2.FeedMessage.FromString(feed.SerializeToString())
+    feed.header.timestamp += seconds
+
+    for entity in feed.entity:
+        if entity.HasField('trip_update'):
+            updates = entity.trip_update.stop_time_update
+            roll = rng.random()
+            if roll < 0.1 and len(updates) > 1:
+                del updates[0]
+            elif roll < 0.2:
+                delay = rng.randrange(30, 120)
+                for update in updates[:3]:
+                    update.arrival.time += delay
+                    update.departure.time += delay
+        elif entity.HasField('vehicle') and rng.random() < 0.2:
+            entity.vehicle.timestamp += seconds
+
+    return feed
+
+
+def load_recorded_feeds(feed_id: str = "irt") -> List[bytes]:
+    """
+    Raw payloads recorded for a feed, oldest first
+    """
+    feed_dir = FIXTURES_DIR / feed_id
+    if not feed_dir.is_dir():
+        return []
+    return [path.read_bytes() for path in sorted(feed_dir.glob("*.pb"))]
+
+
+def load_feed_payloads(feed_id: str = "irt") -> Dict[str, bytes]:
+    """
+    Recorded payloads for a feed if any exist, otherwise a synthetic one
+    """
+    recorded = load_recorded_feeds(feed_id)
+    if recorded:
+        return {f"recorded[{i}]": content for i, content in enumerate(recorded)}
+    return {"synthetic": build_feed().SerializeToString()}
@@ -0,0 +1,68 @@
+"""
+Record raw GTFS-RT payloads from the MTA for replay.
+
+    python -m benchmarks.record_feeds [feed_id ...] [--versions 20] [--interval 30]
+
+Every new feed version is written to <FEED_FIXTURES_DIR>/<feed_id>/<header
+timestamp>.pb, where load_recorded_feeds and benchmarks.fake_mta read them
+back in order.
+"""
+import argparse
+import asyncio
+import time
+from pathlib import Path
+from typing import Dict, List
+from app.services.mta_service import MTAService
+from benchmarks.feed_fixtures import FIXTURES_DIR
+
+
+async def record_version(service: MTAService, feed_id: str, target: Path) -> bool:
+    """
+    Fetch a feed and store it if it is a version not recorded yet
+    """
+    content = await service.fetch_feed(MTAService.FEEDS[feed_id], conditional=True)
+    if content is None:
+        return False
+    timestamp = service.parse_feed(content).header.timestamp
+    path = target / feed_id / f"{timestamp:010d}.pb"
+    if path.exists():
+        return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    print(f"{feed_id}: recorded {path.name} ({len(content)} bytes)")
+    return True
+
+
+async def record(feed_ids: List[str], versions: int, interval: float, target: Path = FIXTURES_DIR) -> Dict[str, int]:
+    """
+    Poll feeds until each has `versions` new versions recorded
+    """
+    service = MTAService()
+    counts = {feed_id: 0 for feed_id in feed_ids}
+    try:
+        while True:
+            pending = [feed_id for feed_id, count in counts.items() if count < versions]
+            if not pending:
+                return counts
+            started = time.monotonic()
+            results = await asyncio.gather(
+                *(record_version(service, feed_id, target) for feed_id in pending),
+                return_exceptions=True
+            )
+            for feed_id, result in zip(pending, results):
+                if isinstance(result, Exception):
+                    print(f"{feed_id}: {result}")
+                elif result:
+                    counts[feed_id] += 1
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+    finally:
+        await service.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("feeds", nargs="*", default=["irt"], choices=list(MTAService.FEEDS))
+    parser.add_argument("--versions", type=int, default=20, help="new versions to record per feed")
+    parser.add_argument("--interval", type=float, default=30, help="seconds between polls")
+    args = parser.parse_args()
+    print(asyncio.run(record(args.feeds, args.versions, args.interval)))
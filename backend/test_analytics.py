@@ -0,0 +1,90 @@
+import asyncio
+from datetime import date
+from app.services.analytics import AnalyticsService, ArrivalTracker, Histogram
+from app.services.feed_diff import diff_feeds
+from app.services.mta_service import MTAService
+from benchmarks.feed_fixtures import advance_feed, build_feed
+from test_history_store import with_history
+
+
+def test_histogram_percentiles():
+    """
+    Percentiles interpolate within fixed-width buckets and merge additively
+    """
+    histogram = Histogram(0, 600, 60)
+    for value in (30, 90, 90, 150, 10000):
+        histogram.add(value)
+    assert histogram.counts[0] == 1 and histogram.counts[1] == 2 and histogram.counts[-1] == 1
+    assert histogram.percentile(0.5) == 105.0
+    other = Histogram(0, 600, 60, histogram.counts)
+    other.merge(histogram)
+    assert sum(other.counts) == 10 and other.percentile(0.5) == histogram.percentile(0.5)
+    assert Histogram(0, 600, 60).percentile(0.5) is None
+
+
+def test_observed_arrivals_are_aggregated_once():
+    """
+    A trip stopping at a stop is counted once whether it is seen through its
+    vehicle or through the stop leaving the feed, and aggregates grow
+    incrementally
+    """
+    feed = build_feed(trips=40, stops_per_trip=5)
+    service = MTAService()
+    old = service._decode_feed(feed)
+    new = service._decode_feed(advance_feed(feed, seconds=30, seed=1))
+    tracker = ArrivalTracker()
+    observations = tracker.observe(old, diff_feeds(old, new))
+    unique = {(item['trip_id'], item['stop_id']) for item in observations}
+    assert len(unique) < len(observations)
+
+    async def run(history, session):
+        analytics = AnalyticsService(session)
+        stored = await analytics.record_arrivals(observations, tracker)
+        again = await analytics.record_arrivals(tracker.observe(old, diff_feeds(old, new)), tracker)
+        fresh = ArrivalTracker()
+        reloaded = await analytics.record_arrivals(fresh.observe(old, diff_feeds(old, new)), fresh)
+        day = date(2023, 11, 14)
+        return stored, again, reloaded, await analytics.performance(day, day), await analytics.performance(day, day, route_id="4")
+
+    stored, again, reloaded, everything, route = asyncio.run(with_history(run))
+    assert stored == len(unique) and again == 0 and reloaded == 0
+    assert everything['summary']['arrivals'] == len(unique)
+    assert route['route_id'] == "4"
+    assert route['summary']['arrivals'] == len({(item['trip_id'], item['stop_id']) for item in observations if item['route_id'] == "4"})
+    assert [hour['hour'] for hour in everything['hours']] == sorted({item['arrived_at'].hour for item in observations})
+
+
+def test_only_inserted_arrivals_are_aggregated():
+    """
+    Observations already stored by another writer are skipped without
+    touching the aggregates, and the tracker learns about observations only
+    once they are committed
+    """
+    feed = build_feed(trips=40, stops_per_trip=5)
+    service = MTAService()
+    old = service._decode_feed(feed)
+    new = service._decode_feed(advance_feed(feed, seconds=30, seed=1))
+    day = date(2023, 11, 14)
+
+    tracker = ArrivalTracker()
+    accepted = tracker.accept(tracker.observe(old, diff_feeds(old, new)))
+    assert accepted and tracker.accept(tracker.observe(old, diff_feeds(old, new))) == accepted
+
+    async def run(history, session):
+        analytics = AnalyticsService(session)
+        first, second = ArrivalTracker(), ArrivalTracker()
+        # Neither writer has seen the other's rows
+        first.loaded.add(day)
+        second.loaded.add(day)
+        observations = first.observe(old, diff_feeds(old, new))
+        for item in observations:
+            item['delay'] = 90
+        stored = await analytics.record_arrivals(observations, first)
+        duplicate = await analytics.record_arrivals(second.observe(old, diff_feeds(old, new)), second)
+        return stored, duplicate, second.accept(second.observe(old, diff_feeds(old, new))), await analytics.performance(day, day)
+
+    stored, duplicate, pending, performance = asyncio.run(with_history(run))
+    assert stored == len(accepted) and duplicate == 0 and pending == []
+    assert performance['summary']['arrivals'] == stored
+    delay = performance['summary']['delay']
+    assert delay['count'] == stored and delay['mean'] == 90 and 90 <= delay['p50'] <= 120
@@ -0,0 +1,59 @@
+import time
+from app.services.arrivals_index import ArrivalsIndex
+from app.services.feed_poller import FeedSnapshot
+from app.services.mta_service import MTAService
+from benchmarks.feed_fixtures import build_feed
+
+
+def make_snapshot(feed_id: str, routes, timestamp: int = 1700000000) -> FeedSnapshot:
+    """
+    Snapshot of a synthetic feed for the given routes
+    """
+    feed = build_feed(timestamp=timestamp, routes=routes, trips=40, stops_per_trip=8)
+    return FeedSnapshot(feed_id, MTAService()._decode_feed(feed), time.time())
+
+
+def brute_force(snapshots, stop_ids, after):
+    """
+    Reference answer computed by scanning every stop time update
+    """
+    events = []
+    for snapshot in snapshots:
+        for trip in snapshot.data["trip_updates"]:
+            for update in trip["stop_time_updates"]:
+                event = update.get("arrival", update.get("departure"))
+                if update["stop_id"] in stop_ids and event["time"] >= after:
+                    events.append((event["time"], trip["trip_id"]))
+    return sorted(events)
+
+
+def test_next_arrivals_across_feeds():
+    """
+    Lookups merge every feed and direction in time order
+    """
+    irt = make_snapshot("irt", ["1", "2"])
+    l_train = make_snapshot("l", ["1"], timestamp=1700000100)
+    index = ArrivalsIndex()
+    index.update(irt)
+    index.update(l_train)
+
+    stop_id = irt.decoded.stop_times.stop_ids[3][:-1]
+    after = 1700000200
+    arrivals = index.next_arrivals(stop_id, limit=4, after=after)
+    expected = brute_force([irt, l_train], {f"{stop_id}N", f"{stop_id}S"}, after)[:4]
+    assert [(a["time"], a["trip_id"]) for a in arrivals] == expected
+    assert all(a["direction"] in ("N", "S") for a in arrivals)
+
+    directed = index.next_arrivals(f"{stop_id}N", limit=50, after=0)
+    assert directed and all(a["stop_id"] == f"{stop_id}N" for a in directed)
+
+
+def test_update_replaces_feed():
+    """
+    A new snapshot replaces only its own feed's arrivals
+    """
+    index = ArrivalsIndex()
+    index.update(make_snapshot("irt", ["1"]))
+    index.update(make_snapshot("irt", ["2"]))
+    assert {a["route_id"] for a in index.next_arrivals("201", limit=50, after=0)} == {"2"}
+    assert index.next_arrivals("101", limit=50, after=0) == []
@@ -0,0 +1,203 @@
+import asyncio
+from sqlalchemy import and_, delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from app.models.base import Base
+from app.models.subway import Alert, AlertInformedEntity, FeedUpdate, StopTimeUpdate, Trip, VehiclePosition
+from app.services.db_service import DBService
+from app.services.feed_diff import diff_feeds
+from app.services.mta_service import MTAService
+from benchmarks.feed_fixtures import advance_feed, build_feed
+
+
+async def with_service(callback):
+    """
+    Run a callback against a DBService on a fresh in-memory SQLite database
+    """
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    try:
+        async with sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)() as session:
+            return await callback(DBService(session), session)
+    finally:
+        await engine.dispose()
+
+
+async def count(session, model) -> int:
+    """
+    Number of rows stored for a model
+    """
+    return (await session.execute(select(func.count()).select_from(model))).scalar()
+
+
+def test_bulk_store_replaces_stop_time_updates():
+    """
+    Storing a feed twice upserts trips and replaces their stop time updates
+    """
+    first = MTAService()._process_feed_data(build_feed(trips=20, stops_per_trip=6))
+    second = MTAService()._process_feed_data(build_feed(trips=20, stops_per_trip=4))
+
+    async def run(service, session):
+        await service.bulk_store_feed_data(first)
+        await service.bulk_store_feed_data(second)
+        return [await count(session, model) for model in (FeedUpdate, Trip, StopTimeUpdate, VehiclePosition)]
+
+    assert asyncio.run(with_service(run)) == [2, 20, 20 * 4, 15]
+
+
+def test_bulk_and_per_entity_store_agree():
+    """
+    Both ingestion paths store the same rows
+    """
+    data = MTAService()._process_feed_data(build_feed(trips=10, stops_per_trip=3))
+
+    def store_with(method):
+        async def run(service, session):
+            await method(service, data)
+            return [await count(session, model) for model in (Trip, StopTimeUpdate, VehiclePosition)]
+        return asyncio.run(with_service(run))
+
+    assert store_with(DBService.store_feed_data) == store_with(DBService.bulk_store_feed_data)
+
+
+def test_applied_changes_match_full_store():
+    """
+    Writing only the changes leaves the same stop time updates as storing
+    the new version in full
+    """
+    service = MTAService()
+    feed = build_feed(trips=40, stops_per_trip=8)
+    versions = [feed]
+    for seed in range(3):
+        versions.append(advance_feed(versions[-1], seed=seed))
+    decoded = [service._decode_feed(version) for version in versions]
+
+    async def stop_times(session):
+        result = await session.execute(
+            select(Trip.trip_id, StopTimeUpdate.stop_id, StopTimeUpdate.arrival_time, StopTimeUpdate.departure_time)
+            .join(StopTimeUpdate.trip)
+        )
+        return sorted(result.all())
+
+    async def incremental(service, session):
+        await service.bulk_store_feed_data(decoded[0].to_dict())
+        for old, new in zip(decoded, decoded[1:]):
+            await service.apply_feed_changes(diff_feeds(old, new))
+        return await stop_times(session)
+
+    async def full(service, session):
+        await service.bulk_store_feed_data(decoded[-1].to_dict())
+        return await stop_times(session)
+
+    assert asyncio.run(with_service(incremental)) == asyncio.run(with_service(full))
+
+
+def test_applied_changes_recreate_missing_trips():
+    """
+    Changes for a trip whose row was deleted, as prune_live does, recreate
+    the trip and insert its changed stops instead of failing
+    """
+    service = MTAService()
+    first = service._decode_feed(build_feed(trips=20, stops_per_trip=6))
+    second = service._decode_feed(advance_feed(build_feed(trips=20, stops_per_trip=6), seed=1))
+    changes = diff_feeds(first, second)
+    changed = {update["trip_id"]: update["stop_id"] for update in changes.stop_time_updates.updated}
+    trip_id, stop_id = next(iter(changed.items()))
+
+    async def run(service, session):
+        await service.bulk_store_feed_data(first.to_dict())
+        stored = select(Trip.id).where(Trip.trip_id == trip_id).scalar_subquery()
+        for model in (StopTimeUpdate, VehiclePosition):
+            await session.execute(
+                delete(model).where(model.trip_id == stored).execution_options(synchronize_session=False)
+            )
+        await session.execute(delete(Trip).where(Trip.trip_id == trip_id))
+        await session.commit()
+
+        await service.apply_feed_changes(changes)
+        result = await session.execute(
+            select(Trip.route_id, StopTimeUpdate.stop_id).join(StopTimeUpdate.trip).where(Trip.trip_id == trip_id)
+        )
+        return result.all()
+
+    rows = asyncio.run(with_service(run))
+    route_id = next(trip.route_id for trip in second.trips if trip.trip_id == trip_id)
+    assert (route_id, stop_id) in rows
+    assert {route for route, _ in rows} == {route_id}
+
+
+def test_alerts_are_deduplicated_and_expired():
+    """
+    Alerts are upserted by entity id and content, replaced versions and
+    alerts that left the feed are expired, and lookups go through the
+    informed entity index
+    """
+    service = MTAService()
+    feed = build_feed(trips=5, stops_per_trip=2, routes=["1", "2", "3"], alerts=3)
+    changed = type(feed)()
+    changed.CopyFrom(feed)
+    alerts = [entity for entity in changed.entity if entity.HasField("alert")]
+    alerts[0].alert.header_text.translation[0].text = "Suspended on the 1"
+    changed.entity.remove(alerts[2])
+    first, second = service._decode_feed(feed), service._decode_feed(changed)
+
+    async def active(session):
+        result = await session.execute(select(Alert.entity_id, Alert.header_text).where(Alert.active == True))
+        return sorted(result.all())
+
+    async def run(db, session):
+        await db.bulk_store_feed_data(first.to_dict(), "irt")
+        await db.bulk_store_feed_data(first.to_dict(), "irt")
+        stored = await count(session, Alert), await count(session, AlertInformedEntity)
+        # Same entity ids from another feed are kept apart
+        await db.bulk_store_feed_data(first.to_dict(), "l")
+        await db.apply_feed_changes(diff_feeds(first, second), "irt")
+        by_route = sorted(alert.header_text for alert in await db.get_alerts_for(route_id="1"))
+        by_stop = await db.get_alerts_for(stop_id="101N")
+        irt = await session.execute(select(Alert.entity_id, Alert.header_text).where(and_(
+            Alert.active == True, Alert.feed_id == "irt"
+        )))
+        return stored, sorted(irt.all()), by_route, by_stop, await count(session, Alert)
+
+    stored, irt, by_route, by_stop, total = asyncio.run(with_service(run))
+    assert stored == (3, 3)
+    assert irt == [("alert_0", "Suspended on the 1"), ("alert_1", "Delays on the 2")]
+    assert by_route == ["Delays on the 1", "Suspended on the 1"]
+    assert by_stop == []
+    # Three per feed plus the new version of alert_0
+    assert total == 7
+
+
+def test_trip_ids_repeat_across_service_days():
+    """
+    A trip id seen again on the next service day is a new trip, on every
+    ingestion path
+    """
+    feed = build_feed(trips=10, stops_per_trip=3)
+    today = MTAService()._decode_feed(feed)
+    for entity in feed.entity:
+        if entity.HasField("trip_update"):
+            entity.trip_update.trip.start_date = "20231115"
+        if entity.HasField("vehicle"):
+            entity.vehicle.trip.start_date = "20231115"
+    tomorrow = MTAService()._decode_feed(feed)
+
+    async def apply_changes(service, decoded):
+        if decoded is today:
+            return await service.bulk_store_feed_data(decoded.to_dict())
+        return await service.apply_feed_changes(diff_feeds(today, decoded))
+
+    def store_with(method):
+        async def run(service, session):
+            await method(service, today)
+            await method(service, tomorrow)
+            dates = (await session.execute(select(Trip.start_date, func.count()).group_by(Trip.start_date))).all()
+            return sorted(dates), await count(session, StopTimeUpdate), await count(session, VehiclePosition)
+        return asyncio.run(with_service(run))
+
+    expected = ([("20231114", 10), ("20231115", 10)], 2 * 10 * 3, 2 * 7)
+    assert store_with(lambda service, decoded: service.bulk_store_feed_data(decoded.to_dict())) == expected
+    assert store_with(lambda service, decoded: service.store_feed_data(decoded.to_dict())) == expected
+    assert store_with(apply_changes) == expected
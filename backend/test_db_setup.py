@@ -1,60 +1,31 @@
 import asyncio
-from app.services.mta_service import MTAService
-from app.services.db_service import DBService
-from app.db.session import SessionLocal
-from app.db.init_db import init_db, clear_db
+from app.models.subway import Alert, FeedUpdate, StopTimeUpdate, Trip
+from test_db_service import count, with_service
+from test_mta_feed import replay_service
 
-async def test_db_setup():
+
+def test_db_setup():
     """
-    Test database setup and data storage
+    Store a replayed MTA feed in a fresh database and read it back
     """
-    try:
-        print("\nInitializing database...")
-        init_db()
-        
-        # Get MTA data
-        print("\nFetching MTA data...")
-        mta_service = MTAService()
-        feed_data = await mta_service.get_feed_data()
-        
-        # Store in database
-        print("\nStoring data in database...")
-        db = SessionLocal()
-        db_service = DBService(db)
-        feed_update = db_service.store_feed_data(feed_data)
-        
-        # Print results
-        print("\nData stored successfully!")
-        print(f"Timestamp: {feed_update.timestamp}")
-        print(f"Total entities processed: {feed_update.processed_count}")
-        print(f"Trips: {feed_update.trips_count}")
-        print(f"Vehicles: {feed_update.vehicles_count}")
-        print(f"Alerts: {feed_update.alerts_count}")
-        
-        # Test retrieval
-        print("\nRetrieving stored data...")
-        active_trips = db_service.get_active_trips()
-        vehicle_positions = db_service.get_vehicle_positions()
-        active_alerts = db_service.get_active_alerts()
-        
-        print(f"\nRetrieved data:")
-        print(f"Active trips: {len(active_trips)}")
-        print(f"Vehicle positions: {len(vehicle_positions)}")
-        print(f"Active alerts: {len(active_alerts)}")
-        
-        if active_alerts:
-            print("\nExample alert:")
-            alert = active_alerts[0]
-            print(f"Effect: {alert.effect}")
-            print(f"Header: {alert.header_text}")
-            print(f"Description: {alert.description_text}")
-        
-        db.close()
-        print("\nDatabase test completed successfully!")
-        
-    except Exception as e:
-        print(f"\nError: {str(e)}")
-        raise e
+    async def run(service, session):
+        mta_service = replay_service()
+        try:
+            feed_data = await mta_service.get_feed_data("1-2-3")
+        finally:
+            await mta_service.aclose()
+
+        feed_update = await service.bulk_store_feed_data(feed_data, "irt")
+        stored = {model.__name__: await count(session, model) for model in (FeedUpdate, Trip, StopTimeUpdate, Alert)}
+        return feed_data, feed_update, stored, await service.get_active_alerts()
 
-if __name__ == "__main__":
-    asyncio.run(test_db_setup()) 
\ No newline at end of file
+    feed_data, feed_update, stored, active_alerts = asyncio.run(with_service(run))
+    assert feed_update.trips_count == len(feed_data["trip_updates"]) > 0
+    assert feed_update.vehicles_count == len(feed_data["vehicle_positions"])
+    assert feed_update.processed_count == (
+        feed_update.trips_count + feed_update.vehicles_count + feed_update.alerts_count
+    )
+    assert stored["FeedUpdate"] == 1
+    assert stored["Trip"] >= len({trip["trip_id"] for trip in feed_data["trip_updates"]})
+    assert stored["StopTimeUpdate"] == sum(len(trip["stop_time_updates"]) for trip in feed_data["trip_updates"])
+    assert len(active_alerts) == stored["Alert"]
@@ -0,0 +1,51 @@
+import pickle
+from app.services.mta_service import MTAService
+from benchmarks.feed_fixtures import build_feed
+
+
+def test_columnar_round_trip():
+    """
+    The lazy dict view survives pickling and matches the decoded columns
+    """
+    service = MTAService()
+    decoded = service._decode_feed(build_feed(trips=20, stops_per_trip=5))
+    restored = pickle.loads(pickle.dumps(decoded))
+    assert restored.to_dict() == decoded.to_dict()
+    assert len(decoded.stop_times) == 20 * 5
+    first = decoded.to_dict()["trip_updates"][0]
+    assert len(first["stop_time_updates"]) == 5
+    assert set(first["stop_time_updates"][0]) == {"stop_id", "arrival", "departure"}
+
+
+def test_records_share_interned_ids():
+    """
+    Records compare without their entity id and share id strings across
+    decodes
+    """
+    service = MTAService()
+    feed = build_feed(trips=10, stops_per_trip=3)
+    first = service._decode_feed(feed)
+    second = service._decode_feed(feed)
+    trip, other = first.trips[0], second.trips[0]
+    assert trip.route_id is other.route_id and trip.trip_id is other.trip_id
+    other.entity_id = "moved"
+    assert trip == other and trip != first.trips[1]
+    assert not hasattr(trip, "__dict__")
+
+
+def test_optional_stop_time_fields():
+    """
+    Events at time 0, delays and missing events keep their presence
+    """
+    feed = build_feed(trips=1, stops_per_trip=3)
+    updates = feed.entity[0].trip_update.stop_time_update
+    updates[0].ClearField("departure")
+    updates[0].arrival.time = 0
+    updates[1].ClearField("arrival")
+    updates[1].departure.delay = 0
+    updates[2].schedule_relationship = updates[2].SKIPPED
+
+    rows = MTAService()._decode_feed(feed).to_dict()["trip_updates"][0]["stop_time_updates"]
+    assert rows[0]["arrival"] == {"time": 0} and "departure" not in rows[0]
+    assert "arrival" not in rows[1] and rows[1]["departure"]["delay"] == 0
+    assert rows[2]["schedule_relationship"] == updates[2].SKIPPED
@@ -0,0 +1,103 @@
+import asyncio
+import time
+import httpx
+from app.services.arrivals_index import ArrivalsIndex
+from app.services.display_boards import ROW_WIDTH, Board, DisplayBoards, parse_boards, render_rows
+from app.services.display_boards import get_display_boards
+from test_arrivals_index import make_snapshot
+
+
+def test_parse_boards():
+    assert parse_boards("lobby=127N, 127S;home=R16;;empty=") == {"lobby": ("127N", "127S"), "home": ("R16",)}
+
+
+def test_board_rows_have_fixed_layout():
+    """
+    Boards render soonest arrivals first as fixed-width rows, padded to
+    the configured row count
+    """
+    index = ArrivalsIndex()
+    irt = make_snapshot("irt", ["1", "2"])
+    index.update(irt)
+    stop_id = irt.decoded.stop_times.stop_ids[3][:-1]
+    boards = DisplayBoards(index, {"lobby": (stop_id,)}, rows=3)
+    now = 1700000000
+
+    body = boards.render(boards.get("lobby"), now)
+    arrivals = index.next_arrivals(stop_id, 3, now)
+    assert body == render_rows(arrivals, now, 3)
+    rows = body.decode().splitlines(keepends=True)
+    assert len(rows) == 3 and all(len(row) == ROW_WIDTH for row in rows)
+    assert rows[0][:3].strip() == arrivals[0]["route_id"]
+    assert rows[0][3] == arrivals[0]["direction"]
+    assert int(rows[0][4:7]) == (arrivals[0]["time"] - now) // 60
+
+    assert render_rows([], now, 2) == b"       \n" * 2
+
+
+def test_long_poll_wakes_on_change():
+    """
+    A board request holding the current ETag waits for the rows to change,
+    and gets a 304 if they don't
+    """
+    from app.main import app
+
+    boards = DisplayBoards(ArrivalsIndex(), {"lobby": ("127",)}, rows=2)
+    board = boards.get("lobby")
+    app.dependency_overrides[get_display_boards] = lambda: boards
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            first = await client.get("/api/display/boards/lobby")
+            etag = first.headers["etag"]
+            timed_out = await client.get(
+                "/api/display/boards/lobby", params={"wait": 0.05}, headers={"If-None-Match": etag}
+            )
+
+            async def change():
+                await asyncio.sleep(0.05)
+                board.set_body(render_rows([{"route_id": "1", "direction": "N", "time": 300}], 0, 2))
+
+            woken, _ = await asyncio.gather(
+                client.get("/api/display/boards/lobby", params={"wait": 5}, headers={"If-None-Match": etag}),
+                change()
+            )
+            missing = await client.get("/api/display/boards/unknown")
+            return first, timed_out, woken, missing
+
+    try:
+        first, timed_out, woken, missing = asyncio.run(run())
+    finally:
+        app.dependency_overrides.pop(get_display_boards, None)
+
+    assert first.status_code == 200 and first.content == b"       \n" * 2
+    assert timed_out.status_code == 304
+    assert woken.status_code == 200 and woken.content == b"1  N  5\n       \n"
+    assert woken.headers["etag"] != first.headers["etag"]
+    assert missing.status_code == 404
+
+
+def test_boards_follow_their_feeds_and_the_clock():
+    """
+    A feed update only re-renders boards showing its stops, and refreshing
+    later counts the minutes down without a feed update
+    """
+    now = int(time.time())
+    index = ArrivalsIndex()
+    irt, bdfm = make_snapshot("irt", ["1", "2"], now), make_snapshot("bdfm", ["B", "D"], now)
+    index.update(irt)
+    index.update(bdfm)
+    boards = DisplayBoards(index, {
+        "irt": (irt.decoded.stop_times.stop_ids[0][:-1],),
+        "bdfm": (bdfm.decoded.stop_times.stop_ids[0][:-1],)
+    }, rows=2)
+    blank = b"       \n" * 2
+
+    boards.update(irt)
+    assert boards.get("irt").body != blank
+    assert boards.get("bdfm").body == blank
+
+    before = boards.get("irt").body
+    boards.refresh(boards.boards.values(), now + 120)
+    assert boards.get("bdfm").body != blank
+    assert boards.get("irt").body != before
@@ -0,0 +1,105 @@
+from google.transit import gtfs_realtime_pb2
+from app.services.feed_diff import diff_feeds
+from app.services.mta_service import MTAService
+from benchmarks.feed_fixtures import advance_feed, build_feed
+from test_feed_poller import build_feed_bytes
+
+
+def decode(feed):
+    return MTAService()._decode_feed(feed)
+
+
+def test_first_version_is_all_inserts():
+    """
+    Without a previous version every entity is an insert
+    """
+    feed = build_feed(trips=10, stops_per_trip=4, alerts=2)
+    changes = diff_feeds(None, decode(feed))
+    assert len(changes.trips.inserted) == 10
+    assert len(changes.stop_time_updates.inserted) == 40
+    assert len(changes.vehicle_positions.inserted) == 7
+    assert len(changes.alerts.inserted) == 2
+    assert not changes.trips.updated and not changes.stop_time_updates.deleted
+
+
+def test_unchanged_feed_has_no_changes():
+    """
+    A new header alone, or shifted entity ids, is not a change
+    """
+    feed = build_feed(trips=10)
+    old = decode(feed)
+    feed.header.timestamp += 30
+    new = decode(feed)
+    for i, trip in enumerate(new.trips):
+        trip.entity_id = f"shifted{i}"
+    changes = diff_feeds(old, new)
+    assert len(changes) == 0
+    assert changes.header['timestamp'] == 1700000030
+
+
+def test_stop_level_changes():
+    """
+    Passed stops are deleted and delayed stops updated, keyed by trip and stop
+    """
+    feed = build_feed(trips=50, stops_per_trip=10)
+    old, new = decode(feed), decode(advance_feed(feed))
+    changes = diff_feeds(old, new)
+
+    old_rows = {(trip['trip_id'], update['stop_id']): update for trip in old.trip_updates() for update in trip['stop_time_updates']}
+    new_rows = {(trip['trip_id'], update['stop_id']): update for trip in new.trip_updates() for update in trip['stop_time_updates']}
+    assert set(changes.stop_time_updates.deleted) == old_rows.keys() - new_rows.keys()
+    assert changes.stop_time_updates.inserted == []
+    assert {
+        (update['trip_id'], update['stop_id']) for update in changes.stop_time_updates.updated
+    } == {key for key in new_rows.keys() & old_rows.keys() if new_rows[key] != old_rows[key]}
+    assert 0 < len(changes.stop_time_updates) < len(new_rows) / 2
+
+
+def test_filter_routes():
+    """
+    Route filtering applies to trips, their stops and vehicles
+    """
+    feed = gtfs_realtime_pb2.FeedMessage.FromString(build_feed_bytes())
+    old = decode(feed)
+    del feed.entity[0]
+    new = decode(feed)
+    changes = diff_feeds(old, new)
+    assert changes.trips.deleted == ["000650_1..N03R"]
+    assert changes.filter_routes(frozenset({"1"})).trips.deleted == ["000650_1..N03R"]
+    assert changes.filter_routes(frozenset({"4"})).trips.deleted == []
+    assert changes.filter_routes(frozenset({"4"})).stop_time_updates.deleted == []
+
+
+def test_alerts_keyed_by_content():
+    """
+    Alerts are matched by content, not positional entity ids, and deleted
+    alerts only reach the line groups whose routes they informed
+    """
+    feed = build_feed(trips=4, alerts=2)
+    old = decode(feed)
+    feed.entity[-1].id, feed.entity[-2].id = feed.entity[-2].id, feed.entity[-1].id
+    assert len(diff_feeds(old, decode(feed)).alerts) == 0
+
+    edited = feed.entity[-1].alert
+    edited.header_text.translation[0].text = "Suspended"
+    changes = diff_feeds(old, decode(feed))
+    assert len(changes.alerts.inserted) == len(changes.alerts.deleted) == 1
+    inserted = changes.alerts.inserted[0]
+    assert inserted["header_text"] == "Suspended" and inserted["content_hash"] != changes.alerts.deleted[0]
+
+    route = edited.informed_entity[0].route_id
+    other = feed.entity[-2].alert.informed_entity[0].route_id
+    assert len(changes.filter_routes(frozenset({route})).alerts) == 2
+    assert len(changes.filter_routes(frozenset({other})).alerts) == 0
+
+
+def test_duplicate_keys_are_counted():
+    """
+    Repeated trips keep their last entry and are counted as duplicates
+    """
+    feed = build_feed(trips=4, stops_per_trip=3, alerts=0)
+    feed.entity.add().CopyFrom(feed.entity[0])
+    changes = diff_feeds(None, decode(feed))
+    assert len(changes.trips.inserted) == 4
+    # The repeated trip update and its three stops
+    assert changes.counts['duplicates'] == 4
@@ -0,0 +1,84 @@
+import gzip
+import msgpack
+import orjson
+from google.transit import gtfs_realtime_pb2
+from app.services.feed_encoding import (
+    NotAcceptable, filter_feed_bytes, negotiate_encoding, negotiate_format
+)
+from app.services.feed_poller import FeedSnapshot
+from app.services.mta_service import MTAService
+from test_feed_poller import build_feed_bytes
+
+
+def snapshot() -> FeedSnapshot:
+    content = build_feed_bytes()
+    return FeedSnapshot("irt", MTAService().decode(content, None), 0.0, content)
+
+
+def test_negotiate_format():
+    """
+    The most preferred acceptable format wins, JSON by default
+    """
+    assert negotiate_format(None) == "json"
+    assert negotiate_format("text/html,*/*;q=0.8") == "json"
+    assert negotiate_format("application/x-protobuf") == "protobuf"
+    assert negotiate_format("application/json;q=0.5, application/msgpack") == "msgpack"
+    try:
+        negotiate_format("text/html")
+        assert False, "text/html is not servable"
+    except NotAcceptable:
+        pass
+
+
+def test_negotiate_encoding():
+    """
+    Brotli is preferred over gzip unless the client refuses it
+    """
+    assert negotiate_encoding(None) is None
+    assert negotiate_encoding("gzip, deflate, br") == "br"
+    assert negotiate_encoding("gzip, br;q=0") == "gzip"
+    assert negotiate_encoding("identity") is None
+
+
+def test_encoded_payloads_are_cached_per_snapshot():
+    """
+    Each format matches the JSON view and is only built once
+    """
+    current = snapshot()
+    view = current.view("1-2-3")
+    body = current.encoded("1-2-3", None, "json")
+    assert orjson.loads(body) == view
+    assert current.encoded("1-2-3", None, "json") is body
+    assert msgpack.unpackb(current.encoded("1-2-3", "trip_updates", "msgpack")) == view["trip_updates"]
+    assert gzip.decompress(current.encoded("1-2-3", None, "json", "gzip")) == body
+    assert current.revalidated(1.0).encoded("1-2-3", None, "json") is body
+
+
+def test_protobuf_pass_through():
+    """
+    Unfiltered feeds are served as the upstream bytes; shared feeds are cut
+    down to the line group's routes
+    """
+    content = build_feed_bytes()
+    assert filter_feed_bytes(content, None) is content
+    current = snapshot()
+    feed = gtfs_realtime_pb2.FeedMessage.FromString(current.encoded("4-5-6", None, "protobuf"))
+    assert [entity.trip_update.trip.route_id for entity in feed.entity] == ["4"]
+    assert feed.header.timestamp == 1700000000
+
+
+def test_etags_follow_feed_version():
+    """
+    Variants have distinct strong ETags that change with the feed version
+    """
+    from app.routers.subway import etag_matches
+
+    current = snapshot()
+    etag = current.etag("1-2-3", None, "json", "gzip")
+    assert etag != current.etag("1-2-3", None, "json")
+    assert current.revalidated(1.0).etag("1-2-3", None, "json", "gzip") == etag
+    newer = build_feed_bytes(1700000030)
+    assert FeedSnapshot("irt", MTAService().decode(newer, None), 0.0, newer).etag("1-2-3", None, "json", "gzip") != etag
+    assert etag_matches(f'"other", W/{etag}', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches(None, etag)
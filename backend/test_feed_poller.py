@@ -0,0 +1,199 @@
+import asyncio
+import httpx
+from google.transit import gtfs_realtime_pb2
+from app.services.mta_service import MTAService
+from app.services.feed_poller import FEED_BREAKER_THRESHOLD, FeedPoller, FeedUnavailable
+
+
+def build_feed_bytes(timestamp: int = 1700000000) -> bytes:
+    """
+    Build a minimal IRT GTFS-RT feed with one trip update per route
+    """
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "1.0"
+    feed.header.timestamp = timestamp
+    for i, (route_id, stop_id) in enumerate([("1", "101N"), ("4", "401S")]):
+        entity = feed.entity.add()
+        entity.id = f"00000{i}"
+        entity.trip_update.trip.trip_id = f"000650_{route_id}..N03R"
+        entity.trip_update.trip.route_id = route_id
+        stop = entity.trip_update.stop_time_update.add()
+        stop.stop_id = stop_id
+        stop.arrival.time = timestamp + 60
+    return feed.SerializeToString()
+
+
+class CountingMTAService(MTAService):
+    """
+    MTA service serving a fixed payload and counting upstream fetches
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.fetches = 0
+        self.timestamp = 1700000000
+
+    async def fetch_feed(self, feed_url: str, conditional: bool = False) -> bytes:
+        self.fetches += 1
+        return build_feed_bytes(self.timestamp)
+
+
+def test_line_groups_share_snapshot():
+    """
+    Concurrent requests for line groups on the same feed trigger one fetch
+    """
+    async def run():
+        service = CountingMTAService()
+        poller = FeedPoller(service)
+        snapshots = await asyncio.gather(
+            poller.get_line_snapshot("1-2-3"),
+            poller.get_line_snapshot("4-5-6"),
+            poller.get_line_snapshot("7"),
+        )
+        return service, snapshots
+
+    service, snapshots = asyncio.run(run())
+    assert service.fetches == 1
+    assert snapshots[0] is snapshots[1] is snapshots[2]
+    assert snapshots[0].data["header"]["timestamp"] == 1700000000
+    assert not snapshots[0].status()["stale"]
+
+
+def test_line_group_view_filters_routes():
+    """
+    Line groups on a shared feed only see their own routes
+    """
+    poller = FeedPoller(CountingMTAService())
+    snapshot = asyncio.run(poller.get_line_snapshot("1-2-3"))
+    assert [t["route_id"] for t in snapshot.view("1-2-3")["trip_updates"]] == ["1"]
+    assert [t["route_id"] for t in snapshot.view("4-5-6")["trip_updates"]] == ["4"]
+    assert snapshot.view("7")["trip_updates"] == []
+    assert snapshot.view("1-2-3") is snapshot.view("1-2-3")
+
+
+def test_unknown_line_group():
+    """
+    Unknown line groups have no snapshot
+    """
+    poller = FeedPoller(CountingMTAService())
+    assert asyncio.run(poller.get_line_snapshot("X")) is None
+
+
+def test_fetch_feed_uses_shared_client():
+    """
+    Feeds are downloaded through the injected async client
+    """
+    requested = []
+
+    def handler(request):
+        requested.append(str(request.url))
+        return httpx.Response(200, content=build_feed_bytes())
+
+    async def run():
+        service = MTAService(httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        try:
+            return await service.get_feed_data("7", "trip_updates")
+        finally:
+            await service.aclose()
+
+    assert asyncio.run(run()) == []
+    assert requested == [MTAService.FEEDS["irt"]]
+
+
+def test_unchanged_feed_is_not_reprocessed():
+    """
+    Identical bodies and 304 responses revalidate the current snapshot
+    """
+    etag_matches = []
+
+    def handler(request):
+        if request.headers.get("If-None-Match") == '"v1"':
+            etag_matches.append(True)
+            return httpx.Response(304)
+        return httpx.Response(200, content=build_feed_bytes(), headers={"ETag": '"v1"'})
+
+    async def run():
+        service = MTAService(httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        poller = FeedPoller(service)
+        first = await poller.refresh("irt")
+        second = await poller.refresh("irt")
+        await service.aclose()
+        return poller, first, second
+
+    poller, first, second = asyncio.run(run())
+    assert etag_matches == [True]
+    assert second.data is first.data
+    assert poller.feed_states()["irt"]["not_modified"] == 1
+
+    service = CountingMTAService()
+    poller = FeedPoller(service)
+    asyncio.run(poller.refresh("irt"))
+    asyncio.run(poller.refresh("irt"))
+    service.timestamp += 30
+    asyncio.run(poller.refresh("irt"))
+    state = poller.feed_states()["irt"]
+    assert (state["unchanged"], state["updated"]) == (1, 2)
+
+
+def test_circuit_breaker_serves_last_snapshot():
+    """
+    Upstream failures keep the last good snapshot published until the
+    breaker opens and stops fetching; feeds never fetched are unavailable
+    """
+    responses = [httpx.Response(200, content=build_feed_bytes())]
+
+    def handler(request):
+        if responses:
+            return responses.pop()
+        raise httpx.ConnectError("MTA is down", request=request)
+
+    async def run():
+        service = MTAService(httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        poller = FeedPoller(service)
+        try:
+            first = await poller.refresh("irt")
+            served = [await poller.refresh("irt") for _ in range(FEED_BREAKER_THRESHOLD + 2)]
+            try:
+                await poller.refresh("l")
+                unavailable = None
+            except FeedUnavailable as e:
+                unavailable = e
+            return poller, first, served, unavailable
+        finally:
+            await service.aclose()
+
+    poller, first, served, unavailable = asyncio.run(run())
+    assert all(snapshot is first for snapshot in served)
+    state = poller.feed_states()["irt"]
+    # Fetching stopped once the breaker opened
+    assert state["failed"] == FEED_BREAKER_THRESHOLD
+    assert state["consecutive_failures"] == FEED_BREAKER_THRESHOLD
+    assert state["circuit"] == "open" and state["retry_in"] > 0
+    assert state["last_success"] and "ConnectError" in state["last_error"]
+    assert unavailable is not None and unavailable.feed_id == "l"
+
+    status = poller.service_status()
+    assert status["status"] == "degraded"
+    assert set(status["failing_feeds"]) == {"irt", "l"}
+    assert status["last_update"] == first.decoded.header["timestamp"]
+
+
+def test_service_status_at_cold_start():
+    """
+    Feeds never fetched count against the status: unavailable until some
+    feed has a snapshot, degraded until all of them do
+    """
+    async def run():
+        poller = FeedPoller(CountingMTAService())
+        cold = poller.service_status()
+        await poller.refresh("irt")
+        warming = poller.service_status()
+        for feed_id in MTAService.FEEDS:
+            await poller.refresh(feed_id)
+        return cold, warming, poller.service_status()
+
+    cold, warming, warm = asyncio.run(run())
+    assert cold["status"] == "unavailable" and cold["last_update"] is None
+    assert set(cold["unavailable_feeds"]) == set(MTAService.FEEDS)
+    assert warming["status"] == "degraded" and "irt" not in warming["unavailable_feeds"]
+    assert warm["status"] == "operational" and not warm["unavailable_feeds"]
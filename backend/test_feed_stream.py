@@ -0,0 +1,113 @@
+import asyncio
+import json
+from app.services.feed_poller import FeedPoller
+from app.services.feed_stream import STREAM_QUEUE_SIZE, FeedBroadcaster
+from test_feed_poller import CountingMTAService
+
+
+def test_broadcast_fans_out_one_diff_per_line_group():
+    """
+    Subscribers get diffs for their own line groups, filtered to their stops
+    """
+    async def run():
+        service = CountingMTAService()
+        poller = FeedPoller(service)
+        broadcaster = FeedBroadcaster(poller)
+        poller.subscribe(broadcaster.on_snapshot)
+        everything = broadcaster.subscribe(frozenset({'1-2-3'}))
+        one_stop = broadcaster.subscribe(frozenset({'1-2-3'}), frozenset({'999N'}))
+        delayed = broadcaster.subscribe(frozenset({'1-2-3', '4-5-6'}), frozenset({'101N'}))
+        other = broadcaster.subscribe(frozenset({'L'}))
+
+        await poller.refresh('irt')
+        service.timestamp += 30
+        await poller.refresh('irt')
+        return everything, one_stop, delayed, other
+
+    everything, one_stop, delayed, other = asyncio.run(run())
+    assert everything.queue.qsize() == 1
+    message = json.loads(everything.queue.get_nowait().text)
+    assert message['type'] == 'diff'
+    assert message['line_group'] == '1-2-3'
+    assert message['header']['timestamp'] == 1700000030
+    assert [update['stop_id'] for update in message['stop_time_updates']['updated']] == ['101N']
+    assert json.loads(one_stop.queue.get_nowait().text)['stop_time_updates']['updated'] == []
+    messages = [json.loads(delayed.queue.get_nowait().text) for _ in range(2)]
+    assert [len(m['stop_time_updates']['updated']) for m in messages] == [1, 0]
+    assert other.queue.empty()
+
+
+def test_slow_subscriber_resyncs_from_versioned_snapshot():
+    """
+    A subscriber that falls behind gets a resync marker instead of its
+    backlog, and queued diffs carry the version they lead to so ones
+    already covered by the resync snapshot can be skipped
+    """
+    async def run():
+        service = CountingMTAService()
+        poller = FeedPoller(service)
+        broadcaster = FeedBroadcaster(poller)
+        poller.subscribe(broadcaster.on_snapshot)
+        slow = broadcaster.subscribe(frozenset({'1-2-3'}), frozenset({'101N'}))
+        same_stops = broadcaster.subscribe(frozenset({'1-2-3'}), frozenset({'101N'}))
+
+        await poller.refresh('irt')
+        for _ in range(STREAM_QUEUE_SIZE + 1):
+            service.timestamp += 30
+            await poller.refresh('irt')
+        backlog = [slow.queue.get_nowait() for _ in range(slow.queue.qsize())]
+        snapshots = await broadcaster.snapshot_messages(slow)
+        service.timestamp += 30
+        await poller.refresh('irt')
+        return slow, same_stops, backlog, snapshots, service.timestamp
+
+    slow, same_stops, backlog, snapshots, latest = asyncio.run(run())
+    assert backlog == [None]
+    assert [(m.line_group, m.version) for m in snapshots] == [('1-2-3', latest - 30)]
+    assert json.loads(snapshots[0].text)['type'] == 'snapshot'
+    message = slow.queue.get_nowait()
+    assert message.version == latest and message.version > snapshots[0].version
+    # Subscribers sharing a stop filter share one encoded message
+    assert same_stops.queue.get_nowait() is None
+    assert same_stops.queue.get_nowait().text is message.text
+
+
+def test_stream_closes_when_pushing_fails():
+    """
+    A failing pusher closes the websocket with 1011 instead of leaving the
+    connection open without updates
+    """
+    from app.routers.subway import stream_feed
+
+    class FailingBroadcaster(FeedBroadcaster):
+        async def snapshot_messages(self, subscription):
+            raise RuntimeError("encoding failed")
+
+    class FakeWebSocket:
+        def __init__(self):
+            self.closed = asyncio.Event()
+            self.close_code = None
+
+        async def accept(self):
+            pass
+
+        async def receive(self):
+            await self.closed.wait()
+            return {"type": "websocket.disconnect"}
+
+        async def send_text(self, text):
+            pass
+
+        async def close(self, code=1000):
+            self.close_code = code
+            self.closed.set()
+
+    async def run():
+        websocket = FakeWebSocket()
+        broadcaster = FailingBroadcaster(FeedPoller(CountingMTAService()))
+        await asyncio.wait_for(stream_feed(websocket, "1-2-3", None, broadcaster), timeout=5)
+        return websocket.close_code, broadcaster
+
+    close_code, broadcaster = asyncio.run(run())
+    assert close_code == 1011
+    assert not broadcaster.subscribers
@@ -0,0 +1,75 @@
+import asyncio
+from datetime import date
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from app.models.base import Base
+from app.models.history import StopTimeHistory, VehiclePositionHistory
+from app.models.subway import StopTimeUpdate, Trip
+from app.services.feed_diff import diff_feeds
+from app.services.history_store import HistoryService
+from app.services.mta_service import MTAService
+from benchmarks.feed_fixtures import advance_feed, build_feed
+
+
+async def with_history(callback):
+    """
+    Run a callback against a HistoryService on a fresh in-memory SQLite database
+    """
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    try:
+        async with sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)() as session:
+            return await callback(HistoryService(session), session)
+    finally:
+        await engine.dispose()
+
+
+async def count(session, model) -> int:
+    return (await session.execute(select(func.count()).select_from(model))).scalar()
+
+
+def test_history_keeps_stops_that_left_the_feed():
+    """
+    Recording consecutive versions upserts predictions per service day and
+    keeps stops the live feed no longer carries
+    """
+    feed = build_feed(trips=20, stops_per_trip=5)
+    service = MTAService()
+    first = service._decode_feed(feed)
+    second = service._decode_feed(advance_feed(feed, seconds=120, seed=1))
+    changes = diff_feeds(first, second)
+    assert changes.stop_time_updates.deleted
+
+    async def run(history, session):
+        await history.record_changes(diff_feeds(None, first))
+        await history.record_changes(changes)
+        days = (await session.execute(select(StopTimeHistory.service_date).distinct())).scalars().all()
+        return await count(session, StopTimeHistory), await count(session, VehiclePositionHistory), days
+
+    stops, vehicles, days = asyncio.run(with_history(run))
+    assert stops == len(first.stop_times) + len(changes.stop_time_updates.inserted)
+    assert vehicles == len(first.vehicle_positions) + len(changes.vehicle_positions.updated)
+    assert days == [date(2023, 11, 14)]
+
+
+def test_retention_expires_old_service_days():
+    """
+    History and live trips older than the retention period are deleted
+    """
+    decoded = MTAService()._decode_feed(build_feed(trips=10, stops_per_trip=3))
+
+    async def run(history, session):
+        await history.bulk_store_feed_data(decoded.to_dict())
+        await history.record_changes(diff_feeds(None, decoded))
+        kept = await history.prune_history(retention_days=(date.today() - date(2023, 11, 14)).days)
+        counts = [await count(session, model) for model in (StopTimeHistory, Trip)]
+        expired, trips = await history.run_maintenance()
+        return kept, counts, expired, trips, [await count(session, model) for model in (StopTimeHistory, Trip, StopTimeUpdate)]
+
+    kept, counts, expired, trips, after = asyncio.run(with_history(run))
+    assert kept == [] and counts == [30, 10]
+    assert expired == [] and trips == 10
+    assert after == [0, 0, 0]
@@ -0,0 +1,76 @@
+import asyncio
+from app.services import metrics
+from app.services.feed_poller import FeedPoller
+from test_mta_feed import replay_service
+
+
+def test_histogram_render():
+    """
+    Histogram children render cumulative buckets, sum and count
+    """
+    registry = metrics.Registry()
+    histogram = registry.register(metrics.Histogram('test_seconds', 'Test latency', ('stage',), (0.1, 1.0)))
+    for value in (0.05, 0.5, 2.0):
+        histogram.labels('parse').observe(value)
+    counter = registry.register(metrics.Counter('test_total', 'Test count'))
+    counter.labels().inc(3)
+
+    lines = registry.render().splitlines()
+    assert '# TYPE test_seconds histogram' in lines
+    assert 'test_seconds_bucket{stage="parse",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="parse",le="1"} 2' in lines
+    assert 'test_seconds_bucket{stage="parse",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{stage="parse"} 2.55' in lines
+    assert 'test_seconds_count{stage="parse"} 3' in lines
+    assert 'test_total 3' in lines
+
+
+def test_refresh_records_metrics():
+    """
+    A poller refresh records fetch, decode and serialization metrics, and
+    the poller's collector reports feed state at scrape time
+    """
+    async def run():
+        poller = FeedPoller(replay_service())
+        try:
+            snapshot = await poller.get_line_snapshot("1-2-3")
+            snapshot.encoded("1-2-3", None, 'json')
+            snapshot.encoded("1-2-3", None, 'json')
+            return poller
+        finally:
+            await poller.stop()
+
+    poller = asyncio.run(run())
+    registry = metrics.Registry()
+    registry.add_collector(poller.collect_metrics)
+    rendered = metrics.REGISTRY.render() + registry.render()
+
+    assert 'subway_feed_fetch_seconds_count{feed="irt",status="200"}' in rendered
+    assert 'subway_feed_decode_seconds_count{feed="irt",stage="parse"}' in rendered
+    assert 'subway_feed_decode_seconds_count{feed="irt",stage="entities"}' in rendered
+    assert 'subway_feed_serialize_seconds_count{feed="irt",format="json",encoding="identity"}' in rendered
+    assert 'subway_feed_encoded_cache_total{feed="irt",result="hit"}' in rendered
+    assert 'subway_feed_fetches_total{feed="irt",result="updated"} 1' in rendered
+    assert 'subway_feed_stale{feed="irt"} 0' in rendered
+
+
+def test_encoded_cache_counts_one_lookup_per_request():
+    """
+    A compressed cache miss counts once, not again for the uncompressed
+    body it is built from
+    """
+    async def run():
+        poller = FeedPoller(replay_service())
+        try:
+            return await poller.get_line_snapshot("1-2-3")
+        finally:
+            await poller.stop()
+
+    snapshot = asyncio.run(run())
+    hits = metrics.ENCODED_CACHE.labels(snapshot.feed_id, 'hit')
+    misses = metrics.ENCODED_CACHE.labels(snapshot.feed_id, 'miss')
+    before = (hits.value, misses.value)
+    snapshot.encoded("1-2-3", None, 'json', 'gzip')
+    snapshot.encoded("1-2-3", None, 'json')
+    snapshot.encoded("1-2-3", None, 'json', 'gzip')
+    assert (hits.value - before[0], misses.value - before[1]) == (2, 1)
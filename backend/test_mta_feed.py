@@ -1,68 +1,56 @@
 import asyncio
-from app.services.mta_service import MTAService
+import httpx
 import json
+import sys
 from datetime import datetime
+from app.services.mta_service import MTAService
+from benchmarks.fake_mta import FakeMTA
+
+
+def replay_service(speed: float = 0, synthetic_versions: int = 1) -> MTAService:
+    """
+    MTA service fetching from an in-process replay of the recorded feeds
+    """
+    fake = FakeMTA(speed, synthetic_versions=synthetic_versions)
+    return MTAService(httpx.AsyncClient(transport=httpx.ASGITransport(app=fake)))
+
 
-async def test_mta_feed():
+def test_mta_feed():
     """
-    Test function to fetch and display MTA feed data
+    Fetch line groups through MTAService from the replayed MTA feeds
     """
+    async def run():
+        service = replay_service()
+        try:
+            return await service.get_feed_data("1-2-3"), await service.get_feed_data("4-5-6", "vehicle_positions")
+        finally:
+            await service.aclose()
+
+    data, vehicles = asyncio.run(run())
+    assert set(data) == {"header", "trip_updates", "vehicle_positions", "alerts"}
+    assert data["trip_updates"] and {trip["route_id"] for trip in data["trip_updates"]} <= {"1", "2", "3"}
+    assert data["trip_updates"][0]["stop_time_updates"]
+    assert vehicles and {vehicle["trip"]["route_id"] for vehicle in vehicles} <= {"4", "5", "6", "6X"}
+
+
+async def print_feed(line_group: str):
+    """
+    Fetch a line group from the configured upstream (MTA_FEED_BASE_URL) and
+    display a summary and one example of each entity type
+    """
+    service = MTAService()
     try:
-        # Initialize the MTA service
-        mta_service = MTAService()
-        
-        print("\nFetching subway feed data...")
-        data = await mta_service.get_feed_data()
-        
-        # Convert timestamp to readable format
-        timestamp = datetime.fromtimestamp(data['header']['timestamp'])
-        
-        # Print formatted results
-        print("\nFeed Information:")
-        print(f"Timestamp: {timestamp}")
-        print(f"GTFS Version: {data['header']['version']}")
-        print(f"\nNumber of entities: {len(data['entities'])}")
-        
-        # Analyze the types of data we're getting
-        trips = sum(1 for e in data['entities'] if 'trip' in e)
-        vehicles = sum(1 for e in data['entities'] if 'vehicle' in e)
-        alerts = sum(1 for e in data['entities'] if 'alert' in e)
-        
-        print(f"\nData Overview:")
-        print(f"Trips: {trips}")
-        print(f"Vehicle Positions: {vehicles}")
-        print(f"Service Alerts: {alerts}")
-        
-        # Find interesting examples
-        trip_example = next((e for e in data['entities'] if 'trip' in e and e['trip']['stop_time_updates']), None)
-        vehicle_example = next((e for e in data['entities'] if 'vehicle' in e and e.get('vehicle', {}).get('position')), None)
-        alert_example = next((e for e in data['entities'] if 'alert' in e), None)
-        
-        if trip_example:
-            print("\nExample Trip Update:")
-            print(json.dumps(trip_example, indent=2))
-            
-            if trip_example['trip']['stop_time_updates']:
-                print("\nDetailed Stop Updates:")
-                for update in trip_example['trip']['stop_time_updates'][:3]:  # Show first 3 stops
-                    stop_id = update['stop_id']
-                    arrival = datetime.fromtimestamp(update['arrival']['time']) if update.get('arrival', {}).get('time') else None
-                    departure = datetime.fromtimestamp(update['departure']['time']) if update.get('departure', {}).get('time') else None
-                    print(f"\nStop ID: {stop_id}")
-                    print(f"Arrival: {arrival}")
-                    print(f"Departure: {departure}")
-        
-        if vehicle_example:
-            print("\nExample Vehicle Position:")
-            print(json.dumps(vehicle_example, indent=2))
-        
-        if alert_example:
-            print("\nExample Service Alert:")
-            print(json.dumps(alert_example, indent=2))
+        data = await service.get_feed_data(line_group)
+    finally:
+        await service.aclose()
+
+    print(f"Timestamp: {datetime.fromtimestamp(data['header']['timestamp'])}")
+    print(f"GTFS Version: {data['header']['version']}")
+    for data_type in ("trip_updates", "vehicle_positions", "alerts"):
+        print(f"{data_type}: {len(data[data_type])}")
+        if data[data_type]:
+            print(json.dumps(data[data_type][0], indent=2)[:2000])
 
-    except Exception as e:
-        print(f"\nError: {str(e)}")
 
 if __name__ == "__main__":
-    # Run the async test function
-    asyncio.run(test_mta_feed()) 
\ No newline at end of file
+    asyncio.run(print_feed(sys.argv[1] if len(sys.argv) > 1 else "1-2-3"))
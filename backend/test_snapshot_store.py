@@ -0,0 +1,167 @@
+import asyncio
+import pickle
+import zlib
+from app.services.feed_poller import FeedPoller
+from app.services.snapshot_store import RedisSnapshotStore
+from test_feed_poller import CountingMTAService
+
+
+class FakeRedis:
+    """
+    In-memory stand-in for the handful of Redis commands the store uses
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value.encode() if isinstance(value, str) else value
+        return True
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def expire(self, key, ttl):
+        return key in self.values
+
+    async def eval(self, script, numkeys, key, token, ttl):
+        # Only RENEW_LEASE_SCRIPT is run: renew the key if it holds the token
+        if self.values.get(key) == token.encode():
+            return await self.expire(key, ttl)
+        return 0
+
+    async def close(self):
+        pass
+
+
+def test_followers_reuse_leader_snapshots():
+    """
+    Only the leader fetches upstream; followers adopt its published versions
+    """
+    redis = FakeRedis()
+    leader_service, follower_service = CountingMTAService(), CountingMTAService()
+    leader = FeedPoller(leader_service, store=RedisSnapshotStore(redis))
+    follower = FeedPoller(follower_service, store=RedisSnapshotStore(redis))
+    seen = []
+    follower.subscribe(lambda snapshot, previous: seen.append(snapshot.decoded.header["timestamp"]))
+
+    async def run():
+        await leader.refresh("irt")
+        first = await follower.refresh("irt")
+        leader_service.timestamp += 30
+        await leader.refresh("irt")
+        second = await follower.refresh("irt")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert leader.leading and not follower.leading
+    assert (leader_service.fetches, follower_service.fetches) == (2, 0)
+    assert seen == [1700000000, 1700000030]
+    assert second.data == leader.get_snapshot("irt").data
+    assert first.decoded.header["timestamp"] == 1700000000
+
+
+def test_only_leader_runs_persistence_listeners():
+    """
+    Index listeners run on every worker, persistence listeners only on the
+    worker ingesting from the MTA
+    """
+    redis = FakeRedis()
+    leader_service = CountingMTAService()
+    leader = FeedPoller(leader_service, store=RedisSnapshotStore(redis))
+    follower = FeedPoller(CountingMTAService(), store=RedisSnapshotStore(redis))
+    indexed, stored = [], []
+    for name, poller in (("leader", leader), ("follower", follower)):
+        poller.subscribe(lambda snapshot, previous, name=name: indexed.append(name))
+        poller.subscribe(lambda snapshot, previous, name=name: stored.append(name), leader_only=True)
+
+    async def run():
+        for _ in range(2):
+            await leader.refresh("irt")
+            await follower.refresh("irt")
+            leader_service.timestamp += 30
+
+    asyncio.run(run())
+    assert indexed == ["leader", "follower"] * 2
+    assert stored == ["leader"] * 2
+
+
+def test_leader_renews_lease_while_feeds_back_off():
+    """
+    The ingest lease is renewed on its own timer while every feed waits
+    out its breaker backoff
+    """
+    class DownMTAService(CountingMTAService):
+        async def fetch_feed(self, feed_url: str, conditional: bool = False) -> bytes:
+            self.fetches += 1
+            raise ConnectionError("MTA is down")
+
+    class RenewCountingRedis(FakeRedis):
+        renewals = 0
+
+        async def eval(self, script, numkeys, key, token, ttl):
+            self.renewals += 1
+            return await super().eval(script, numkeys, key, token, ttl)
+
+    redis = RenewCountingRedis()
+    service = DownMTAService()
+    poller = FeedPoller(service, interval=3600, store=RedisSnapshotStore(redis), lease_interval=0.01)
+
+    async def run():
+        await poller.start()
+        await asyncio.sleep(0.2)
+        fetches = service.fetches
+        await poller.stop()
+        return fetches
+
+    fetches = asyncio.run(run())
+    # One failed fetch per feed, then the loops sleep out the interval
+    assert fetches == len(service.FEEDS)
+    assert poller.leading
+    assert redis.renewals > len(service.FEEDS) + 5
+
+
+def test_snapshots_are_not_unpickled():
+    """
+    Versions round-trip through msgpack, and a pickle written to the
+    snapshot key is discarded instead of run
+    """
+    class Exploit:
+        def __reduce__(self):
+            return (ran.append, ("exploit",))
+
+    ran = []
+    redis = FakeRedis()
+    leader = FeedPoller(CountingMTAService(), store=RedisSnapshotStore(redis))
+    snapshot = asyncio.run(leader.refresh("irt"))
+    timestamp = snapshot.decoded.header["timestamp"]
+
+    decoded, content, _ = asyncio.run(RedisSnapshotStore(redis).latest("irt"))
+    other, _, _ = asyncio.run(RedisSnapshotStore(redis).latest("irt"))
+    assert decoded.to_dict() == snapshot.data
+    assert decoded.trips[0].trip_id is other.trips[0].trip_id
+    assert content == snapshot.content
+
+    redis.values[f"subway:snapshot:irt:{timestamp}"] = zlib.compress(pickle.dumps(Exploit()))
+    assert asyncio.run(RedisSnapshotStore(redis).latest("irt")) is None
+    assert ran == []
+
+
+def test_lease_renewal_requires_holding_it():
+    """
+    A worker only renews the ingest lease while it still holds the token
+    """
+    redis = FakeRedis()
+    first, second = RedisSnapshotStore(redis), RedisSnapshotStore(redis)
+
+    async def run():
+        taken = await first.is_leader()
+        renewed = await first.is_leader()
+        blocked = await second.is_leader()
+        # The lease expired and the second worker took it over
+        redis.values["subway:ingest:leader"] = second.token.encode()
+        return taken, renewed, blocked, await first.is_leader(), await second.is_leader()
+
+    assert asyncio.run(run()) == (True, True, False, False, True)
@@ -0,0 +1,97 @@
+import zipfile
+from app.services.static_gtfs import StaticGTFS, compile_gtfs
+
+GTFS_FILES = {
+    "stops.txt": (
+        "stop_id,stop_name,stop_lat,stop_lon,location_type,parent_station\n"
+        "101,Van Cortlandt Park-242 St,40.889248,-73.898583,1,\n"
+        "101N,Van Cortlandt Park-242 St,40.889248,-73.898583,,101\n"
+        "103N,238 St,40.884667,-73.90087,,103\n"
+    ),
+    "routes.txt": (
+        "route_id,agency_id,route_short_name,route_long_name,route_type,route_color\n"
+        "1,MTA NYCT,1,Broadway - 7 Avenue Local,1,EE352E\n"
+    ),
+    "calendar.txt": (
+        "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+        "Weekday,1,1,1,1,1,0,0,20231101,20240101\n"
+        "Sunday,0,0,0,0,0,0,1,20231101,20240101\n"
+    ),
+    "calendar_dates.txt": "service_id,date,exception_type\nSunday,20231123,1\nWeekday,20231123,2\n",
+    "trips.txt": (
+        "route_id,trip_id,service_id,trip_headsign\n"
+        "1,AFA23GEN-1038-Weekday-00_000650_1..N03R,Weekday,Van Cortlandt Park-242 St\n"
+        "1,AFA23GEN-1038-Sunday-00_000650_1..N03R,Sunday,Sunday Headsign\n"
+    ),
+    "stop_times.txt": (
+        "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+        "AFA23GEN-1038-Weekday-00_000650_1..N03R,00:08:30,00:08:30,101N,2\n"
+        "AFA23GEN-1038-Weekday-00_000650_1..N03R,00:06:30,00:06:30,103N,1\n"
+        "AFA23GEN-1038-Sunday-00_000650_1..N03R,25:00:00,25:00:00,101N,1\n"
+    ),
+}
+
+
+def build_index(tmp_path) -> StaticGTFS:
+    """
+    Compile a two-trip schedule and open it
+    """
+    source = tmp_path / "gtfs.zip"
+    with zipfile.ZipFile(source, "w") as archive:
+        for name, content in GTFS_FILES.items():
+            archive.writestr(name, content)
+    target = tmp_path / "gtfs.idx"
+    counts = compile_gtfs(str(source), str(target))
+    assert counts == {"stops": 3, "routes": 1, "trips": 2, "stop_times": 3}
+    return StaticGTFS(str(target))
+
+
+def test_lookups(tmp_path):
+    """
+    Stops, routes and trips resolve from the mapped index
+    """
+    static = build_index(tmp_path)
+    assert static.stop_name("103N") == "238 St"
+    assert static.stop("101N")["parent_station"] == "101"
+    assert static.stop_name("999N") is None
+    assert static.route("1")["color"] == "EE352E"
+
+    # Service days pick between trips sharing a realtime id
+    assert static.headsign(static.find_trip("000650_1..N03R", "20231114")) == "Van Cortlandt Park-242 St"
+    assert static.headsign(static.find_trip("000650_1..N03R", "20231119")) == "Sunday Headsign"
+    assert static.headsign(static.find_trip("000650_1..N03R", "20231123")) == "Sunday Headsign"
+    assert static.find_trip("000000_1..N03R") is None
+    assert static.find_trip("000650_1..N03R", "tomorrow") is None
+    static.close()
+
+
+def test_enrich_with_schedule(tmp_path):
+    """
+    Realtime stop time updates gain names, scheduled times and delays
+    """
+    static = build_index(tmp_path)
+    day_start = static.service_day_start("20231114")
+    data = {
+        'header': {'timestamp': day_start},
+        'vehicle_positions': [{'id': '2', 'stop_id': '103N'}],
+        'alerts': [],
+        'trip_updates': [{
+            'trip_id': '000650_1..N03R',
+            'route_id': '1',
+            'start_date': '20231114',
+            'stop_time_updates': [{'stop_id': '101N', 'arrival': {'time': day_start + 510 + 90}}]
+        }]
+    }
+    enriched = static.enrich(data)
+    trip = enriched['trip_updates'][0]
+    assert trip['headsign'] == "Van Cortlandt Park-242 St"
+    assert trip['stop_time_updates'][0] == {
+        'stop_id': '101N',
+        'arrival': {'time': day_start + 600},
+        'stop_name': "Van Cortlandt Park-242 St",
+        'scheduled_time': day_start + 510,
+        'schedule_delay': 90
+    }
+    assert enriched['vehicle_positions'][0]['stop_name'] == "238 St"
+    assert 'headsign' not in data['trip_updates'][0]
+    static.close()
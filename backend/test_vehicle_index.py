@@ -0,0 +1,76 @@
+import asyncio
+import httpx
+import json
+from app.services.vehicle_index import VehicleIndex, get_vehicle_index
+from test_arrivals_index import make_snapshot
+
+
+def brute_force(snapshots, bbox, routes=None):
+    """
+    Reference answer computed by scanning every vehicle
+    """
+    min_lat, min_lon, max_lat, max_lon = bbox
+    return sorted(
+        vehicle["id"]
+        for snapshot in snapshots
+        for vehicle in snapshot.data["vehicle_positions"]
+        if "position" in vehicle
+        and min_lat <= vehicle["position"]["latitude"] <= max_lat
+        and min_lon <= vehicle["position"]["longitude"] <= max_lon
+        and (routes is None or vehicle["trip"]["route_id"] in routes)
+    )
+
+
+def test_bbox_matches_scan():
+    """
+    Grid lookups return exactly the vehicles inside the box, for boxes
+    smaller and larger than a grid cell
+    """
+    irt = make_snapshot("irt", ["1", "2"])
+    l_train = make_snapshot("l", ["L"])
+    index = VehicleIndex(cell=0.01)
+    index.update(irt)
+    index.update(l_train)
+
+    for bbox in [(40.75, -73.98, 40.80, -73.93), (40.7601, -73.9555, 40.7649, -73.9501), (39, -75, 42, -72)]:
+        found = sorted(vehicle["id"] for vehicle in index.within(bbox))
+        assert found == brute_force([irt, l_train], bbox)
+
+    bbox = (39, -75, 42, -72)
+    assert sorted(v["id"] for v in index.within(bbox, frozenset({"L"}))) == brute_force([l_train], bbox)
+    assert len(index.within(bbox, limit=3)) == 3
+    assert index.within((41, -73, 41.1, -72.9)) == []
+
+
+def test_vehicles_endpoint():
+    """
+    The bbox endpoint takes west,south,east,north and validates it
+    """
+    from app.main import app
+
+    index = VehicleIndex()
+    snapshot = make_snapshot("irt", ["1"])
+    index.update(snapshot)
+    app.dependency_overrides[get_vehicle_index] = lambda: index
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return (
+                await client.get("/api/subway/vehicles", params={"bbox": "-75,39,-72,42", "routes": "1"}),
+                await client.get("/api/subway/vehicles", params={"bbox": "-72,39,-75,42"}),
+                await client.get("/api/subway/vehicles", params={"bbox": "nowhere"}),
+                [
+                    await client.get("/api/subway/vehicles", params={"bbox": bbox})
+                    for bbox in ("nan,39,-72,42", "-75,39,inf,42", "-inf,-inf,inf,inf")
+                ]
+            )
+
+    try:
+        found, inverted, invalid, non_finite = asyncio.run(run())
+    finally:
+        app.dependency_overrides.pop(get_vehicle_index, None)
+
+    body = json.loads(found.content)
+    assert body["count"] == len(snapshot.data["vehicle_positions"]) == len(body["vehicles"])
+    assert inverted.status_code == 400 and invalid.status_code == 400
+    assert [response.status_code for response in non_finite] == [400] * 3